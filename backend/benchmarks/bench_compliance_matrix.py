@@ -0,0 +1,99 @@
+"""
+Multi-retailer compliance benchmark.
+
+Registers 12 throwaway retailer profiles, then checks a 24-layer 1080x1920
+project against all of them two ways:
+  fan-out - one full check per retailer (what 12 /compliance/check calls cost)
+  matrix  - GET /compliance/matrix, one render and measurement for all 12
+Both must report the same violations for every retailer.
+
+Usage (from backend/, uses the MONGODB_URI in .env):
+    python benchmarks/bench_compliance_matrix.py
+"""
+import io
+import os
+import sys
+import time
+import random
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bson import ObjectId
+from PIL import Image
+from fastapi.testclient import TestClient
+
+import main
+
+RUNS = 10
+RETAILERS = [f"BenchRetailer{i:02d}" for i in range(12)]
+
+random.seed(7)
+client = TestClient(main.app)
+
+main.db.retailer_guidelines.insert_many([
+    {
+        "retailer": name,
+        "rules": {
+            "min_font_size": 12 + i,
+            "min_contrast_ratio": 3.0 + i * 0.25,
+            "logo_safe_margin_pct": 0.02 + i * 0.005,
+            "max_text_coverage_pct": 0.15 + i * 0.02,
+            "required_file_resolution": [600 + i * 50, 600 + i * 50],
+            "max_background_std": 30 + i * 5,
+        },
+    }
+    for i, name in enumerate(RETAILERS)
+])
+main.guideline_registry.reload()
+
+project_id = client.post("/editor/create-project", params={"width": 1080, "height": 1920}).json()["project_id"]
+file_ids = []
+try:
+    for i in range(12):
+        buf = io.BytesIO()
+        Image.new("RGBA", (600, 600), (random.randint(0, 255), 120, 200, 220)).save(buf, format="PNG")
+        layer = client.post(
+            f"/editor/{project_id}/add-image-layer",
+            files={"file": (f"bench_{i}.png", buf.getvalue(), "image/png")},
+            params={"x": random.randint(0, 700), "y": random.randint(0, 1500), "width": 380, "height": 380, "opacity": 0.9},
+        ).json()["layer"]
+        file_ids.append(layer["file_id"])
+    for i in range(12):
+        client.post(
+            f"/editor/{project_id}/add-text-layer",
+            params={"text": f"Offer line {i}", "font_size": random.randint(10, 60), "x": random.randint(0, 700), "y": random.randint(0, 1800)},
+        )
+    proj = main.db.editor_projects.find_one({"_id": ObjectId(project_id)})
+
+    fanout_ms, matrix_ms = [], []
+    for _ in range(RUNS):
+        main.compliance_states.clear()
+        start = time.perf_counter()
+        expected = {
+            name: main.evaluate_compliance(project_id, proj, main.guideline_registry.get(name).rules)["violations"]
+            for name in RETAILERS
+        }
+        fanout_ms.append((time.perf_counter() - start) * 1000)
+
+        main.compliance_states.clear()
+        start = time.perf_counter()
+        r = client.get(f"/compliance/matrix/{project_id}", params={"retailers": ",".join(RETAILERS)})
+        matrix_ms.append((time.perf_counter() - start) * 1000)
+
+        assert r.status_code == 200, r.text
+        assert r.json()["violations"] == expected, "matrix disagrees with per-retailer checks"
+
+    print(f"{len(proj['layers'])} layers on 1080x1920, {len(RETAILERS)} retailers, {RUNS} runs")
+    print(f"fan-out p50 {statistics.median(fanout_ms):8.2f} ms")
+    print(f"matrix  p50 {statistics.median(matrix_ms):8.2f} ms  (includes HTTP round-trip and project read)")
+    for name, row in list(r.json()["matrix"].items())[:3]:
+        print(f"  {name}: {row}")
+    print("OK: matrix matches per-retailer checks")
+finally:
+    main.db.editor_projects.delete_one({"_id": ObjectId(project_id)})
+    main.db.editor_revisions.delete_many({"project_id": ObjectId(project_id)})
+    main.db.retailer_guidelines.delete_many({"retailer": {"$in": RETAILERS}})
+    main.guideline_registry.reload()
+    for fid in file_ids:
+        main.fs.delete(ObjectId(fid))
@@ -0,0 +1,82 @@
+"""
+Incremental compositor benchmark.
+
+Builds a 1080x1920 story canvas with 24 layers (12 images, 12 text), then
+moves one text layer 50 times. Each step is rendered both from scratch
+(compose_layers) and through render_project_image, which re-composites only
+the dirty region. Outputs are compared pixel for pixel.
+
+Usage (from backend/, uses the MONGODB_URI in .env):
+    python benchmarks/bench_compositor.py
+"""
+import io
+import os
+import sys
+import time
+import random
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bson import ObjectId
+from PIL import Image
+from fastapi.testclient import TestClient
+
+import main
+
+STEPS = 50
+
+random.seed(7)
+client = TestClient(main.app)
+
+project_id = client.post("/editor/create-project", params={"width": 1080, "height": 1920}).json()["project_id"]
+file_ids = []
+try:
+    for i in range(12):
+        buf = io.BytesIO()
+        Image.new("RGBA", (600, 600), (random.randint(0, 255), 120, 200, 220)).save(buf, format="PNG")
+        layer = client.post(
+            f"/editor/{project_id}/add-image-layer",
+            files={"file": (f"bench_{i}.png", buf.getvalue(), "image/png")},
+            params={"x": random.randint(0, 700), "y": random.randint(0, 1500), "width": 380, "height": 380, "opacity": 0.9},
+        ).json()["layer"]
+        file_ids.append(layer["file_id"])
+    text_ids = []
+    for i in range(12):
+        r = client.post(
+            f"/editor/{project_id}/add-text-layer",
+            params={"text": f"Offer line {i}", "font_size": 48, "x": random.randint(0, 700), "y": random.randint(0, 1800)},
+        )
+        text_ids.append(r.json()["layer"]["layer_id"])
+
+    moved = text_ids[3]  # a layer in the middle of the stack
+    main.render_project_image(project_id)  # warm the compositor and bitmap cache
+
+    full_ms, incremental_ms = [], []
+    for step in range(STEPS):
+        main.db.editor_projects.update_one(
+            {"_id": ObjectId(project_id), "layers.layer_id": moved},
+            {"$set": {"layers.$.x": 100 + step * 8, "layers.$.y": 600 + step * 4}},
+        )
+        proj = main.db.editor_projects.find_one({"_id": ObjectId(project_id)})
+
+        start = time.perf_counter()
+        expected = main.compose_layers((proj["width"], proj["height"]), proj["background_color"], proj["layers"]).convert("RGB")
+        full_ms.append((time.perf_counter() - start) * 1000)
+
+        start = time.perf_counter()
+        actual = main.render_project_image(project_id)
+        incremental_ms.append((time.perf_counter() - start) * 1000)
+
+        assert actual.tobytes() == expected.tobytes(), f"render mismatch at step {step}"
+
+    print(f"{len(proj['layers'])} layers on 1080x1920, {STEPS} single-layer moves")
+    print(f"full render        p50 {statistics.median(full_ms):7.2f} ms")
+    print(f"incremental render p50 {statistics.median(incremental_ms):7.2f} ms  (includes project read)")
+    print(f"compositor: {main.project_compositor.stats()}")
+    print("OK: incremental output matches full render")
+finally:
+    main.db.editor_projects.delete_one({"_id": ObjectId(project_id)})
+    main.db.editor_revisions.delete_many({"project_id": ObjectId(project_id)})
+    for fid in file_ids:
+        main.fs.delete(ObjectId(fid))
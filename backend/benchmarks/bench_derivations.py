@@ -0,0 +1,71 @@
+"""
+Derived-asset memo benchmark.
+
+Stores a 6000x4000 catalog JPEG (bench_segmentation_proxy.py's product on a
+gradient) in GridFS and calls /enhance, /crop, /smart-enhance, /smart-crop
+(edges detector) and /auto-resize on it three times: the first call renders,
+the repeat returns the recorded derivation, and force=true renders again.
+Prints the latency of each and the GridFS files the repeat added (0 when
+the memo hits). Every file written is deleted again.
+
+Usage (from backend/, uses the .env like the app):
+    python benchmarks/bench_derivations.py
+"""
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bson import ObjectId
+
+import main
+from bench_segmentation_proxy import WIDTH, HEIGHT, catalog_photo
+
+OPERATIONS = [
+    ("enhance", main.enhance_image_by_id, {}),
+    ("crop", main.crop_image, {"mode": "portrait"}),
+    ("smart-enhance", main.smart_enhance, {}),
+    ("smart-crop", main.smart_crop, {"mode": "square", "detector": "edges"}),
+    ("auto-resize", main.auto_resize, {}),
+]
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return result, (time.perf_counter() - start) * 1000
+
+def file_ids(result):
+    return [f["file_id"] for f in result["files"]] if "files" in result else [result["new_file_id"]]
+
+def stored_files():
+    return main.db.fs.files.count_documents({})
+
+if __name__ == "__main__":
+    buf = io.BytesIO()
+    catalog_photo(0)[0].save(buf, format="JPEG", quality=90)
+    source = buf.getvalue()
+    source_id = str(main.fs.put(source, filename="bench_derivations.jpg", contentType="image/jpeg"))
+    written = set()
+
+    print(f"{WIDTH}x{HEIGHT} JPEG ({len(source) / 1e6:.1f} MB)")
+    print(f"{'operation':>14} {'first ms':>9} {'repeat ms':>10} {'force ms':>9} {'repeat files':>13}")
+    try:
+        for name, endpoint, params in OPERATIONS:
+            main.db.derivations.delete_many({"operation": name})
+            first, first_ms = timed(lambda: endpoint(source_id, force=True, **params))
+            before = stored_files()
+            repeat, repeat_ms = timed(lambda: endpoint(source_id, **params))
+            added = stored_files() - before
+            forced, force_ms = timed(lambda: endpoint(source_id, force=True, **params))
+            assert repeat.get("cached") and file_ids(repeat) == file_ids(first), f"{name}: repeat was not memoized"
+            written.update(file_ids(first) + file_ids(forced))
+            print(f"{name:>14} {first_ms:9.0f} {repeat_ms:10.1f} {force_ms:9.0f} {added:13d}")
+    finally:
+        for file_id in written:
+            main.fs.delete(ObjectId(file_id))
+            if os.path.exists(f"processed/{file_id}.png"):
+                os.remove(f"processed/{file_id}.png")
+        main.db.derivations.delete_many({"file_ids": {"$in": list(written)}})
+        main.fs.delete(ObjectId(source_id))
@@ -0,0 +1,60 @@
+"""
+Editor undo-history benchmark.
+
+Runs 1,000 layer edits against a throwaway project and prints the project
+document size, stored revision count and per-edit latency every 100 edits.
+All three should stay flat once the history reaches EDITOR_HISTORY_DEPTH.
+
+Usage (from backend/, uses the MONGODB_URI in .env):
+    python benchmarks/bench_editor_history.py
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bson
+from bson import ObjectId
+from fastapi.testclient import TestClient
+
+import main
+
+EDITS = 1000
+CHECKPOINT = 100
+
+client = TestClient(main.app)
+
+project_id = client.post("/editor/create-project", params={"width": 1080, "height": 1920}).json()["project_id"]
+try:
+    layer_ids = []
+    for i in range(10):
+        r = client.post(f"/editor/{project_id}/add-text-layer", params={"text": f"Layer {i}", "y": i * 100})
+        layer_ids.append(r.json()["layer"]["layer_id"])
+
+    print(f"History depth: {main.EDITOR_HISTORY_DEPTH}")
+    print(f"{'edits':>6} {'doc size (KB)':>14} {'revisions':>10} {'avg edit (ms)':>14}")
+
+    timings = []
+    for i in range(1, EDITS + 1):
+        start = time.perf_counter()
+        client.put(
+            f"/editor/{project_id}/update-layer/{layer_ids[i % len(layer_ids)]}",
+            json={"x": i % 500, "y": (i * 7) % 1500},
+        )
+        timings.append(time.perf_counter() - start)
+
+        if i % CHECKPOINT == 0:
+            doc = main.db.editor_projects.find_one({"_id": ObjectId(project_id)})
+            size_kb = len(bson.encode(doc)) / 1024
+            revisions = main.db.editor_revisions.count_documents({"project_id": ObjectId(project_id)})
+            avg_ms = sum(timings[-CHECKPOINT:]) / CHECKPOINT * 1000
+            print(f"{i:>6} {size_kb:>14.1f} {revisions:>10} {avg_ms:>14.2f}")
+
+    start = time.perf_counter()
+    for _ in range(10):
+        client.post(f"/editor/{project_id}/undo")
+    print(f"undo avg: {(time.perf_counter() - start) / 10 * 1000:.2f} ms")
+finally:
+    main.db.editor_projects.delete_one({"_id": ObjectId(project_id)})
+    main.db.editor_revisions.delete_many({"project_id": ObjectId(project_id)})
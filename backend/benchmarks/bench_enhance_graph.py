@@ -0,0 +1,82 @@
+"""
+Fused enhancement graph benchmark.
+
+Runs the default smart-enhance chain on a 6000x4000 synthetic photo, PIL
+image in and PIL image out, in two modes. Each mode runs in its own process
+so the peak RSS figures are comparable:
+  chain - the helpers called one after another, each allocating its output
+  graph - run_enhance_graph(smart_enhance_graph()): steps 1-2 fused into one
+          in-place LUT pass, buffers reused, identity steps skipped
+Both outputs are hashed and must match.
+
+Usage (from backend/, uses the .env like the app):
+    python benchmarks/bench_enhance_graph.py
+"""
+import os
+import sys
+import time
+import hashlib
+import resource
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+WIDTH, HEIGHT = 6000, 4000
+RUNS = 3
+
+def peak_rss_mb():
+    # ru_maxrss is KB on Linux, bytes on macOS
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+
+def photo():
+    import cv2
+    import numpy as np
+    from PIL import Image
+    rng = np.random.default_rng(5)
+    ramp = np.linspace(0, 1, HEIGHT, dtype=np.float32)[:, None, None]
+    img = np.broadcast_to(np.array([235, 215, 200]) * (1 - ramp) + np.array([150, 140, 120]) * ramp, (HEIGHT, WIDTH, 3))
+    img = np.ascontiguousarray(img, dtype=np.uint8)
+    for _ in range(40):
+        cv2.circle(img, (int(rng.integers(0, WIDTH)), int(rng.integers(0, HEIGHT))), int(rng.integers(50, 600)),
+                   [int(c) for c in rng.integers(20, 230, 3)], -1)
+    return Image.fromarray(cv2.add(img, rng.integers(0, 25, img.shape, dtype=np.uint8)))  # sensor noise
+
+def run_mode(mode):
+    import main
+
+    pil_img = photo()
+    baseline = peak_rss_mb()
+    times = []
+    for _ in range(RUNS):
+        start = time.perf_counter()
+        img = main.pil_to_cv(pil_img)
+        if mode == "chain":
+            img = main.auto_white_balance(img)
+            img = main.enhance_shadows_highlights(img)
+            img = main.auto_contrast(img)
+            img = main.noise_reduction(img)
+            img = main.smart_sharpen(img)
+            out = main.cv_to_pil(img)
+        else:
+            img = main.run_enhance_graph(img, main.smart_enhance_graph())
+            out = main.cv_to_pil(img)
+        times.append(time.perf_counter() - start)
+        del img
+    digest = hashlib.sha256(out.tobytes()).hexdigest()[:16]
+    print(f"{mode:>6}: peak RSS +{peak_rss_mb() - baseline:6.0f} MB, best of {RUNS} {min(times):6.2f} s, output {digest}")
+    return digest
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        run_mode(sys.argv[1])
+    else:
+        print(f"default smart-enhance chain on {WIDTH}x{HEIGHT}")
+        digests = []
+        for mode in ("chain", "graph"):
+            out = subprocess.run([sys.executable, os.path.abspath(__file__), mode], check=True, capture_output=True, text=True).stdout
+            line = out.strip().splitlines()[-1]
+            print(line)
+            digests.append(line.rsplit(" ", 1)[-1])
+        assert digests[0] == digests[1], "graph output differs from the chain"
+        print("OK: outputs match")
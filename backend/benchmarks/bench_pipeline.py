@@ -0,0 +1,111 @@
+"""
+Pipeline benchmark.
+
+Runs the asset flow remove-bg -> smart-crop -> smart-enhance -> auto-resize
+on a 6000x4000 catalog JPEG (bench_segmentation_proxy.py's product on a
+gradient) two ways:
+  chained  - one endpoint per hop, each reading the previous hop's PNG back
+             from GridFS and storing its own
+  pipeline - POST /pipeline with the same steps, storing only the
+             auto-resize channels
+and prints wall time, PNG encodes and bytes written to GridFS. The stored
+channels are hashed and must match. remove-bg is left out (smart-crop then
+uses the edges detector) when the rembg model can't load. Every file written
+is deleted again.
+
+Usage (from backend/, uses the .env like the app):
+    python benchmarks/bench_pipeline.py
+"""
+import io
+import os
+import sys
+import time
+import hashlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bson import ObjectId
+from PIL import Image
+
+import main
+from bench_segmentation_proxy import WIDTH, HEIGHT, catalog_photo
+
+class GridFSMeter:
+    """Counts what goes through fs.put and remembers it for cleanup."""
+    def __init__(self):
+        self.put, self.file_ids, self.bytes = main.fs.put, [], 0
+
+    def __enter__(self):
+        def put(data, **kwargs):
+            file_id = self.put(data, **kwargs)
+            self.file_ids.append(file_id)
+            self.bytes += len(data)
+            return file_id
+        main.fs.put = put
+        return self
+
+    def __exit__(self, *exc):
+        main.fs.put = self.put
+        for file_id in self.file_ids:
+            main.fs.delete(file_id)
+            for ext in ("png", "jpeg", "webp"):
+                if os.path.exists(f"processed/{file_id}.{ext}"):
+                    os.remove(f"processed/{file_id}.{ext}")
+
+def digest(file_ids):
+    h = hashlib.sha256()
+    for file_id in file_ids:
+        h.update(Image.open(io.BytesIO(main.fs.get(ObjectId(file_id)).read())).tobytes())
+    return h.hexdigest()[:16]
+
+def chained(source_id, steps):
+    file_id = source_id
+    for op, params in steps[:-1]:
+        endpoint = {"remove-bg": main.remove_background_by_id, "smart-crop": main.smart_crop,
+                    "smart-enhance": main.smart_enhance}[op]
+        file_id = endpoint(file_id, **params)["new_file_id"]
+    return [f["file_id"] for f in main.auto_resize(file_id)["files"]]
+
+def pipelined(source_id, steps):
+    req = main.PipelineRequest(file_id=source_id, steps=[{"op": op, "params": params} for op, params in steps])
+    return [f["file_id"] for f in main.run_pipeline(req)["files"]]
+
+if __name__ == "__main__":
+    try:
+        main.rembg_sessions.warm_up()
+        steps = [("remove-bg", {}), ("smart-crop", {"detector": "background"})]
+    except Exception as e:
+        print(f"rembg unavailable ({type(e).__name__}); running without remove-bg")
+        steps = [("smart-crop", {"detector": "edges"})]
+    steps += [("smart-enhance", {}), ("auto-resize", {})]
+
+    buf = io.BytesIO()
+    catalog_photo(0)[0].save(buf, format="JPEG", quality=90)
+    source_id = str(main.fs.put(buf.getvalue(), filename="bench_pipeline.jpg", contentType="image/jpeg"))
+
+    encodes = 0
+    save = Image.Image.save
+    def counting_save(img, fp, format=None, **params):
+        global encodes
+        if (format or "").upper() == "PNG" or str(fp).endswith(".png"):
+            encodes += 1
+        return save(img, fp, format, **params)
+    Image.Image.save = counting_save
+
+    print(f"{' -> '.join(op for op, _ in steps)} on {WIDTH}x{HEIGHT}")
+    print(f"{'mode':>9} {'seconds':>8} {'PNG encodes':>12} {'GridFS MB':>10}  output")
+    digests = []
+    try:
+        for name, run in (("chained", chained), ("pipeline", pipelined)):
+            encodes = 0
+            with GridFSMeter() as meter:
+                start = time.perf_counter()
+                file_ids = run(source_id, steps)
+                seconds = time.perf_counter() - start
+                digests.append(digest(file_ids))
+            print(f"{name:>9} {seconds:8.2f} {encodes:12d} {meter.bytes / 1e6:10.1f}  {digests[-1]}")
+    finally:
+        Image.Image.save = save
+        main.fs.delete(ObjectId(source_id))
+    assert digests[0] == digests[1], "pipeline output differs from the chained endpoints"
+    print("OK: outputs match")
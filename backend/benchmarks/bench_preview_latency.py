@@ -0,0 +1,65 @@
+"""
+Preview latency benchmark.
+
+Stores a 6000x4000 catalog JPEG (bench_segmentation_proxy.py's product on a
+gradient) in GridFS and times /enhance, /smart-enhance, /crop and /smart-crop
+(edges detector) as the endpoints run them, preview=true (reduced JPEG
+decode, PNG bytes returned, nothing stored) against the full-resolution
+render. Committing the preview afterwards is the full render.
+Every file the full renders store is deleted again.
+
+Usage (from backend/, uses the .env like the app):
+    python benchmarks/bench_preview_latency.py
+"""
+import io
+import os
+import sys
+import time
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bson import ObjectId
+
+import main
+from bench_segmentation_proxy import WIDTH, HEIGHT, catalog_photo
+
+RUNS = 5
+
+OPERATIONS = [
+    ("enhance", main.enhance_image_by_id, {}),
+    ("smart-enhance", main.smart_enhance, {}),
+    ("crop", main.crop_image, {"mode": "portrait"}),
+    ("smart-crop", main.smart_crop, {"mode": "square", "detector": "edges"}),
+]
+
+def timed(fn, runs):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = fn()
+        times.append((time.perf_counter() - start) * 1000)
+    return result, statistics.median(times)
+
+def discard(result):
+    file_id = result["new_file_id"]
+    main.fs.delete(ObjectId(file_id))
+    if os.path.exists(f"processed/{file_id}.png"):
+        os.remove(f"processed/{file_id}.png")
+
+if __name__ == "__main__":
+    buf = io.BytesIO()
+    catalog_photo(0)[0].save(buf, format="JPEG", quality=90)
+    source_id = str(main.fs.put(buf.getvalue(), filename="bench_preview.jpg", contentType="image/jpeg"))
+
+    print(f"{WIDTH}x{HEIGHT} JPEG ({len(buf.getvalue()) / 1e6:.1f} MB), PREVIEW_MAX_SIDE={main.PREVIEW_MAX_SIDE}")
+    print(f"{'operation':>14} {'preview ms':>11} {'full ms':>9} {'speedup':>8}")
+    try:
+        for name, endpoint, params in OPERATIONS:
+            response, preview_ms = timed(lambda: endpoint(source_id, preview=True, **params), RUNS)
+            main.db.previews.delete_one({"_id": ObjectId(response.headers["X-Preview-Id"])})
+            result, full_ms = timed(lambda: endpoint(source_id, **params), 1)
+            discard(result)
+            print(f"{name:>14} {preview_ms:11.0f} {full_ms:9.0f} {full_ms / preview_ms:8.1f}x")
+    finally:
+        main.fs.delete(ObjectId(source_id))
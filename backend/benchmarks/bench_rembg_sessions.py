@@ -0,0 +1,61 @@
+"""
+Background-removal session benchmark.
+
+Runs each mode in a fresh process so cold start is really cold:
+  sessionless - rembg.remove(image) with no session, as the endpoints used to
+  pooled      - RembgSessionPool: warm_up() once, then remove() on a pooled session
+and prints the cold-start time (app imported -> first result ready) and the
+steady-state p50 over the following calls on a 1024x1024 synthetic product shot.
+
+Usage (from backend/, uses the .env and REMBG_* settings like the app; run it
+once beforehand if the model still has to be downloaded):
+    python benchmarks/bench_rembg_sessions.py
+"""
+import os
+import sys
+import time
+import statistics
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+CALLS = 20
+
+def product_shot():
+    from PIL import Image, ImageDraw
+    img = Image.new("RGB", (1024, 1024), (235, 235, 240))
+    draw = ImageDraw.Draw(img)
+    draw.rectangle((0, 700, 1024, 1024), fill=(200, 200, 210))
+    draw.ellipse((312, 220, 712, 820), fill=(180, 40, 40))
+    return img
+
+def run_mode(mode):
+    os.environ["REMBG_PRELOAD"] = "0"
+    import main
+    image = product_shot()
+
+    start = time.perf_counter()
+    if mode == "sessionless":
+        call = lambda: main.remove(image)
+    else:
+        main.rembg_sessions.warm_up()
+        call = lambda: main.rembg_sessions.remove(image)
+    call()
+    cold_ms = (time.perf_counter() - start) * 1000
+
+    timings = []
+    for _ in range(CALLS):
+        start = time.perf_counter()
+        call()
+        timings.append((time.perf_counter() - start) * 1000)
+    print(f"{mode:>12}: cold start {cold_ms:8.0f} ms, steady p50 {statistics.median(timings):7.1f} ms")
+    if mode == "pooled":
+        print(f"{'':>12}  {main.rembg_sessions.stats()}")
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        run_mode(sys.argv[1])
+    else:
+        print(f"{CALLS} calls per mode on a 1024x1024 image")
+        for mode in ("sessionless", "pooled"):
+            subprocess.run([sys.executable, os.path.abspath(__file__), mode], check=True)
@@ -0,0 +1,110 @@
+"""
+Proxy segmentation benchmark.
+
+Builds large synthetic catalog photos (a textured product on a gradient
+background, with a known anti-aliased alpha) and compares full-resolution
+segmentation with segmenting a SEGMENT_PROXY_SIZE proxy and refining the edge
+band at full size (refine_mask_edges):
+  refine  - a 320 px model-resolution mask (what rembg produces) upsampled
+            plainly vs through refine_mask_edges; runs without the model
+  grabcut - grabcut_mask on the proxy; --full-grabcut adds the old
+            full-resolution run (minutes per image at 6000x4000)
+  rembg   - full-resolution vs proxy + refine (skipped if the model can't load)
+
+Edge error is the mean alpha difference within 16 px of the true outline.
+
+Usage (from backend/, uses the .env and REMBG_* settings like the app):
+    python benchmarks/bench_segmentation_proxy.py [--full-grabcut]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cv2
+import numpy as np
+from PIL import Image, ImageDraw, ImageFilter
+
+import main
+
+WIDTH, HEIGHT = 6000, 4000
+IMAGES = 3
+
+def catalog_photo(seed):
+    rng = np.random.default_rng(seed)
+    w, h = WIDTH, HEIGHT
+    bg = rng.integers(200, 250, 3)
+    ramp = np.linspace(0, 1, h, dtype=np.float32)[:, None, None]
+    background = np.broadcast_to(bg * (1 - ramp) + (bg - 50) * ramp, (h, w, 3))
+
+    alpha = Image.new("L", (w, h), 0)
+    draw = ImageDraw.Draw(alpha)
+    cx, cy = rng.uniform(0.35, 0.65) * w, rng.uniform(0.4, 0.6) * h
+    draw.ellipse((cx - w * 0.18, cy - h * 0.3, cx + w * 0.05, cy + h * 0.3), fill=255)
+    draw.rounded_rectangle((cx - w * 0.05, cy - h * 0.15, cx + w * 0.2, cy + h * 0.35), radius=h // 12, fill=255)
+    draw.polygon([(cx + w * 0.08, cy - h * 0.38), (cx + w * 0.18, cy - h * 0.1), (cx, cy - h * 0.1)], fill=255)
+    truth = np.asarray(alpha.filter(ImageFilter.GaussianBlur(1.2)))
+
+    texture = cv2.resize(rng.normal(0, 12, (h // 16, w // 16)).astype(np.float32), (w, h))[..., None]
+    product = np.clip(rng.integers(30, 160, 3) + texture, 0, 255)
+    a = truth[..., None] / 255
+    return Image.fromarray((background * (1 - a) + product * a).astype(np.uint8)), truth
+
+def edge_error(mask, truth):
+    band = cv2.dilate(cv2.Canny(truth, 50, 150), np.ones((33, 33), np.uint8)) > 0
+    return float(np.abs(np.asarray(mask, dtype=np.float32) - truth)[band].mean() / 255)
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, (time.perf_counter() - start) * 1000
+
+def row(label, errors, times):
+    print(f"{label:>28}  {np.mean(errors):10.4f}  {np.median(times):10.0f}")
+
+def with_proxy_size(size, fn, *args):
+    saved, main.SEGMENT_PROXY_SIZE = main.SEGMENT_PROXY_SIZE, size
+    try:
+        return fn(*args)
+    finally:
+        main.SEGMENT_PROXY_SIZE = saved
+
+if __name__ == "__main__":
+    full_grabcut = "--full-grabcut" in sys.argv
+    try:
+        main.rembg_sessions.warm_up()
+        have_rembg = True
+    except Exception as e:
+        print(f"rembg unavailable ({type(e).__name__}); skipping the rembg rows")
+        have_rembg = False
+
+    results = {}
+    def record(label, mask_and_ms, truth):
+        mask, ms = mask_and_ms
+        errors, times = results.setdefault(label, ([], []))
+        errors.append(edge_error(mask, truth))
+        times.append(ms)
+
+    for seed in range(IMAGES):
+        image, truth = catalog_photo(seed)
+        proxy, factor = main.segmentation_proxy(image)
+        model_mask = Image.fromarray(truth).resize((320, 320), Image.BOX)  # rembg's working resolution
+
+        record("refine: plain upsample", timed(lambda: model_mask.resize(image.size, Image.LANCZOS)), truth)
+        record("refine: proxy + edge band", timed(lambda: main.refine_mask_edges(image, model_mask.resize(proxy.size, Image.LANCZOS))), truth)
+
+        record("grabcut: proxy + edge band", timed(main.grabcut_mask, image), truth)
+        if full_grabcut:
+            record("grabcut: full resolution", timed(with_proxy_size, 0, main.grabcut_mask, image), truth)
+
+        if have_rembg:
+            record("rembg: full resolution", timed(lambda: main.rembg_sessions.remove(image, only_mask=True).convert("L")), truth)
+            def proxied():
+                return main.refine_mask_edges(image, main.rembg_sessions.remove(proxy, only_mask=True).convert("L"))
+            record("rembg: proxy + edge band", timed(proxied), truth)
+
+    print(f"{IMAGES} photos at {WIDTH}x{HEIGHT}, SEGMENT_PROXY_SIZE={main.SEGMENT_PROXY_SIZE} (proxy {proxy.size[0]}x{proxy.size[1]})")
+    print(f"{'':>28}  {'edge error':>10}  {'p50 ms':>10}")
+    for label, (errors, times) in results.items():
+        row(label, errors, times)
@@ -0,0 +1,117 @@
+"""
+Smart-crop subject detector benchmark.
+
+Generates a synthetic set of packshots (one product shape with a label and a
+soft shadow on a plain, gradient or textured background, ground-truth box
+known) and runs every detector on each image:
+  background / edges - the fast detectors behind smart-crop's `detector`
+  rembg              - full segmentation (skipped if the model can't load)
+For each it prints bbox IoU against the ground truth and against rembg, how
+often the confidence gate would fall back to rembg, and latency.
+
+Usage (from backend/, uses the .env and REMBG_* settings like the app):
+    python benchmarks/bench_smart_crop_detectors.py
+"""
+import os
+import sys
+import time
+import random
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("REMBG_PRELOAD", "0")
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFilter
+
+import main
+
+IMAGES = 60
+random.seed(11)
+
+def packshot():
+    w, h = random.choice([(1200, 1200), (1600, 1200), (1000, 1400)])
+    kind = random.choices(["plain", "gradient", "textured"], weights=[3, 2, 1])[0]
+    bg = tuple(random.randint(215, 255) for _ in range(3))
+    img = Image.new("RGB", (w, h), bg)
+    if kind == "gradient":
+        ramp = np.linspace(0, 1, h)[:, None, None]
+        dark = np.array(bg) - 45
+        img = Image.fromarray((np.array(bg) * (1 - ramp) + dark * ramp).repeat(w, axis=1).astype(np.uint8))
+    elif kind == "textured":
+        noise = np.random.default_rng(random.randint(0, 9999)).integers(0, 90, (h // 8, w // 8, 3))
+        img = Image.fromarray(np.clip(np.array(bg) - noise, 0, 255).astype(np.uint8)).resize((w, h), Image.NEAREST)
+
+    sw, sh = int(w * random.uniform(0.25, 0.6)), int(h * random.uniform(0.3, 0.7))
+    x0, y0 = random.randint(int(w * 0.05), w - sw - int(w * 0.05)), random.randint(int(h * 0.05), h - sh - int(h * 0.05))
+    box = (x0, y0, x0 + sw, y0 + sh)
+
+    shadow = Image.new("L", (w, h), 0)
+    ImageDraw.Draw(shadow).ellipse((x0 + sw * 0.1, y0 + sh * 0.92, x0 + sw * 1.05, y0 + sh * 1.04), fill=90)
+    img = Image.composite(Image.new("RGB", (w, h), (60, 60, 60)), img, shadow.filter(ImageFilter.GaussianBlur(18)))
+
+    draw = ImageDraw.Draw(img)
+    color = tuple(random.randint(20, 200) for _ in range(3))
+    shape = random.choice(["ellipse", "rounded", "bottle"])
+    if shape == "ellipse":
+        draw.ellipse(box, fill=color)
+    elif shape == "rounded":
+        draw.rounded_rectangle(box, radius=min(sw, sh) // 6, fill=color)
+    else:
+        neck = sw // 3
+        draw.rounded_rectangle((x0 + neck, y0, x0 + sw - neck, y0 + sh // 4), radius=neck // 3, fill=color)
+        draw.rounded_rectangle((x0, y0 + sh // 5, x0 + sw, y0 + sh), radius=sw // 5, fill=color)
+    draw.rectangle((x0 + sw // 5, y0 + sh // 2, x0 + sw * 4 // 5, y0 + sh * 3 // 4), fill=(245, 245, 245))
+    return img.convert("RGBA"), box, kind
+
+def iou(a, b):
+    if not a or not b:
+        return 0.0
+    ix = max(0, min(a[2], b[2]) - max(a[0], b[0]))
+    iy = max(0, min(a[3], b[3]) - max(a[1], b[1]))
+    inter = ix * iy
+    return inter / ((a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - inter)
+
+def fast_detect(name, image):
+    # same steps as detect_subject_bbox, without the rembg fallback
+    factor = max(1, max(image.size) // main.DETECTOR_PROXY_SIZE)
+    proxy = image.reduce(factor) if factor > 1 else image
+    scale = 1 / factor
+    mask, confidence = main.FAST_SUBJECT_DETECTORS[name](np.asarray(proxy))
+    bbox, coverage = main._mask_bbox(mask, scale, image.size)
+    if bbox is None or not 0.005 <= coverage <= 0.9:
+        confidence = 0.0
+    return bbox, confidence
+
+dataset = [packshot() for _ in range(IMAGES)]
+rembg_boxes, rembg_ms = [], []
+try:
+    main.rembg_sessions.warm_up()
+    for image, _, _ in dataset:
+        start = time.perf_counter()
+        rembg_boxes.append(main.rembg_sessions.remove(image).getchannel("A").getbbox())
+        rembg_ms.append((time.perf_counter() - start) * 1000)
+except Exception as e:
+    print(f"rembg unavailable ({e.__class__.__name__}); comparing against ground truth only")
+    rembg_boxes = []
+
+kinds = {k: sum(1 for _, _, kind in dataset if kind == k) for k in ("plain", "gradient", "textured")}
+print(f"{IMAGES} synthetic packshots {kinds}, confidence gate {main.SMART_CROP_MIN_CONFIDENCE}")
+print(f"{'detector':>10} {'IoU truth':>10} {'IoU rembg':>10} {'kept':>6} {'IoU kept':>9} {'p50 ms':>8}")
+for name in main.FAST_SUBJECT_DETECTORS:
+    truth, vs_rembg, kept, timings = [], [], [], []
+    for i, (image, box, _) in enumerate(dataset):
+        start = time.perf_counter()
+        bbox, confidence = fast_detect(name, image)
+        timings.append((time.perf_counter() - start) * 1000)
+        truth.append(iou(bbox, box))
+        if rembg_boxes:
+            vs_rembg.append(iou(bbox, rembg_boxes[i]))
+        if confidence >= main.SMART_CROP_MIN_CONFIDENCE:
+            kept.append(truth[-1])
+    print(f"{name:>10} {statistics.mean(truth):10.3f} {statistics.mean(vs_rembg) if vs_rembg else float('nan'):10.3f} "
+          f"{len(kept):>6} {statistics.mean(kept) if kept else float('nan'):9.3f} {statistics.median(timings):8.2f}")
+if rembg_boxes:
+    truth = [iou(b, box) for b, (_, box, _) in zip(rembg_boxes, dataset)]
+    print(f"{'rembg':>10} {statistics.mean(truth):10.3f} {1.0:10.3f} {IMAGES:>6} {statistics.mean(truth):9.3f} {statistics.median(rembg_ms):8.2f}")
+print("kept = images whose confidence passes the gate (the rest fall back to rembg)")
@@ -0,0 +1,90 @@
+"""
+Tiled smart-enhance benchmark.
+
+Runs the smart-enhance chain on a 6000x4000 synthetic photo untiled (the
+fused graph) and through smart_enhance_tiled on 1..N cores (N = cores
+available, or the counts given on the command line). Each run is a separate
+process pinned to that many cores (OpenCV's own thread count set to match),
+so wall time and peak RSS are comparable. Each tiled output is compared with
+the untiled one: they should match, but OpenCV's vectorised filters can round
+a tile's edge pixels differently, so differences of a level are reported
+rather than failed.
+
+Usage (from backend/, uses the .env like the app):
+    python benchmarks/bench_smart_enhance_tiled.py [cores ...]
+"""
+import os
+import sys
+import time
+import resource
+import subprocess
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+WIDTH, HEIGHT = 6000, 4000
+
+def peak_rss_mb():
+    # ru_maxrss is KB on Linux, bytes on macOS
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+
+def photo():
+    import cv2
+    import numpy as np
+    rng = np.random.default_rng(5)
+    ramp = np.linspace(0, 1, HEIGHT, dtype=np.float32)[:, None, None]
+    img = np.broadcast_to(np.array([200, 215, 235]) * (1 - ramp) + np.array([120, 140, 150]) * ramp, (HEIGHT, WIDTH, 3))
+    img = np.ascontiguousarray(img, dtype=np.uint8)
+    for _ in range(40):
+        cv2.circle(img, (int(rng.integers(0, WIDTH)), int(rng.integers(0, HEIGHT))), int(rng.integers(50, 600)),
+                   [int(c) for c in rng.integers(20, 230, 3)], -1)
+    return cv2.add(img, rng.integers(0, 25, img.shape, dtype=np.uint8))  # sensor noise
+
+def run(mode, cores, path):
+    import cv2
+    import numpy as np
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, sorted(os.sched_getaffinity(0))[:cores])
+    cv2.setNumThreads(cores)
+    import main
+
+    img = photo()
+    baseline = peak_rss_mb()
+    start = time.perf_counter()
+    if mode == "untiled":
+        out = main.run_enhance_graph(img.copy(), main.smart_enhance_graph())
+    else:
+        out = main.smart_enhance_tiled(img, workers=cores)
+    elapsed = time.perf_counter() - start
+    rss = peak_rss_mb() - baseline
+    np.save(path, out)
+    print(f"{mode},{cores},{elapsed:.3f},{rss:.0f}")
+
+if __name__ == "__main__":
+    if len(sys.argv) == 5 and sys.argv[1] == "--run":
+        run(sys.argv[2], int(sys.argv[3]), sys.argv[4])
+        sys.exit(0)
+
+    available = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 1)
+    counts = [int(c) for c in sys.argv[1:]] or sorted({1, 2, 4, 8, available} & set(range(1, available + 1)))
+
+    import numpy as np
+    workdir = tempfile.mkdtemp()
+
+    def child(mode, cores):
+        path = os.path.join(workdir, f"{mode}.npy")
+        out = subprocess.run([sys.executable, os.path.abspath(__file__), "--run", mode, str(cores), path],
+                             check=True, capture_output=True, text=True).stdout
+        mode, cores, seconds, rss = out.strip().splitlines()[-1].split(",")
+        return float(seconds), float(rss), np.load(path)
+
+    print(f"{WIDTH}x{HEIGHT} photo, {available} cores available")
+    print(f"{'mode':>8} {'cores':>6} {'seconds':>8} {'speedup':>8} {'peak RSS +MB':>13}  output")
+    for cores in counts:
+        untiled, rss, expected = child("untiled", cores)
+        print(f"{'untiled':>8} {cores:>6} {untiled:8.2f} {1:8.2f} {rss:13.0f}  reference")
+        seconds, rss, out = child("tiled", cores)
+        diff = np.abs(out.astype(np.int16) - expected).max(axis=2)
+        match = "matches" if not diff.any() else f"{np.count_nonzero(diff)} px differ, by up to {diff.max()}"
+        print(f"{'tiled':>8} {cores:>6} {seconds:8.2f} {untiled / seconds:8.2f} {rss:13.0f}  {match}")
@@ -0,0 +1,61 @@
+"""
+Text bounding-box memory benchmark.
+
+Measures the 15 text layers of a 1920x1080 banner 50 times, the way a
+compliance pass does, in two modes. Each mode runs in its own process so
+the peak RSS figures are comparable:
+  canvas  - old approach: full-canvas Image.new per layer, then draw.textbbox
+  metrics - text_layer_bbox (cached font metrics, no canvas)
+
+Usage (from backend/, uses the .env like the app):
+    python benchmarks/bench_text_metrics_memory.py
+"""
+import os
+import sys
+import time
+import resource
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+WIDTH, HEIGHT = 1920, 1080
+PASSES = 50
+LAYERS = [
+    {"type": "text", "text": f"Banner copy line {i}", "font_size": 24 + i * 4, "x": 60, "y": 40 + i * 65}
+    for i in range(15)
+]
+
+def peak_rss_mb():
+    # ru_maxrss is KB on Linux, bytes on macOS
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+
+def run_mode(mode):
+    from PIL import Image, ImageDraw
+    import main
+
+    for layer in LAYERS:  # warm the font registry so only measuring is compared
+        main.layer_font(layer, 16)
+
+    baseline = peak_rss_mb()
+    start = time.perf_counter()
+    for _ in range(PASSES):
+        for layer in LAYERS:
+            if mode == "canvas":
+                tmp = Image.new("RGB", (WIDTH, HEIGHT), (255, 255, 255))
+                draw = ImageDraw.Draw(tmp)
+                draw.textbbox((layer["x"], layer["y"]), layer["text"], font=main.layer_font(layer, 16))
+            else:
+                main.text_layer_bbox(layer, 16)
+    elapsed = (time.perf_counter() - start) * 1000
+    print(f"{mode:>8}: peak RSS +{peak_rss_mb() - baseline:6.1f} MB, {elapsed / PASSES:7.3f} ms per pass")
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        run_mode(sys.argv[1])
+    else:
+        throwaway = WIDTH * HEIGHT * 3 * len(LAYERS) / (1024 * 1024)
+        print(f"{len(LAYERS)} text layers on {WIDTH}x{HEIGHT}, {PASSES} passes "
+              f"(old approach allocates {throwaway:.0f} MB of canvases per pass)")
+        for mode in ("canvas", "metrics"):
+            subprocess.run([sys.executable, os.path.abspath(__file__), mode], check=True)
@@ -0,0 +1,97 @@
+"""
+Parallel undo/redo stress check.
+
+Makes a chain of edits, records the layer state at every revision, then fires
+undo and redo calls from many threads at once. Afterwards the project's layers
+must equal the recorded state for whatever revision the cursor ended on, and
+every call must have answered 200, 400 (nothing to undo/redo) or 409 (retry).
+
+A second round mixes edits in with the undo/redo calls, so redo branches are
+discarded and revisions rewritten while other threads move the cursor. The
+history is then walked from head back to base: at every revision the layers
+must equal the "after" side of the delta the project points at, i.e. no undo
+reverted a delta that wasn't the one applied.
+
+Usage (from backend/, uses the MONGODB_URI in .env):
+    python benchmarks/bench_undo_concurrency.py
+"""
+import os
+import sys
+import time
+import random
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bson import ObjectId
+from fastapi.testclient import TestClient
+
+import main
+
+EDITS = 30
+CALLS = 400
+THREADS = 16
+
+main.EDITOR_COALESCE_WINDOW = 0  # keep one revision per edit
+client = TestClient(main.app)
+
+project_id = client.post("/editor/create-project").json()["project_id"]
+try:
+    layer_id = client.post(f"/editor/{project_id}/add-text-layer", params={"text": "Headline"}).json()["layer"]["layer_id"]
+
+    states = {0: [], 1: client.get(f"/editor/{project_id}").json()["layers"]}
+    for i in range(EDITS):
+        client.put(f"/editor/{project_id}/update-layer/{layer_id}", json={"x": i * 10})
+        project = client.get(f"/editor/{project_id}").json()
+        states[project["revision"]] = project["layers"]
+
+    # start in the middle so both undo and redo have room
+    for _ in range(EDITS // 2):
+        client.post(f"/editor/{project_id}/undo")
+
+    ops = [random.choice(["undo", "redo"]) for _ in range(CALLS)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=THREADS) as pool:
+        codes = list(pool.map(lambda op: client.post(f"/editor/{project_id}/{op}").status_code, ops))
+    elapsed = time.perf_counter() - start
+
+    project = client.get(f"/editor/{project_id}").json()
+    counts = {code: codes.count(code) for code in set(codes)}
+    print(f"{CALLS} parallel calls on {THREADS} threads in {elapsed:.2f}s, status codes: {counts}")
+    print(f"final revision: {project['revision']}")
+
+    assert set(codes) <= {200, 400, 409}, counts
+    assert project["layers"] == states[project["revision"]], "layers do not match the cursor revision"
+    print("OK: layers match the recorded state for the final revision")
+
+    ops = [random.choice(["undo", "redo", "edit", "edit"]) for _ in range(CALLS)]
+    def call(op):
+        if op == "edit":
+            return client.put(f"/editor/{project_id}/update-layer/{layer_id}", json={"x": random.randint(0, 10000)}).status_code
+        return client.post(f"/editor/{project_id}/{op}").status_code
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=THREADS) as pool:
+        codes = list(pool.map(call, ops))
+    elapsed = time.perf_counter() - start
+    counts = {code: codes.count(code) for code in set(codes)}
+    print(f"{CALLS} parallel edits/undos/redos on {THREADS} threads in {elapsed:.2f}s, status codes: {counts}")
+    assert set(codes) <= {200, 400, 409}, counts
+
+    while client.post(f"/editor/{project_id}/redo").status_code == 200:
+        pass
+    steps = 0
+    while True:
+        project = main.db.editor_projects.find_one({"_id": ObjectId(project_id)})
+        if project["revision"] <= project.get("base", 0):
+            break
+        entry = main.db.editor_revisions.find_one(main._revision_filter(project, project["revision"]))
+        assert entry, f"no delta for revision {project['revision']}"
+        layers = main._layers_by_id(project["layers"])
+        for change in entry["delta"].get("changes", []):
+            assert layers.get(change["layer_id"]) == change["after"], f"revision {project['revision']} does not match its delta"
+        assert client.post(f"/editor/{project_id}/undo").status_code == 200
+        steps += 1
+    print(f"OK: {steps} revisions from head to base match the deltas they undo")
+finally:
+    main.db.editor_projects.delete_one({"_id": ObjectId(project_id)})
+    main.db.editor_revisions.delete_many({"project_id": ObjectId(project_id)})
@@ -0,0 +1,85 @@
+"""
+Background-removal model evaluation.
+
+Runs every model in REMBG_MODEL_OPTIONS (or the ones named on the command
+line) and the default REMBG_MODEL over the same images, one single-threaded
+ONNX session each, and prints per model:
+  IoU         - mask IoU against the default model (mean and worst image)
+  alpha diff  - mean absolute alpha difference against the default model
+  p50 ms      - inference latency, so img/s is throughput per core
+  load ms     - session creation (includes the one-off int8 quantization)
+
+Images come from --images DIR (jpg/png/webp, e.g. a sample of catalog
+photos) or, without it, from the synthetic packshots of
+bench_smart_crop_detectors.py.
+
+Usage (from backend/, uses the .env like the app):
+    python benchmarks/eval_segmentation_models.py [--images DIR] [model ...]
+"""
+import os
+import sys
+import time
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+from PIL import Image
+
+import main
+
+SYNTHETIC_IMAGES = 30
+
+def load_images(folder):
+    if folder:
+        names = sorted(n for n in os.listdir(folder) if n.lower().endswith((".jpg", ".jpeg", ".png", ".webp")))
+        return [Image.open(os.path.join(folder, n)).convert("RGB") for n in names]
+    from bench_smart_crop_detectors import packshot
+    return [packshot()[0].convert("RGB") for _ in range(SYNTHETIC_IMAGES)]
+
+def run_model(model, images):
+    pool = main.RembgSessionPool(model, 1)
+    pool.warm_up()
+    masks, times = [], []
+    for image in images:
+        start = time.perf_counter()
+        masks.append(np.asarray(pool.remove(image, only_mask=True).convert("L")))
+        times.append((time.perf_counter() - start) * 1000)
+    return masks, times, pool.stats()["load_ms"][0]
+
+def iou(a, b):
+    a, b = a >= 128, b >= 128
+    union = (a | b).sum()
+    return (a & b).sum() / union if union else 1.0
+
+def row(model, ious, diffs, times, load_ms):
+    p50 = statistics.median(times)
+    print(f"{model:>16} {np.mean(ious):9.4f} {np.min(ious):8.4f} {np.mean(diffs):11.4f} "
+          f"{p50:8.1f} {1000 / p50:11.2f} {load_ms:8.0f}")
+
+if __name__ == "__main__":
+    args, folder = sys.argv[1:], None
+    if "--images" in args:
+        i = args.index("--images")
+        folder, args = args[i + 1], args[:i] + args[i + 2:]
+    models = args or main.REMBG_MODEL_OPTIONS
+    main.REMBG_INTRA_OP_THREADS = 1  # one core per session: latency -> throughput per core
+    main.REMBG_INTER_OP_THREADS = 1
+
+    images = load_images(folder)
+    print(f"{len(images)} images, reference model {main.REMBG_MODEL}, 1 ONNX thread per session")
+    reference, ref_times, ref_load = run_model(main.REMBG_MODEL, images)
+
+    print(f"{'model':>16} {'IoU mean':>9} {'IoU min':>8} {'alpha diff':>11} {'p50 ms':>8} {'img/s/core':>11} {'load ms':>8}")
+    row(main.REMBG_MODEL, [1.0], [0.0], ref_times, ref_load)
+    for model in models:
+        if model == main.REMBG_MODEL:
+            continue
+        try:
+            masks, times, load_ms = run_model(model, images)
+        except Exception as e:
+            print(f"{model:>16} failed to load: {e}")
+            continue
+        ious = [iou(m, r) for m, r in zip(masks, reference)]
+        diffs = [np.abs(m.astype(np.float32) - r).mean() / 255 for m, r in zip(masks, reference)]
+        row(model, ious, diffs, times, load_ms)
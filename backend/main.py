@@ -1,24 +1,38 @@
 import os
 import io
 from dotenv import load_dotenv
-from fastapi import FastAPI, UploadFile, File, HTTPException
+from fastapi import FastAPI, UploadFile, File, HTTPException, Header, Response
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import StreamingResponse
-from pymongo import MongoClient
+from pymongo import MongoClient, ReturnDocument
+from pymongo.errors import DuplicateKeyError
 from bson import ObjectId
 import gridfs
 from PIL import Image, ImageEnhance
 from rembg import remove
 from bson import ObjectId
 from bson.errors import InvalidId
-from PIL import ImageDraw, ImageFont, ImageStat, ImageOps
+from PIL import ImageDraw, ImageFont, ImageOps
 import numpy as np
-from pydantic import BaseModel
-from typing import List, Optional, Union, Dict
+from pydantic import BaseModel, ConfigDict, ValidationError, field_validator, model_validator
+from typing import List, Optional, Union, Dict, Literal
 import math
+import time
+import json
+import hashlib
+import functools
 import cv2
 import zipfile
-from datetime import datetime
+import threading
+import bisect
+import heapq
+import queue
+import statistics
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
+from collections import OrderedDict, defaultdict, deque
+from dataclasses import dataclass
+from datetime import datetime, timedelta
 import PyPDF2
 import docx 
 import requests
@@ -48,6 +62,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag", "X-Preview-Id", "X-Preview-Scale", "X-Bbox", "X-Detector"],
 )
 
 # MongoDB + GridFS
@@ -87,31 +102,343 @@ def pil_to_bytes(img: Image.Image):
     buf.seek(0)
     return buf
 
+# --- Previews -------------------------------------------------------------------
+# /enhance, /smart-enhance, /crop and /smart-crop take `preview=true` for the
+# enhance page's sliders: the same pipeline runs on a proxy of the source no
+# larger than PREVIEW_MAX_SIDE (JPEGs are decoded straight at reduced scale)
+# and the PNG comes back in the response - nothing is written to GridFS or
+# processed/. The operation and its parameters are kept in the previews
+# collection for PREVIEW_TTL_SECONDS under the X-Preview-Id header, and
+# POST /preview/{id}/commit renders and stores the full-resolution result.
+# A commit claims its preview for PREVIEW_COMMIT_TIMEOUT seconds; a claim left
+# by a process that died mid-render is free again after that.
+PREVIEW_MAX_SIDE = int(os.getenv("PREVIEW_MAX_SIDE", "1024"))
+PREVIEW_TTL_SECONDS = int(os.getenv("PREVIEW_TTL_SECONDS", "3600"))
+PREVIEW_COMMIT_TIMEOUT = int(os.getenv("PREVIEW_COMMIT_TIMEOUT", "300"))
+
+@app.on_event("startup")
+def ensure_preview_indexes():
+    db.previews.create_index("created_at", expireAfterSeconds=PREVIEW_TTL_SECONDS)
+
+def open_source_image(data: bytes, preview: bool = False):
+    """(decoded image, its scale vs. the stored file); previews are reduced to PREVIEW_MAX_SIDE."""
+    img = Image.open(io.BytesIO(data))
+    if not preview:
+        return img, 1.0
+    full_width = img.width
+    img.draft(img.mode, (PREVIEW_MAX_SIDE, PREVIEW_MAX_SIDE))  # JPEG: decode at 1/2..1/8 scale
+    img.thumbnail((PREVIEW_MAX_SIDE, PREVIEW_MAX_SIDE))
+    return img, img.width / full_width
+
+def preview_response(operation: str, file_id: str, params: dict, img: Image.Image, scale: float, headers: dict = None):
+    """The rendered proxy as a PNG response, recorded so it can be committed at full size."""
+    preview_id = db.previews.insert_one({
+        "operation": operation,
+        "file_id": file_id,
+        "params": params,
+        "created_at": datetime.utcnow(),
+    }).inserted_id
+    buf = io.BytesIO()
+    img.save(buf, format="PNG", compress_level=1)  # screen-sized: favour speed over size
+    return Response(content=buf.getvalue(), media_type="image/png", headers={
+        "X-Preview-Id": str(preview_id),
+        "X-Preview-Scale": f"{scale:.4f}",
+        "Cache-Control": "no-store",
+        **(headers or {}),
+    })
+
+@app.post("/preview/{preview_id}/commit")
+def commit_preview(preview_id: str):
+    """Render a previewed operation at full resolution and store it; repeat calls return the same file."""
+    try:
+        preview_oid = ObjectId(preview_id)
+    except InvalidId:
+        raise HTTPException(status_code=404, detail="Preview not found or expired")
+    # claim the preview, so concurrent commits don't both render it
+    now = datetime.utcnow()
+    doc = db.previews.find_one_and_update(
+        {"_id": preview_oid, "result": {"$exists": False},
+         "$or": [{"committing_at": {"$exists": False}},
+                 {"committing_at": {"$lt": now - timedelta(seconds=PREVIEW_COMMIT_TIMEOUT)}}]},
+        {"$set": {"committing_at": now}},
+    )
+    if not doc:
+        doc = db.previews.find_one({"_id": preview_oid})
+        if not doc:
+            raise HTTPException(status_code=404, detail="Preview not found or expired")
+        if doc.get("result"):
+            return doc["result"]
+        raise HTTPException(status_code=409, detail="Preview is already being committed, please retry")
+
+    render = {
+        "enhance": enhance_image_by_id,
+        "smart-enhance": smart_enhance,
+        "crop": crop_image,
+        "smart-crop": smart_crop,
+    }[doc["operation"]]
+    claim = {"_id": preview_oid, "committing_at": now}
+    try:
+        result = render(doc["file_id"], **doc["params"])
+    except Exception:
+        db.previews.update_one(claim, {"$unset": {"committing_at": ""}})  # let it be retried
+        raise
+    # the first commit to finish wins (a slow one may have had its claim taken over)
+    if not db.previews.update_one({"_id": preview_oid, "result": {"$exists": False}},
+                                  {"$set": {"result": result}, "$unset": {"committing_at": ""}}).matched_count:
+        stored = db.previews.find_one({"_id": preview_oid})
+        return stored["result"] if stored and stored.get("result") else result
+    return result
+
+# --- Derived assets -------------------------------------------------------------
+# Calling an operation again on the same file with the same parameters used to
+# store another identical file and redo the work. Every stored result is now
+# recorded in the derivations collection under (source content hash,
+# operation, canonical params, version), and a repeat call returns the recorded
+# response (with "cached": true) as long as its files still exist. force=true
+# recomputes and replaces the record. Bump an operation's DERIVATION_VERSIONS
+# entry when its output changes; settings that change an output are part of
+# its version.
+DERIVATION_VERSIONS = {
+    "remove-bg": 1,
+    "enhance": 1,
+    "crop": 1,
+    "smart-enhance": 1,
+    "smart-crop": 1,
+    "auto-resize": 1,
+}
+
+@app.on_event("startup")
+def ensure_derivation_indexes():
+    db.derivations.create_index(
+        [("source_hash", 1), ("operation", 1), ("params", 1), ("version", 1)],
+        unique=True,
+    )
+
+def derivation_version(operation: str) -> str:
+    version = f"v{DERIVATION_VERSIONS[operation]}"
+    if operation in ("remove-bg", "smart-crop"):
+        version += f"/proxy{SEGMENT_PROXY_SIZE}"  # the subject mask's resolution
+    if operation == "smart-crop":
+        version += f"/min-confidence{SMART_CROP_MIN_CONFIDENCE}"  # when fast detectors fall back to rembg
+    return version
+
+def derivation_key(source_bytes: bytes, operation: str, params: dict) -> dict:
+    return {
+        "source_hash": hashlib.sha256(source_bytes).hexdigest(),
+        "operation": operation,
+        "params": json.dumps(params, sort_keys=True, separators=(",", ":")),
+        "version": derivation_version(operation),
+    }
+
+def find_derivation(key: dict):
+    """The recorded response for `key`, or None when there is none or its files were deleted."""
+    doc = db.derivations.find_one(key)
+    if doc and all(fs.exists(ObjectId(file_id)) for file_id in doc["file_ids"]):
+        return {**doc["result"], "cached": True}
+    return None
+
+def record_derivation(key: dict, result: dict, file_ids: list) -> dict:
+    db.derivations.update_one(key, {"$set": {
+        "result": result,
+        "file_ids": file_ids,
+        "created_at": datetime.utcnow(),
+    }}, upsert=True)
+    return result
+
+# --- Background-removal sessions ---------------------------------------------
+# rembg's remove() without a session may build a new ONNX session (and reload
+# the model) per call. A small pool of sessions is created once, with explicit
+# ONNX Runtime thread settings, and warmed at startup in the background; calls
+# borrow a session from the pool. REMBG_INTRA_OP_THREADS=0 leaves the choice
+# to ONNX Runtime.
+#
+# REMBG_MODEL is the default model. A request may pick one of
+# REMBG_MODEL_OPTIONS with `model=` instead (e.g. a cheaper one for
+# thumbnails); each model gets its own pool on first use. "<model>-int8" is a
+# u2net-family model with int8 weights: quantized next to the downloaded model
+# the first time it loads, then run through rembg's u2net_custom session.
+REMBG_MODEL = os.getenv("REMBG_MODEL", "u2net")
+REMBG_MODEL_OPTIONS = [m.strip() for m in os.getenv("REMBG_MODEL_OPTIONS", "u2netp,u2net-int8").split(",") if m.strip()]
+REMBG_SESSIONS = int(os.getenv("REMBG_SESSIONS", "1"))
+REMBG_INTRA_OP_THREADS = int(os.getenv("REMBG_INTRA_OP_THREADS", "0"))
+REMBG_INTER_OP_THREADS = int(os.getenv("REMBG_INTER_OP_THREADS", "1"))
+REMBG_PRELOAD = os.getenv("REMBG_PRELOAD", "1") == "1"
+QUANTIZABLE_REMBG_MODELS = ("u2net", "u2netp", "u2net_human_seg", "silueta")  # same I/O as u2net_custom
+
+def _quantized_model_path(base):
+    """Path of an int8 copy of rembg model `base`, quantized from the downloaded model on first use."""
+    from rembg.sessions import sessions_class
+    if base not in QUANTIZABLE_REMBG_MODELS:
+        raise ValueError(f"No int8 variant for rembg model '{base}'")
+    source = next(c for c in sessions_class if c.name() == base).download_models()
+    target = os.path.join(os.path.dirname(source), f"{base}-int8.onnx")
+    if not os.path.exists(target):
+        from onnxruntime.quantization import QuantType, quantize_dynamic  # needs the onnx package
+        partial = f"{target}.{os.getpid()}.{threading.get_ident()}.tmp"
+        quantize_dynamic(source, partial, weight_type=QuantType.QUInt8)
+        os.replace(partial, target)
+    return target
+
+class RembgSessionPool:
+    def __init__(self, model_name, size):
+        self.model_name = model_name
+        self.size = max(1, size)
+        self.idle = queue.Queue()
+        self.created = 0
+        self.load_ms = []
+        self.latencies_ms = deque(maxlen=1000)
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def _create(self):
+        import onnxruntime as ort
+        from rembg.sessions import sessions_class
+        start = time.perf_counter()
+        model_name, model_kwargs = self.model_name, {}
+        if model_name.endswith("-int8"):
+            model_kwargs["model_path"] = _quantized_model_path(model_name[:-len("-int8")])
+            model_name = "u2net_custom"
+        session_class = next((c for c in sessions_class if c.name() == model_name), None)
+        if session_class is None:
+            raise ValueError(f"Unknown rembg model '{self.model_name}'")
+        opts = ort.SessionOptions()
+        opts.intra_op_num_threads = REMBG_INTRA_OP_THREADS
+        opts.inter_op_num_threads = REMBG_INTER_OP_THREADS
+        session = session_class(model_name, opts, **model_kwargs)  # downloads the model on first use
+        with self.lock:
+            self.load_ms.append((time.perf_counter() - start) * 1000)
+        return session
+
+    def _acquire(self):
+        while True:
+            try:
+                return self.idle.get_nowait()
+            except queue.Empty:
+                pass
+            with self.lock:
+                grow = self.created < self.size
+                if grow:
+                    self.created += 1
+            if grow:
+                break
+            try:
+                # wait for a session to be returned; re-check now and then in
+                # case a concurrent _create() failed and freed its slot
+                return self.idle.get(timeout=1)
+            except queue.Empty:
+                pass
+        try:
+            return self._create()
+        except Exception:
+            with self.lock:
+                self.created -= 1
+            raise
+
+    def remove(self, image, **kwargs):
+        """rembg.remove() on a pooled session; kwargs are passed through."""
+        session = self._acquire()
+        try:
+            start = time.perf_counter()
+            result = remove(image, session=session, **kwargs)
+            with self.lock:
+                self.calls += 1
+                self.latencies_ms.append((time.perf_counter() - start) * 1000)
+            return result
+        finally:
+            self.idle.put(session)
+
+    def warm_up(self):
+        """Create every session and run one small inference on each."""
+        sessions = []
+        try:
+            # acquired one by one, so a failed load returns the ones before it
+            for _ in range(self.size):
+                sessions.append(self._acquire())
+            probe = Image.new("RGB", (64, 64), (128, 128, 128))
+            for session in sessions:
+                remove(probe, session=session)
+        finally:
+            for session in sessions:
+                self.idle.put(session)
+
+    def stats(self):
+        with self.lock:
+            latencies = sorted(self.latencies_ms)
+            return {
+                "model": self.model_name,
+                "sessions": self.created,
+                "max_sessions": self.size,
+                "idle": self.idle.qsize(),
+                "intra_op_threads": REMBG_INTRA_OP_THREADS,
+                "inter_op_threads": REMBG_INTER_OP_THREADS,
+                "load_ms": [round(ms, 1) for ms in self.load_ms],
+                "calls": self.calls,
+                "p50_ms": round(statistics.median(latencies), 1) if latencies else None,
+                "p95_ms": round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))], 1) if latencies else None,
+            }
+
+rembg_sessions = RembgSessionPool(REMBG_MODEL, REMBG_SESSIONS)
+rembg_pools = {REMBG_MODEL: rembg_sessions}
+rembg_pools_lock = threading.Lock()
+
+def rembg_pool(model: str = None) -> RembgSessionPool:
+    """Session pool for `model` (default REMBG_MODEL); other models must be in REMBG_MODEL_OPTIONS."""
+    model = model or REMBG_MODEL
+    with rembg_pools_lock:
+        if model not in rembg_pools:
+            if model not in REMBG_MODEL_OPTIONS:
+                raise ValueError(f"Unknown rembg model '{model}'")
+            rembg_pools[model] = RembgSessionPool(model, REMBG_SESSIONS)
+        return rembg_pools[model]
+
+def _warm_rembg_sessions():
+    try:
+        rembg_sessions.warm_up()
+        print(f"[rembg] {rembg_sessions.created} '{REMBG_MODEL}' session(s) ready, load ms: {rembg_sessions.stats()['load_ms']}")
+    except Exception as e:
+        print(f"[rembg] warm-up failed, sessions will load on first use: {e}")
+
+@app.on_event("startup")
+def preload_rembg_sessions():
+    if REMBG_PRELOAD:
+        # background thread: the model may need downloading, don't hold up startup
+        threading.Thread(target=_warm_rembg_sessions, name="rembg-warm-up", daemon=True).start()
+
+@app.get("/background-removal/stats")
+def background_removal_stats():
+    with rembg_pools_lock:
+        pools = list(rembg_pools.values())
+    return {
+        "status": "success",
+        "default_model": REMBG_MODEL,
+        "model_options": REMBG_MODEL_OPTIONS,
+        "sessions": {pool.model_name: pool.stats() for pool in pools},
+        "masks": subject_mask_stats(),
+    }
+
 # Smart background removal — uses rembg (high quality) with GrabCut fallback
-def smart_remove_background(image: Image.Image) -> Image.Image:
-    """Remove background using rembg (AI), falling back to OpenCV GrabCut."""
+def resolve_rembg_model(model: str = None) -> str:
+    """The requested rembg model (REMBG_MODEL when omitted); 400 for one that isn't offered."""
+    model = model or REMBG_MODEL
+    if model != REMBG_MODEL and model not in REMBG_MODEL_OPTIONS:
+        raise HTTPException(status_code=400, detail=f"Unknown model '{model}'")
+    return model
+
+def smart_remove_background(image: Image.Image, source_bytes: bytes = None, model: str = REMBG_MODEL):
+    """Remove background using rembg (AI), falling back to OpenCV GrabCut.
+
+    Returns (image, method) with method "rembg", "grabcut" or "none" (the
+    input unchanged), so callers can tell a fallback from the real result.
+    """
     try:
-        from rembg import remove as rembg_remove
-        return rembg_remove(image)
+        return subject_cutout(image, subject_mask(image, source_bytes, model)), "rembg"
     except Exception as e:
         print(f"[rembg] AI removal failed, using GrabCut fallback: {e}")
         try:
-            img_cv = cv2.cvtColor(np.array(image.convert("RGB")), cv2.COLOR_RGB2BGR)
-            mask = np.zeros(img_cv.shape[:2], np.uint8)
-            bgd_model = np.zeros((1, 65), np.float64)
-            fgd_model = np.zeros((1, 65), np.float64)
-            h, w = img_cv.shape[:2]
-            rect = (int(w*0.05), int(h*0.05), int(w*0.9), int(h*0.9))
-            cv2.grabCut(img_cv, mask, rect, bgd_model, fgd_model, 5, cv2.GC_INIT_WITH_RECT)
-            mask2 = np.where((mask == 2) | (mask == 0), 0, 255).astype('uint8')
-            result = image.convert("RGBA")
-            r, g, b, a = result.split()
-            alpha = Image.fromarray(mask2)
-            result.putalpha(alpha)
-            return result
+            return subject_cutout(image.convert("RGBA"), grabcut_mask(image)), "grabcut"
         except Exception as e2:
             print(f"[GrabCut] Fallback also failed: {e2}")
-            return image
+            return image, "none"
 
 #AI Creative Builder Endpoints
 # 1. UPLOAD ASSET (store in GridFS + save to /tmp)
@@ -138,12 +465,18 @@ async def upload_asset(file: UploadFile = File(...)):
 
 # 2. REMOVE BACKGROUND — using EXISTING UPLOADED FILE (file_id)
 @app.get("/remove-bg/{file_id}")
-def remove_background_by_id(file_id: str):
+def remove_background_by_id(file_id: str, model: str = None, force: bool = False):   # model: REMBG_MODEL or one of REMBG_MODEL_OPTIONS
     try:
-        file_obj = fs.get(ObjectId(file_id))
-        image = Image.open(io.BytesIO(file_obj.read())).convert("RGBA")
+        model = resolve_rembg_model(model)
 
-        output = smart_remove_background(image)
+        data = fs.get(ObjectId(file_id)).read()
+        memo = derivation_key(data, "remove-bg", {"model": model})
+        cached = None if force else find_derivation(memo)
+        if cached:
+            return cached
+        image = Image.open(io.BytesIO(data)).convert("RGBA")
+
+        output, method = smart_remove_background(image, data, model)
 
         # save processed image to bytes
         buffer = pil_to_bytes(output)
@@ -153,31 +486,50 @@ def remove_background_by_id(file_id: str):
         processed_path = f"processed/{new_file_id}.png"
         output.save(processed_path)
 
-        return {
+        result = {
             "status": "success",
             "operation": "background_removed",
+            "method": method,
             "new_file_id": str(new_file_id)
         }
+        # a fallback is only what a transient rembg failure left us: don't memoize it
+        return record_derivation(memo, result, [str(new_file_id)]) if method == "rembg" else result
 
+    except HTTPException as he:
+        raise he
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Background removal failed: {str(e)}")
 
 # 3. ENHANCE IMAGE — using EXISTING UPLOADED FILE (file_id)
+def render_enhance(img: Image.Image, sharpness: float = 1.2, contrast: float = 1.15, brightness: float = 1.1) -> Image.Image:
+    img = ImageEnhance.Sharpness(img).enhance(sharpness)
+    img = ImageEnhance.Contrast(img).enhance(contrast)
+    return ImageEnhance.Brightness(img).enhance(brightness)
+
 @app.get("/enhance/{file_id}")
 def enhance_image_by_id(
     file_id: str,
     sharpness: float = 1.2,
     contrast: float = 1.15,
-    brightness: float = 1.1
+    brightness: float = 1.1,
+    preview: bool = False,
+    force: bool = False        # recompute even if this exact result is stored
 ):
     try:
-        file_obj = fs.get(ObjectId(file_id))
-        img = Image.open(io.BytesIO(file_obj.read()))
+        data = fs.get(ObjectId(file_id)).read()
+        params = {"sharpness": sharpness, "contrast": contrast, "brightness": brightness}
+        if not preview:
+            memo = derivation_key(data, "enhance", params)
+            cached = None if force else find_derivation(memo)
+            if cached:
+                return cached
+        img, scale = open_source_image(data, preview)
 
         # apply enhancements
-        img = ImageEnhance.Sharpness(img).enhance(sharpness)
-        img = ImageEnhance.Contrast(img).enhance(contrast)
-        img = ImageEnhance.Brightness(img).enhance(brightness)
+        img = render_enhance(img, sharpness, contrast, brightness)
+
+        if preview:
+            return preview_response("enhance", file_id, params, img, scale)
 
         buffer = pil_to_bytes(img)
         new_file_id = fs.put(buffer.getvalue(), filename=f"{file_id}_enhanced.png", content_type="image/png")
@@ -186,11 +538,11 @@ def enhance_image_by_id(
         processed_path = f"processed/{new_file_id}.png"
         img.save(processed_path)
 
-        return {
+        return record_derivation(memo, {
             "status": "success",
             "operation": "enhanced",
             "new_file_id": str(new_file_id)
-        }
+        }, [str(new_file_id)])
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Enhancement failed: {str(e)}")
@@ -214,34 +566,45 @@ def delete_asset(file_id: str):
         raise HTTPException(status_code=404, detail="Cannot delete file")
     
 # 6. Crop Asset
+def render_crop(img: Image.Image, mode: str = "square") -> Image.Image:
+    # Crop logic based on mode
+    width, height = img.size
+    if mode == "square":
+        size = min(width, height)
+        img = ImageOps.fit(img, (size, size), Image.LANCZOS)
+    elif mode == "portrait":
+        # 4:5 ratio
+        target_width = int(height * 4 / 5)
+        img = ImageOps.fit(img, (target_width, height), Image.LANCZOS)
+    elif mode == "landscape":
+        # 16:9 ratio
+        target_height = int(width * 9 / 16)
+        img = ImageOps.fit(img, (width, target_height), Image.LANCZOS)
+    return img
+
 @app.get("/crop/{file_id}")
-def crop_image(file_id: str, mode: str = "square"):
+def crop_image(file_id: str, mode: str = "square", preview: bool = False, force: bool = False):
     try:
-        file_obj = fs.get(ObjectId(file_id))
-        img = Image.open(io.BytesIO(file_obj.read()))
-        
-        # Crop logic based on mode
-        width, height = img.size
-        if mode == "square":
-            size = min(width, height)
-            img = ImageOps.fit(img, (size, size), Image.LANCZOS)
-        elif mode == "portrait":
-            # 4:5 ratio
-            target_width = int(height * 4 / 5)
-            img = ImageOps.fit(img, (target_width, height), Image.LANCZOS)
-        elif mode == "landscape":
-            # 16:9 ratio
-            target_height = int(width * 9 / 16)
-            img = ImageOps.fit(img, (width, target_height), Image.LANCZOS)
+        data = fs.get(ObjectId(file_id)).read()
+        if not preview:
+            memo = derivation_key(data, "crop", {"mode": mode})
+            cached = None if force else find_derivation(memo)
+            if cached:
+                return cached
+        img, scale = open_source_image(data, preview)
+        img = render_crop(img, mode)
+
+        if preview:
+            return preview_response("crop", file_id, {"mode": mode}, img, scale)
         
         buffer = pil_to_bytes(img)
         new_file_id = fs.put(buffer.getvalue(), filename=f"{file_id}_cropped_{mode}.png", content_type="image/png")
         
-        return {
+        return record_derivation(memo, {
             "status": "success",
             "operation": f"cropped_{mode}",
             "new_file_id": str(new_file_id)
-        }
+        }, [str(new_file_id)])
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Crop failed: {str(e)}")
     
@@ -275,21 +638,208 @@ def list_all_assets():
         raise HTTPException(status_code=500, detail=f"Failed to list assets: {str(e)}")
     
 #  DRAG-AND-DROP EDITOR 
-def snapshot_project(project_id):
-    project = db.editor_projects.find_one({"_id": ObjectId(project_id)})
-    if not project:
-        return
+# Undo/redo history lives in the editor_revisions collection, one per-edit layer
+# delta per (project_id, revision). The project only holds a cursor:
+#   revision - revision the current layers correspond to
+#   head     - newest revision that can be redone to
+#   base     - oldest revision we can undo back to (older deltas are pruned)
+#   version  - bumped on every layer write, used for optimistic concurrency
+#   revision_tags - revision -> tag of its delta document
+# A delta document is written under a fresh tag before the cursor moves to it,
+# and undo/redo only read the document the project's revision_tags points at.
+# A stale delta left behind by a discarded redo branch, or by an edit that lost
+# the race or crashed before moving the cursor, is never read; it is deleted
+# afterwards or pruned with the old history.
+# Edits sharing a coalesce key (e.g. drag steps on one layer) that land within
+# EDITOR_COALESCE_WINDOW seconds are folded into the previous revision.
+EDITOR_HISTORY_DEPTH = int(os.getenv("EDITOR_HISTORY_DEPTH", "100"))
+EDITOR_COALESCE_WINDOW = float(os.getenv("EDITOR_COALESCE_WINDOW", "1.0"))
+EDITOR_WRITE_RETRIES = 5
+
+def _layers_by_id(layers):
+    """Index layers by layer_id; returns None if any id is missing or duplicated."""
+    by_id = {}
+    for layer in layers:
+        layer_id = layer.get("layer_id")
+        if not layer_id or layer_id in by_id:
+            return None
+        by_id[layer_id] = layer
+    return by_id
+
+def _natural_order(order, removed, added):
+    # order we get by dropping removed ids and appending added ones
+    return [k for k in order if k not in removed] + added
+
+def diff_layers(before, after):
+    """Build a delta that turns `before` into `after` (apply reversed to undo)."""
+    old = _layers_by_id(before)
+    new = _layers_by_id(after)
+    if old is None or new is None:
+        # layers without stable ids: fall back to storing both arrays
+        return {"layers_before": before, "layers_after": after}
+
+    changes = []
+    for layer_id in list(old) + [k for k in new if k not in old]:
+        if old.get(layer_id) != new.get(layer_id):
+            changes.append({"layer_id": layer_id, "before": old.get(layer_id), "after": new.get(layer_id)})
+
+    delta = {"changes": changes}
+    removed = [k for k in old if k not in new]
+    added = [k for k in new if k not in old]
+    # only store orderings when a plain remove/append would not reproduce them
+    if _natural_order(list(old), removed, added) != list(new):
+        delta["order_after"] = list(new)
+    if _natural_order(list(new), added, removed) != list(old):
+        delta["order_before"] = list(old)
+    return delta
+
+def apply_layer_delta(layers, delta, reverse=False):
+    """Apply a delta from diff_layers to a layer list (reverse=True undoes it)."""
+    if "changes" not in delta:
+        return delta["layers_before"] if reverse else delta["layers_after"]
+
+    side = "before" if reverse else "after"
+    by_id = {l.get("layer_id"): l for l in layers}
+    for change in delta["changes"]:
+        value = change[side]
+        if value is None:
+            by_id.pop(change["layer_id"], None)
+        else:
+            by_id[change["layer_id"]] = value
 
-    # remove _id so MongoDB does not complain when restoring
-    project_copy = {k: v for k, v in project.items() if k != "_id"}
+    order = delta.get("order_before" if reverse else "order_after")
+    if order is None:
+        return list(by_id.values())
+    return [by_id[k] for k in order if k in by_id]
 
-    db.editor_projects.update_one(
+def load_project_state(project_id):
+    project = db.editor_projects.find_one(
         {"_id": ObjectId(project_id)},
-        {
-            "$push": {"history": project_copy},
-            "$set": {"future": []}  # clear redo stack
-        }
+        {"layers": 1, "revision": 1, "head": 1, "base": 1, "version": 1, "last_edit": 1, "revision_tags": 1}
     )
+    if not project:
+        raise HTTPException(status_code=404, detail="Project not found")
+    return project
+
+def _unchanged_since(project):
+    # filter matching the project only if no other write landed since it was read
+    return {"_id": project["_id"], "version": project.get("version", 0) or {"$in": [0, None]}}
+
+def _revision_filter(project, revision):
+    """Filter for the delta document the project's cursor uses for `revision`."""
+    tag = (project.get("revision_tags") or {}).get(str(revision))
+    # revisions written before tagging have a single untagged document
+    return {"project_id": project["_id"], "revision": revision, "tag": tag if tag else {"$exists": False}}
+
+def _coalescable_revision(project, coalesce_key, now):
+    """Return the head revision entry if this edit can be folded into it."""
+    last_edit = project.get("last_edit") or {}
+    revision = project.get("revision", 0)
+    if not coalesce_key or last_edit.get("key") != coalesce_key:
+        return None
+    if now - last_edit.get("at", 0) > EDITOR_COALESCE_WINDOW:
+        return None
+    if revision != project.get("head", 0) or revision <= project.get("base", 0):
+        return None  # an undo happened since, or the revision was pruned
+    return db.editor_revisions.find_one(_revision_filter(project, revision))
+
+def edit_layers(project_id, change, coalesce_key=None):
+    """Apply `change(layers) -> new_layers` as a new undoable revision.
+
+    Retries on concurrent writes so parallel edits are never lost. Pass a
+    coalesce_key to merge repeated edits (drag/resize steps) into one revision.
+    """
+    for _ in range(EDITOR_WRITE_RETRIES):
+        project = load_project_state(project_id)
+        before = project.get("layers", [])
+        after = change(before)
+        now = time.time()
+
+        entry = _coalescable_revision(project, coalesce_key, now)
+        if entry:
+            revision = entry["revision"]
+            delta = diff_layers(apply_layer_delta(before, entry["delta"], reverse=True), after)
+        else:
+            revision = project.get("revision", 0) + 1
+            delta = diff_layers(before, after)
+        base = max(project.get("base", 0), revision - EDITOR_HISTORY_DEPTH)
+        updated_at = datetime.utcnow().isoformat()
+        version = project.get("version", 0) or 0
+
+        # write the delta first: the cursor must never point at a revision
+        # whose document isn't there yet
+        tag = str(ObjectId())
+        db.editor_revisions.insert_one({
+            "project_id": project["_id"], "revision": revision, "tag": tag,
+            "version": version, "delta": delta, "at": updated_at,
+        })
+
+        # tags of the discarded redo branch and of revisions pruned past the depth limit
+        dropped = set(range(revision + 1, project.get("head", 0) + 1)) | set(range(project.get("base", 0) + 1, base + 1))
+        result = db.editor_projects.update_one(
+            _unchanged_since(project),
+            {
+                "$set": {
+                    "layers": after, "revision": revision, "head": revision, "base": base,
+                    "last_edit": {"key": coalesce_key, "at": now}, "updated_at": updated_at,
+                    f"revision_tags.{revision}": tag,
+                },
+                "$inc": {"version": 1},
+                "$unset": {"history": "", "future": "",  # legacy inline history
+                           **{f"revision_tags.{r}": "" for r in dropped}},
+            }
+        )
+        if not result.matched_count:
+            db.editor_revisions.delete_one({"project_id": project["_id"], "tag": tag})  # lost the race
+            continue
+
+        # drop what the cursor can no longer reach: deltas for this revision or
+        # later built before this edit (the replaced/discarded ones, lost races)
+        # and anything older than the depth limit. Deltas of edits that landed
+        # after this one were built against a newer version and stay.
+        db.editor_revisions.delete_many({
+            "project_id": project["_id"],
+            "$or": [
+                {"revision": {"$gte": revision}, "tag": {"$ne": tag},
+                 "$or": [{"version": {"$lte": version}}, {"version": {"$exists": False}}]},
+                {"revision": {"$lte": base}},
+            ]
+        })
+        return after
+
+    raise HTTPException(409, "Project is being edited concurrently, please retry")
+
+def move_revision_cursor(project_id, step):
+    """Undo (step=-1) or redo (step=+1) with one conditional update on the project."""
+    for _ in range(EDITOR_WRITE_RETRIES):
+        project = load_project_state(project_id)
+        revision = project.get("revision", 0)
+        if step < 0 and revision <= project.get("base", 0):
+            raise HTTPException(400, "Nothing to undo")
+        if step > 0 and revision >= project.get("head", 0):
+            raise HTTPException(400, "Nothing to redo")
+
+        # undoing revision N reverts its delta; redoing to N re-applies it
+        target = revision if step < 0 else revision + 1
+        entry = db.editor_revisions.find_one(_revision_filter(project, target))
+        if not entry:
+            continue  # history moved on since the project was read
+
+        layers = apply_layer_delta(project.get("layers", []), entry["delta"], reverse=step < 0)
+        result = db.editor_projects.update_one(
+            _unchanged_since(project),
+            {"$set": {"layers": layers, "revision": revision + step, "last_edit": None}, "$inc": {"version": 1}}
+        )
+        if result.matched_count:
+            return layers
+
+    raise HTTPException(409, "Project is being edited concurrently, please retry")
+
+@app.on_event("startup")
+def ensure_editor_indexes():
+    if "project_id_1_revision_1" in db.editor_revisions.index_information():
+        db.editor_revisions.drop_index("project_id_1_revision_1")  # one document per revision, before tags
+    db.editor_revisions.create_index([("project_id", 1), ("revision", 1), ("tag", 1)], unique=True)
     
 # 1) CREATE A NEW PROJECT / CANVAS
 @app.post("/editor/create-project")
@@ -306,8 +856,10 @@ def create_project(
         "height": height,
         "background_color": background_color,
         "layers": [],
-        "history": [],
-        "future": [],
+        "revision": 0,
+        "head": 0,
+        "base": 0,
+        "version": 0,
         "created_at": now,
         "updated_at": now,
     }
@@ -347,8 +899,7 @@ async def add_image_layer(
     opacity: float = 1.0
 ):
 
-    # Take snapshot BEFORE applying changes
-    snapshot_project(project_id)
+    load_project_state(project_id)  # 404 before storing the file
 
     # Save file in GridFS
     file_data = await file.read()
@@ -366,11 +917,8 @@ async def add_image_layer(
         "layer_id": str(ObjectId())
     }
 
-    # Save layer in DB
-    db.editor_projects.update_one(
-        {"_id": ObjectId(project_id)},
-        {"$push": {"layers": layer}}
-    )
+    # Save layer in DB (as an undoable revision)
+    edit_layers(project_id, lambda layers: layers + [layer])
 
     return {
         "status": "success",
@@ -389,9 +937,6 @@ def add_text_layer(
     rotation: float = 0.0
 ):
 
-    # Take snapshot BEFORE applying changes
-    snapshot_project(project_id)
-
     layer = {
         "type": "text",
         "text": text,
@@ -403,10 +948,7 @@ def add_text_layer(
         "layer_id": str(ObjectId())
     }
 
-    db.editor_projects.update_one(
-        {"_id": ObjectId(project_id)},
-        {"$push": {"layers": layer}}
-    )
+    edit_layers(project_id, lambda layers: layers + [layer])
 
     return {
         "status": "success",
@@ -417,12 +959,9 @@ def add_text_layer(
 @app.put("/editor/{project_id}/update-layer/{layer_id}")
 def update_layer(project_id: str, layer_id: str, updates: dict):
 
-    snapshot_project(project_id)  # <-- NEW
-
-    db.editor_projects.update_one(
-        {"_id": ObjectId(project_id), "layers.layer_id": layer_id},
-        {"$set": {f"layers.$.{k}": v for k, v in updates.items()}}
-    )
+    edit_layers(project_id, lambda layers: [
+        {**l, **updates} if l.get("layer_id") == layer_id else l for l in layers
+    ], coalesce_key=f"update:{layer_id}")
     return {"status": "success", "updated": updates}
 
 # 4.5) SET ALL LAYERS (synchronize entire array)
@@ -431,13 +970,82 @@ class SetLayersRequest(BaseModel):
 
 @app.put("/editor/{project_id}/set-layers")
 def set_layers(project_id: str, req: SetLayersRequest):
-    snapshot_project(project_id)
-    db.editor_projects.update_one(
-        {"_id": ObjectId(project_id)},
-        {"$set": {"layers": req.layers}}
-    )
+    edit_layers(project_id, lambda layers: req.layers)
     return {"status": "success"}
 
+# 4.6) BATCH LAYER OPERATIONS (one write, one undo step)
+class LayerOperation(BaseModel):
+    op: str                              # add / update / delete / reorder
+    layer_id: Optional[str] = None
+    layer: Optional[dict] = None         # add: the new layer
+    updates: Optional[dict] = None       # update: fields to change
+    index: Optional[int] = None          # add/reorder: target position (default: top)
+    order: Optional[List[str]] = None    # reorder: full list of layer_ids
+
+class LayerBatchRequest(BaseModel):
+    operations: List[LayerOperation]
+
+def apply_layer_operations(layers, operations):
+    """Apply batch operations in order to a copy of `layers`."""
+    layers = list(layers)
+
+    def position(layer_id):
+        if not layer_id:
+            raise HTTPException(status_code=400, detail="Operation requires a layer_id")
+        for i, l in enumerate(layers):
+            if l.get("layer_id") == layer_id:
+                return i
+        raise HTTPException(status_code=404, detail=f"Layer {layer_id} not found")
+
+    for op in operations:
+        if op.op == "add":
+            index = len(layers) if op.index is None else op.index
+            layers.insert(index, op.layer)
+        elif op.op == "update":
+            i = position(op.layer_id)
+            layers[i] = {**layers[i], **(op.updates or {})}
+        elif op.op == "delete":
+            layers.pop(position(op.layer_id))
+        elif op.op == "reorder" and op.order is not None:
+            by_id = _layers_by_id(layers)
+            if by_id is None:
+                raise HTTPException(status_code=400, detail="Reorder by order needs a unique layer_id on every layer")
+            if sorted(by_id) != sorted(op.order):
+                raise HTTPException(status_code=400, detail="Reorder must list every layer_id exactly once")
+            layers = [by_id[k] for k in op.order]
+        elif op.op == "reorder":
+            layer = layers.pop(position(op.layer_id))
+            layers.insert(len(layers) if op.index is None else op.index, layer)
+        else:
+            raise HTTPException(status_code=400, detail=f"Invalid layer operation: {op.op}")
+    return layers
+
+@app.post("/editor/{project_id}/layers/batch")
+def batch_layer_operations(project_id: str, req: LayerBatchRequest):
+    if not req.operations:
+        raise HTTPException(status_code=400, detail="No operations given")
+
+    for op in req.operations:
+        if op.op == "add":
+            if not op.layer:
+                raise HTTPException(status_code=400, detail="Add operation requires a layer")
+            op.layer = {**op.layer, "layer_id": op.layer.get("layer_id") or str(ObjectId())}
+        elif op.op in ("update", "delete") or (op.op == "reorder" and op.order is None):
+            if not op.layer_id:
+                raise HTTPException(status_code=400, detail=f"{op.op.capitalize()} operation requires a layer_id")
+
+    # update-only batches (drag / resize steps) fold into the previous undo step
+    coalesce_key = None
+    if all(op.op == "update" for op in req.operations):
+        coalesce_key = "update:" + ",".join(sorted({op.layer_id for op in req.operations}))
+
+    layers = edit_layers(
+        project_id,
+        lambda layers: apply_layer_operations(layers, req.operations),
+        coalesce_key=coalesce_key
+    )
+    return {"status": "success", "applied": len(req.operations), "layers": layers}
+
 # 5) GET FULL PROJECT (all layers)
 @app.get("/editor/{project_id}")
 def get_editor_project(project_id: str):
@@ -488,56 +1096,14 @@ def download_rendered_image(file_id: str):
 # 7) UNDO
 @app.post("/editor/{project_id}/undo")
 def undo(project_id: str):
-    project = db.editor_projects.find_one({"_id": ObjectId(project_id)})
-    if not project:
-        raise HTTPException(404, "Project not found")
-
-    history = project.get("history", [])
-    future = project.get("future", [])
-
-    if not history:
-        raise HTTPException(400, "Nothing to undo")
-
-    last_state = history.pop()
-
-    db.editor_projects.update_one(
-        {"_id": ObjectId(project_id)},
-        {
-            "$set": {
-                "layers": last_state,
-                "history": history,   # write full arrays to avoid conflicts
-                "future": future + [project["layers"]],
-            }
-        }
-    )
-    return {"status": "ok", "layers": last_state}
+    layers = move_revision_cursor(project_id, -1)
+    return {"status": "ok", "layers": layers}
 
 # 8) REDO
 @app.post("/editor/{project_id}/redo")
 def redo(project_id: str):
-    project = db.editor_projects.find_one({"_id": ObjectId(project_id)})
-    if not project:
-        raise HTTPException(404, "Project not found")
-
-    future = project.get("future", [])
-    history = project.get("history", [])
-
-    if not future:
-        raise HTTPException(400, "Nothing to redo")
-
-    next_state = future.pop()
-
-    db.editor_projects.update_one(
-        {"_id": ObjectId(project_id)},
-        {
-            "$set": {
-                "layers": next_state,
-                "future": future,    # no $push (avoid conflict)
-                "history": history + [project["layers"]],
-            }
-        }
-    )
-    return {"status": "ok", "layers": next_state}
+    layers = move_revision_cursor(project_id, 1)
+    return {"status": "ok", "layers": layers}
 
 #   AI LAYOUT SUGGESTION ENGINE
 def get_image_focal_point(img: Image.Image):
@@ -774,10 +1340,7 @@ def apply_template_to_project(project_id: str, template_id: str):
         new_layer["layer_id"] = str(ObjectId())  # unique id for project layer
         new_layers.append(new_layer)
 
-    db.editor_projects.update_one(
-        {"_id": ObjectId(project_id)},
-        {"$push": {"layers": {"$each": new_layers}}}
-    )
+    edit_layers(project_id, lambda layers: layers + new_layers)
 
     return {"status": "success", "added_layers": len(new_layers)}
 
@@ -880,16 +1443,80 @@ def hex_to_rgb(hex_color):
     hex_color = hex_color.lstrip("#")
     return tuple(int(hex_color[i:i+2], 16) for i in (0, 2, 4))
 
-def sample_canvas_region(img: Image.Image, bbox):
-    # bbox = (x,y,w,h)
-    x,y,w,h = bbox
-    x = max(0, int(x)); y = max(0, int(y))
-    w = max(1, int(w)); h = max(1, int(h))
-    crop = img.crop((x, y, min(img.width, x+w), min(img.height, y+h)))
-    if crop.width == 0 or crop.height == 0:
-        return (255,255,255)
-    stat = ImageStat.Stat(crop)
-    return tuple(int(v) for v in stat.mean[:3])
+class RegionSampler:
+    """Summed-area tables over a rendered canvas.
+
+    Built once per canvas; the mean colour and luminance spread of any box is
+    then an O(1) lookup, so many candidate text positions can be checked cheaply.
+    """
+
+    def __init__(self, img: Image.Image, origin=(0, 0), canvas_size=None):
+        # `img` may be a crop of a larger canvas placed at `origin`; boxes are
+        # still given (and clipped) in full-canvas coordinates
+        rgb = np.asarray(img.convert("RGB"))
+        self.origin = origin
+        self.canvas_width, self.canvas_height = canvas_size or img.size
+        self.height, self.width = rgb.shape[:2]
+        luma = rgb @ np.array([0.299, 0.587, 0.114])
+
+        # uint32 running sums may wrap, but box differences come out exact (mod 2^32)
+        # as long as no single box can sum past 2^32
+        dtype = np.uint32 if self.width * self.height * 255 < 2 ** 32 else np.uint64
+        self.color_sums = np.zeros((self.height + 1, self.width + 1, 3), dtype=dtype)
+        self.color_sums[1:, 1:] = rgb.cumsum(axis=0, dtype=dtype).cumsum(axis=1, dtype=dtype)
+        self.luma_sums = np.zeros((self.height + 1, self.width + 1, 2), dtype=np.float64)
+        self.luma_sums[1:, 1:, 0] = luma.cumsum(axis=0).cumsum(axis=1)
+        self.luma_sums[1:, 1:, 1] = (luma * luma).cumsum(axis=0).cumsum(axis=1)
+
+    @staticmethod
+    def clip(bbox, canvas_size):
+        # bbox = (x,y,w,h), clipped the same way the old crop-based sampler did
+        x, y, w, h = bbox
+        x = max(0, int(x)); y = max(0, int(y))
+        w = max(1, int(w)); h = max(1, int(h))
+        x1 = min(canvas_size[0], x + w); y1 = min(canvas_size[1], y + h)
+        if x1 <= x or y1 <= y:
+            return None
+        return x, y, x1, y1
+
+    @classmethod
+    def for_box(cls, canvas: Image.Image, bbox):
+        """Sampler over just the part of `canvas` that `bbox` covers."""
+        window = cls.clip(bbox, canvas.size)
+        if window is None:
+            return cls(canvas.crop((0, 0, 1, 1)), canvas_size=canvas.size)
+        return cls(canvas.crop(window), origin=window[:2], canvas_size=canvas.size)
+
+    def _window(self, bbox):
+        window = self.clip(bbox, (self.canvas_width, self.canvas_height))
+        if window is None:
+            return None
+        ox, oy = self.origin
+        return window[0] - ox, window[1] - oy, window[2] - ox, window[3] - oy
+
+    @staticmethod
+    def _box_sum(sums, x0, y0, x1, y1):
+        return sums[y1, x1] - sums[y0, x1] - sums[y1, x0] + sums[y0, x0]
+
+    def mean_color(self, bbox):
+        window = self._window(bbox)
+        if window is None:
+            return (255, 255, 255)
+        x0, y0, x1, y1 = window
+        total = self._box_sum(self.color_sums, x0, y0, x1, y1)
+        area = (x1 - x0) * (y1 - y0)
+        return tuple(int(v) // area for v in total)
+
+    def luminance_std(self, bbox):
+        """Standard deviation of luminance in the box; high values mean a busy background."""
+        window = self._window(bbox)
+        if window is None:
+            return 0.0
+        x0, y0, x1, y1 = window
+        total, total_sq = self._box_sum(self.luma_sums, x0, y0, x1, y1)
+        area = (x1 - x0) * (y1 - y0)
+        mean = total / area
+        return math.sqrt(max(0.0, total_sq / area - mean * mean))
 
 # --- Retailer guideline templates (insert if not present) -----------------
 @app.on_event("startup")
@@ -924,46 +1551,656 @@ def ensure_default_retailer_guidelines():
     db.retailer_guidelines.insert_many(guidelines)
     print("Inserted default retailer guidelines")
 
+# --- Font registry -----------------------------------------------------------
+# Each (family, size) is parsed once per process and text measurements are
+# cached, so renders and compliance passes do no font-file I/O after warm-up.
+# Fonts resolve from FONT_DIR first (<family>.ttf), then the system font paths.
+FONT_DIR = os.getenv("FONT_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "fonts"))
+DEFAULT_FONT_FAMILY = os.getenv("DEFAULT_FONT_FAMILY", "arial")
+TEXT_METRICS_CACHE_SIZE = int(os.getenv("TEXT_METRICS_CACHE_SIZE", "8192"))
+
+@functools.lru_cache(maxsize=256)
+def load_font(size: int, family: str = DEFAULT_FONT_FAMILY):
+    for candidate in (os.path.join(FONT_DIR, f"{family}.ttf"), f"{family}.ttf"):
+        try:
+            return ImageFont.truetype(candidate, size)
+        except OSError:
+            continue
+    print(f"[Fonts] WARNING: '{family}' not found in {FONT_DIR} or system fonts, using Pillow default at {size}px")
+    try:
+        return ImageFont.load_default(size)
+    except TypeError:
+        # Pillow < 10.1 only has the fixed-size bitmap font
+        return ImageFont.load_default()
+
+def layer_font(layer, default_size=24):
+    return load_font(int(layer.get("font_size", default_size)), layer.get("font_family") or DEFAULT_FONT_FAMILY)
+
+@functools.lru_cache(maxsize=TEXT_METRICS_CACHE_SIZE)
+def measure_text(text: str, size: int, family: str = DEFAULT_FONT_FAMILY):
+    """Bounding box of `text` drawn at (0, 0); offset it by the draw position."""
+    draw = ImageDraw.Draw(Image.new("RGB", (1, 1)))
+    return draw.textbbox((0, 0), text, font=load_font(size, family))
+
+def text_layer_bbox(layer, default_size=24):
+    """Canvas-space (x0, y0, x1, y1) of a text layer from cached font metrics."""
+    x, y = int(layer.get("x", 0)), int(layer.get("y", 0))
+    family = layer.get("font_family") or DEFAULT_FONT_FAMILY
+    x0, y0, x1, y1 = measure_text(layer.get("text", ""), int(layer.get("font_size", default_size)), family)
+    return (x + x0, y + y0, x + x1, y + y1)
+
+def font_cache_stats():
+    fonts = load_font.cache_info()
+    metrics = measure_text.cache_info()
+    return {
+        "fonts_loaded": fonts.currsize,
+        "font_hits": fonts.hits,
+        "font_misses": fonts.misses,
+        "metrics_cached": metrics.currsize,
+        "metrics_hits": metrics.hits,
+        "metrics_misses": metrics.misses,
+    }
+
+# --- Prepared layer bitmap cache -------------------------------------------
+# GridFS files never change once written, so a decoded, resized, rotated and
+# faded layer bitmap can be reused by every render of any project using it.
+RENDER_CACHE_BYTES = int(os.getenv("RENDER_CACHE_BYTES", str(256 * 1024 * 1024)))
+
+class LayerBitmapCache:
+    """Thread-safe LRU of prepared RGBA layer bitmaps with a memory budget in bytes."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            img = self.entries.get(key)
+            if img is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return img
+
+    def put(self, key, img):
+        nbytes = img.width * img.height * 4
+        if nbytes > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                return
+            self.entries[key] = img
+            self.size += nbytes
+            while self.size > self.max_bytes:
+                _, old = self.entries.popitem(last=False)
+                self.size -= old.width * old.height * 4
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 3) if total else 0.0,
+            }
+
+layer_bitmap_cache = LayerBitmapCache(RENDER_CACHE_BYTES)
+
+def prepare_image_layer(layer):
+    """Return the layer's bitmap ready to paste (cached), or None if the file is missing."""
+    file_id = layer.get("file_id")
+    width, height = layer.get("width"), layer.get("height")
+    rotation = layer.get("rotation", 0) or 0
+    opacity = layer.get("opacity", 1.0)
+    key = (file_id, width, height, rotation, opacity)
+
+    img = layer_bitmap_cache.get(key)
+    if img is not None:
+        return img
+
+    try:
+        file_obj = fs.get(ObjectId(file_id))
+    except Exception:
+        return None
+    img = Image.open(io.BytesIO(file_obj.read())).convert("RGBA")
+    img = img.resize((int(width or img.width), int(height or img.height)))
+    if rotation:
+        img = img.rotate(rotation, expand=True)
+    if opacity < 1.0:
+        alpha = img.split()[3].point(lambda p: int(p * opacity))
+        img.putalpha(alpha)
+
+    layer_bitmap_cache.put(key, img)
+    return img
+
+
+# --- Layer drawing helpers -------------------------------------------------
+def layer_bbox(layer):
+    """Canvas-space (x0, y0, x1, y1) a layer paints into, or None if it paints nothing."""
+    x, y = int(layer.get("x", 0)), int(layer.get("y", 0))
+    if layer.get("type") == "image":
+        img = prepare_image_layer(layer)
+        return None if img is None else (x, y, x + img.width, y + img.height)
+    if layer.get("type") == "text":
+        return text_layer_bbox(layer)
+    return None
+
+def draw_layer(target: Image.Image, layer, offset=(0, 0)):
+    """Draw one layer onto `target`, whose top-left sits at canvas position `offset`."""
+    x = int(layer.get("x", 0)) - offset[0]
+    y = int(layer.get("y", 0)) - offset[1]
+    if layer.get("type") == "image":
+        img = prepare_image_layer(layer)
+        if img is not None:
+            target.paste(img, (x, y), img)
+    elif layer.get("type") == "text":
+        draw = ImageDraw.Draw(target)
+        draw.text((x, y), layer.get("text", ""), fill=layer.get("color", "#000000"), font=layer_font(layer))
+
+def compose_layers(size, background_color, layers) -> Image.Image:
+    """Full RGBA render of a layer stack."""
+    canvas = Image.new("RGBA", size, background_color)
+    for layer in layers:
+        draw_layer(canvas, layer)
+    return canvas
+
+def _union_rect(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+
+def _rects_intersect(a, b):
+    return a is not None and b is not None and a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+# --- Incremental compositor ------------------------------------------------
+# Keeps the last composited canvas per project. When only some layers changed,
+# just the union of their old and new bounding boxes is re-composited. While
+# the same layer keeps changing (drag/resize), a checkpoint of the stack below
+# it is kept so only the layers from that one upwards are redrawn.
+RENDER_COMPOSITOR_PROJECTS = int(os.getenv("RENDER_COMPOSITOR_PROJECTS", "8"))
+DIRTY_RECT_PADDING = 2  # px, covers anti-aliased glyph edges
+
+class ProjectCompositor:
+    def __init__(self, max_projects):
+        self.max_projects = max_projects
+        self.states = OrderedDict()
+        self.lock = threading.Lock()
+        self.full_renders = 0
+        self.partial_renders = 0
+        self.reused_renders = 0
+
+    def _state(self, project_id):
+        with self.lock:
+            state = self.states.get(project_id)
+            if state is None:
+                state = {"lock": threading.Lock(), "canvas": None}
+                self.states[project_id] = state
+                while len(self.states) > self.max_projects:
+                    self.states.popitem(last=False)
+            else:
+                self.states.move_to_end(project_id)
+            return state
+
+    def render(self, project_id, size, background_color, layers) -> Image.Image:
+        """Return an RGB render of the layers, reusing cached work where possible."""
+        if self.max_projects <= 0:
+            self.full_renders += 1
+            return compose_layers(size, background_color, layers).convert("RGB")
+
+        state = self._state(str(project_id))
+        with state["lock"]:
+            self._update(state, size, background_color, layers)
+            return state["canvas"].convert("RGB")
+
+    def discard(self, project_id):
+        with self.lock:
+            self.states.pop(str(project_id), None)
+
+    def _full(self, state, size, background_color, layers):
+        self.full_renders += 1
+        state.update({
+            "canvas": compose_layers(size, background_color, layers),
+            "size": size,
+            "background_color": background_color,
+            "layers": layers,
+            "bboxes": [layer_bbox(l) for l in layers],
+            "below": None,
+            "last_changed": None,
+        })
+
+    def _update(self, state, size, background_color, layers):
+        old = state.get("layers")
+        if state["canvas"] is None or state["size"] != size or state["background_color"] != background_color:
+            return self._full(state, size, background_color, layers)
+
+        common = min(len(old), len(layers))
+        if [l.get("layer_id") for l in old[:common]] != [l.get("layer_id") for l in layers[:common]]:
+            return self._full(state, size, background_color, layers)  # reordered
+
+        # changed layers plus anything added to / removed from the top of the stack
+        changed = [i for i in range(common) if old[i] != layers[i]]
+        changed += list(range(common, max(len(old), len(layers))))
+        if not changed:
+            self.reused_renders += 1
+            return
+
+        old_bboxes = state["bboxes"] + [None] * (len(layers) - len(old))
+        bboxes = old_bboxes[:len(layers)]
+        dirty = None
+        for i in changed:
+            dirty = _union_rect(dirty, old_bboxes[i])
+            if i < len(layers):
+                bboxes[i] = layer_bbox(layers[i])
+                dirty = _union_rect(dirty, bboxes[i])
+
+        lowest = changed[0]
+        below = state["below"]
+        if below and below[0] > lowest:
+            below = None  # something under the checkpoint changed
+        if below is None and lowest > 0 and state["last_changed"] == lowest:
+            # same layer edited again: worth snapshotting everything beneath it
+            below = (lowest, compose_layers(size, background_color, layers[:lowest]))
+
+        if dirty:
+            pad = DIRTY_RECT_PADDING
+            rect = (max(0, dirty[0] - pad), max(0, dirty[1] - pad),
+                    min(size[0], dirty[2] + pad), min(size[1], dirty[3] + pad))
+            if rect[0] < rect[2] and rect[1] < rect[3]:
+                start = below[0] if below else 0
+                tile = below[1].crop(rect) if below else Image.new("RGBA", (rect[2] - rect[0], rect[3] - rect[1]), background_color)
+                for layer, bbox in zip(layers[start:], bboxes[start:]):
+                    if _rects_intersect(bbox, rect):
+                        draw_layer(tile, layer, offset=rect[:2])
+                state["canvas"].paste(tile, rect[:2])
+
+        self.partial_renders += 1
+        state.update({"layers": layers, "bboxes": bboxes, "below": below, "last_changed": lowest})
+
+    def stats(self):
+        return {
+            "projects": len(self.states),
+            "max_projects": self.max_projects,
+            "full_renders": self.full_renders,
+            "partial_renders": self.partial_renders,
+            "reused_renders": self.reused_renders,
+        }
+
+project_compositor = ProjectCompositor(RENDER_COMPOSITOR_PROJECTS)
+
+@app.get("/editor/render-cache/stats")
+def render_cache_stats():
+    return {
+        "status": "success",
+        "cache": layer_bitmap_cache.stats(),
+        "compositor": project_compositor.stats(),
+        "fonts": font_cache_stats(),
+    }
+
 # --- Render helper (re-use existing render logic) -------------------------
-def render_project_image(project_id: str) -> Image.Image:
-    proj = db.editor_projects.find_one({"_id": ObjectId(project_id)})
+def render_project_image(project_id: str, proj=None) -> Image.Image:
+    if proj is None:
+        proj = db.editor_projects.find_one({"_id": ObjectId(project_id)}, {"history": 0, "future": 0})
     if not proj:
         raise HTTPException(status_code=404, detail="Project not found")
 
-    canvas = Image.new("RGBA", (proj["width"], proj["height"]), proj.get("background_color", "#FFFFFF"))
-    for layer in proj.get("layers", []):
-        if layer.get("type") == "image":
-            try:
-                file_obj = fs.get(ObjectId(layer["file_id"]))
-            except Exception:
-                continue
-            img = Image.open(io.BytesIO(file_obj.read())).convert("RGBA")
-            img = img.resize((int(layer.get("width", img.width)), int(layer.get("height", img.height))))
-            if layer.get("rotation", 0):
-                img = img.rotate(layer.get("rotation", 0), expand=True)
-            if layer.get("opacity", 1.0) < 1.0:
-                alpha = img.split()[3].point(lambda p: int(p * layer.get("opacity", 1.0)))
-                img.putalpha(alpha)
-            canvas.paste(img, (int(layer.get("x", 0)), int(layer.get("y", 0))), img)
-        elif layer.get("type") == "text":
-            draw = ImageDraw.Draw(canvas)
-            try:
-                font = ImageFont.truetype("arial.ttf", int(layer.get("font_size", 24)))
-            except Exception:
-                font = ImageFont.load_default()
-            draw.text((int(layer.get("x", 0)), int(layer.get("y", 0))), layer.get("text", ""),
-                      fill=layer.get("color", "#000000"), font=font)
-    return canvas.convert("RGB")
+    return project_compositor.render(
+        project_id,
+        (proj["width"], proj["height"]),
+        proj.get("background_color", "#FFFFFF"),
+        proj.get("layers", [])
+    )
+
+# --- Spatial index over layer rectangles ---------------------------------
+# Rectangles are (x0, y0, x1, y1), half-open. Both helpers sweep along x and
+# keep the active y-intervals in a segment tree over the compressed y
+# coordinates, so they run in O(n log n) (+ k reported pairs) instead of O(n^2).
+class _IntervalIndex:
+    """Dynamic set of y-intervals that reports which ones overlap a query range."""
+
+    def __init__(self, coords):
+        self.coords = coords
+        self.leaves = 1
+        while self.leaves < len(coords):
+            self.leaves *= 2
+        self.cover = defaultdict(set)  # tree node -> ids whose interval spans it
+        self.starts = []               # sorted (y0, id)
+
+    def _nodes(self, y0, y1):
+        # canonical segment-tree nodes covering slots [y0, y1)
+        lo = bisect.bisect_left(self.coords, y0) + self.leaves
+        hi = bisect.bisect_left(self.coords, y1) + self.leaves
+        while lo < hi:
+            if lo & 1:
+                yield lo
+                lo += 1
+            if hi & 1:
+                hi -= 1
+                yield hi
+            lo //= 2
+            hi //= 2
+
+    def add(self, rid, y0, y1):
+        for node in self._nodes(y0, y1):
+            self.cover[node].add(rid)
+        bisect.insort(self.starts, (y0, rid))
+
+    def remove(self, rid, y0, y1):
+        for node in self._nodes(y0, y1):
+            self.cover[node].discard(rid)
+        del self.starts[bisect.bisect_left(self.starts, (y0, rid))]
+
+    def overlapping(self, y0, y1):
+        # intervals containing y0, plus intervals starting inside (y0, y1)
+        found = set()
+        node = bisect.bisect_right(self.coords, y0) - 1 + self.leaves
+        while node:
+            found |= self.cover.get(node, set())
+            node //= 2
+        lo = bisect.bisect_left(self.starts, (y0, -1))
+        hi = bisect.bisect_left(self.starts, (y1, -1))
+        found.update(rid for _, rid in self.starts[lo:hi])
+        return found
+
+def overlapping_pairs(rects):
+    """All index pairs (i, j), i < j, of rectangles that overlap with positive area."""
+    live = [i for i, r in enumerate(rects) if r[2] > r[0] and r[3] > r[1]]
+    index = _IntervalIndex(sorted({rects[i][1] for i in live} | {rects[i][3] for i in live}))
+    active = []  # heap of (x1, id)
+    pairs = []
+    for i in sorted(live, key=lambda i: rects[i][0]):
+        x0, y0, x1, y1 = rects[i]
+        while active and active[0][0] <= x0:
+            _, done = heapq.heappop(active)
+            index.remove(done, rects[done][1], rects[done][3])
+        pairs.extend((min(i, j), max(i, j)) for j in index.overlapping(y0, y1))
+        index.add(i, y0, y1)
+        heapq.heappush(active, (x1, i))
+    return sorted(pairs)
+
+def union_area(rects):
+    """Exact area covered by the union of the rectangles."""
+    rects = [r for r in rects if r[2] > r[0] and r[3] > r[1]]
+    if not rects:
+        return 0
+    ys = sorted({r[1] for r in rects} | {r[3] for r in rects})
+    slots = len(ys) - 1
+    count = [0] * (4 * slots)     # how many rectangles fully cover each node
+    covered = [0] * (4 * slots)   # covered y-length under each node
+
+    def update(node, lo, hi, a, b, delta):
+        if b <= lo or hi <= a:
+            return
+        if a <= lo and hi <= b:
+            count[node] += delta
+        else:
+            mid = (lo + hi) // 2
+            update(2 * node, lo, mid, a, b, delta)
+            update(2 * node + 1, mid, hi, a, b, delta)
+        if count[node]:
+            covered[node] = ys[hi] - ys[lo]
+        elif hi - lo == 1:
+            covered[node] = 0
+        else:
+            covered[node] = covered[2 * node] + covered[2 * node + 1]
+
+    events = []
+    for x0, y0, x1, y1 in rects:
+        a, b = bisect.bisect_left(ys, y0), bisect.bisect_left(ys, y1)
+        events.append((x0, 1, a, b))
+        events.append((x1, -1, a, b))
+    events.sort()
+
+    area = 0
+    prev_x = events[0][0]
+    for x, delta, a, b in events:
+        area += covered[1] * (x - prev_x)
+        prev_x = x
+        update(1, 0, slots, a, b, delta)
+    return area
+
+# --- Compliance result cache ---------------------------------------------
+# Results are keyed by (project content hash, retailer, guideline version), so
+# any layer or guideline change produces a new key and stale entries just age
+# out. The same key doubles as the ETag for conditional requests.
+COMPLIANCE_CACHE_SIZE = int(os.getenv("COMPLIANCE_CACHE_SIZE", "512"))
+
+class LRUCache:
+    """Small thread-safe LRU with a maximum number of entries."""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+
+    def put(self, key, value):
+        if self.max_entries <= 0:
+            return
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def discard(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.entries), "max_entries": self.max_entries, "hits": self.hits, "misses": self.misses}
+
+compliance_result_cache = LRUCache(COMPLIANCE_CACHE_SIZE)
+
+def _stable_hash(value):
+    return hashlib.sha256(json.dumps(value, sort_keys=True, default=str).encode()).hexdigest()
+
+def project_content_hash(proj):
+    """Hash of everything that affects how a project renders and checks."""
+    return _stable_hash({k: proj.get(k) for k in ("width", "height", "background_color", "layers")})
+
+def guideline_version(guideline):
+    if guideline.get("version") is not None:
+        return str(guideline["version"])
+    return _stable_hash(guideline.get("rules", {}))
+
+def compliance_etag(key):
+    return '"' + _stable_hash(list(key))[:32] + '"'
+
+def etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    tags = [t.strip() for t in if_none_match.split(",")]
+    return "*" in tags or etag in tags or f"W/{etag}" in tags
+
+# --- Compiled retailer guidelines -----------------------------------------
+# Guideline documents are validated once into frozen GuidelineRules objects and
+# kept in-process, so compliance calls do no database round-trip. A compiled
+# guideline is replaced when its version (the `version` field, or a hash of the
+# rules) changes: a background poller checks every GUIDELINE_POLL_SECONDS
+# (0 disables it), and POST /admin/guidelines/reload forces a refresh.
+GUIDELINE_POLL_SECONDS = float(os.getenv("GUIDELINE_POLL_SECONDS", "30"))
+
+@dataclass(frozen=True)
+class GuidelineRules:
+    min_font_size: int = 12                          # px
+    min_contrast_ratio: float = 4.5                  # WCAG ratio, 1..21
+    logo_safe_margin_pct: float = 0.05               # of the shorter canvas side
+    max_text_coverage_pct: float = 0.3               # of the canvas area
+    required_file_resolution: tuple = (0, 0)         # min width, height
+    forbidden_areas: tuple = ()                      # (x, y, w, h) boxes
+    max_background_std: Optional[float] = None       # luminance spread under text
+
+def _rule_number(rules, name, default, kind, low=None, high=None):
+    value = rules.get(name, default)
+    if value is None or isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise ValueError(f"{name} must be a number")
+    if kind is int and value != int(value):
+        raise ValueError(f"{name} must be a whole number")
+    if low is not None and value < low:
+        raise ValueError(f"{name} must be at least {low}")
+    if high is not None and value > high:
+        raise ValueError(f"{name} must be at most {high}")
+    return kind(value)
+
+def compile_guideline_rules(rules) -> GuidelineRules:
+    """Validate a raw `rules` dict into a GuidelineRules; raises ValueError."""
+    if not isinstance(rules, dict):
+        raise ValueError("rules must be an object")
+    unknown = set(rules) - set(GuidelineRules.__dataclass_fields__)
+    if unknown:
+        print(f"[Guidelines] ignoring rules this server does not know: {', '.join(sorted(unknown))}")
+    defaults = GuidelineRules()
+
+    resolution = rules.get("required_file_resolution", defaults.required_file_resolution)
+    if not (isinstance(resolution, (list, tuple)) and len(resolution) == 2
+            and all(isinstance(v, int) and not isinstance(v, bool) and v >= 0 for v in resolution)):
+        raise ValueError("required_file_resolution must be [width, height]")
+
+    areas = rules.get("forbidden_areas") or []
+    if not (isinstance(areas, (list, tuple)) and all(
+            isinstance(a, (list, tuple)) and len(a) == 4 and all(isinstance(v, (int, float)) for v in a) for a in areas)):
+        raise ValueError("forbidden_areas must be a list of [x, y, w, h]")
+
+    max_std = rules.get("max_background_std")
+    return GuidelineRules(
+        min_font_size=_rule_number(rules, "min_font_size", defaults.min_font_size, int, 1),
+        min_contrast_ratio=_rule_number(rules, "min_contrast_ratio", defaults.min_contrast_ratio, float, 1, 21),
+        logo_safe_margin_pct=_rule_number(rules, "logo_safe_margin_pct", defaults.logo_safe_margin_pct, float, 0, 0.5),
+        max_text_coverage_pct=_rule_number(rules, "max_text_coverage_pct", defaults.max_text_coverage_pct, float, 0, 1),
+        required_file_resolution=tuple(resolution),
+        forbidden_areas=tuple(tuple(a) for a in areas),
+        max_background_std=None if max_std is None else _rule_number(rules, "max_background_std", None, float, 0),
+    )
+
+@dataclass(frozen=True)
+class CompiledGuideline:
+    retailer: str
+    version: str
+    rules: GuidelineRules
+
+class GuidelineRegistry:
+    def __init__(self):
+        self.compiled = {}
+        self.errors = {}
+        self.loads = 0
+        self.lock = threading.Lock()
+
+    def _compile(self, doc):
+        version = guideline_version(doc)
+        current = self.compiled.get(doc["retailer"])
+        if current is not None and current.version == version:
+            return current
+        try:
+            compiled = CompiledGuideline(doc["retailer"], version, compile_guideline_rules(doc.get("rules")))
+        except ValueError as e:
+            # keep serving the last good version; report why the new one was rejected
+            self.errors[doc["retailer"]] = f"version {version}: {e}"
+            print(f"[Guidelines] WARNING: {doc['retailer']} {self.errors[doc['retailer']]}")
+            return current
+        self.errors.pop(doc["retailer"], None)
+        self.loads += 1
+        return compiled
+
+    def get(self, retailer) -> CompiledGuideline:
+        compiled = self.compiled.get(retailer)
+        if compiled is not None:
+            return compiled
+        doc = db.retailer_guidelines.find_one({"retailer": retailer}, {"retailer": 1, "version": 1, "rules": 1})
+        if not doc:
+            raise HTTPException(status_code=404, detail="Retailer guideline not found")
+        with self.lock:
+            compiled = self._compile(doc)
+            if compiled is None:
+                raise HTTPException(status_code=500, detail=f"Retailer guideline is invalid: {self.errors[retailer]}")
+            self.compiled[retailer] = compiled
+        return compiled
+
+    def reload(self):
+        """Re-read every guideline, recompiling only the ones whose version changed."""
+        docs = list(db.retailer_guidelines.find({}, {"retailer": 1, "version": 1, "rules": 1}))
+        with self.lock:
+            compiled = {}
+            for doc in docs:
+                result = self._compile(doc)
+                if result is not None:
+                    compiled[doc["retailer"]] = result
+            retailers = {doc["retailer"] for doc in docs}
+            self.errors = {k: v for k, v in self.errors.items() if k in retailers}
+            self.compiled = compiled
+        return self.stats()
+
+    def stats(self):
+        return {
+            "retailers": {k: v.version for k, v in self.compiled.items()},
+            "errors": dict(self.errors),
+            "compiles": self.loads,
+            "poll_seconds": GUIDELINE_POLL_SECONDS,
+        }
+
+guideline_registry = GuidelineRegistry()
+
+def _poll_guidelines():
+    while True:
+        time.sleep(GUIDELINE_POLL_SECONDS)
+        try:
+            guideline_registry.reload()
+        except Exception as e:
+            print(f"[Guidelines] reload failed: {e}")
+
+@app.on_event("startup")
+def start_guideline_registry():
+    guideline_registry.reload()
+    if GUIDELINE_POLL_SECONDS > 0:
+        threading.Thread(target=_poll_guidelines, name="guideline-poller", daemon=True).start()
+
+@app.post("/admin/guidelines/reload")
+def reload_guidelines():
+    return {"status": "success", **guideline_registry.reload()}
+
+@app.get("/admin/guidelines")
+def list_guidelines():
+    return {"status": "success", **guideline_registry.stats()}
 
 # --- Compliance check core -----------------------------------------------
 @app.get("/compliance/check/{project_id}")
-def compliance_check(project_id: str, retailer: str = "RetailerA"):
-    # load guidelines
-    guideline = db.retailer_guidelines.find_one({"retailer": retailer})
-    if not guideline:
-        raise HTTPException(status_code=404, detail="Retailer guideline not found")
-
-    rules = guideline["rules"]
+def compliance_check(
+    project_id: str,
+    response: Response,
+    retailer: str = "RetailerA",
+    incremental: bool = True,
+    if_none_match: Optional[str] = Header(None)
+):
+    guideline = guideline_registry.get(retailer)
     try:
         pid = ObjectId(project_id)
     except Exception:
@@ -972,199 +2209,746 @@ def compliance_check(project_id: str, retailer: str = "RetailerA"):
     if not proj:
         raise HTTPException(status_code=404, detail="Project not found")
 
-    # Guard: empty project
-    if not proj.get("layers"):
-        return {"status": "success", "violations": [], "info": "No layers to check"}
-
+    key = (project_content_hash(proj), retailer, guideline.version)
+    etag = compliance_etag(key)
+    # no-cache: browsers keep the result but revalidate it with If-None-Match
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+
+    result = compliance_result_cache.get(key)
+    if result is None:
+        result = evaluate_compliance(project_id, proj, guideline.rules, incremental)
+        compliance_result_cache.put(key, result)
+    return result
+
+@app.get("/compliance/cache/stats")
+def compliance_cache_stats():
+    return {"status": "success", "cache": compliance_result_cache.stats(), "incremental": compliance_states.stats()}
+
+# --- Compliance measurements -----------------------------------------------
+# Everything a check needs from the canvas (text boxes, background samples,
+# image overlaps) is measured independently of any retailer's rules, so one
+# render and one set of measurements can be judged against several rule sets.
+def _measure_text_layer(layer, proj, get_sampler):
+    """Font size, box and background samples for one text layer.
+
+    box/window are None when the text could not be measured, contrast/spread
+    when the background could not be sampled. get_sampler(bbox) returns a
+    RegionSampler covering that box (None if the canvas could not be rendered).
+    """
+    m = {"font_size": int(layer.get("font_size", 16)), "box": None, "window": None,
+         "background": None, "contrast": None, "spread": None}
+    # text bounding box from font metrics (no scratch canvas needed)
     try:
-        canvas_img = render_project_image(project_id)
-        canvas_is_blank = np.std(np.array(canvas_img)) < 5
+        x0,y0,x1,y1 = text_layer_bbox(layer, 16)
+        w = x1 - x0; h = y1 - y0
+        m["box"] = (max(0, x0), max(0, y0), min(proj["width"], x1), min(proj["height"], y1))
+        m["window"] = RegionSampler.clip((x0,y0,w,h), (proj["width"], proj["height"]))
+
+        # sample background color under text region
+        sampler = get_sampler((x0,y0,w,h))
+        m["background"] = sampled = sampler.mean_color((x0,y0,w,h))
+        m["contrast"] = contrast_ratio(hex_to_rgb(layer.get("color","#000000")), sampled)
+        m["spread"] = sampler.luminance_std((x0,y0,w,h))
     except Exception:
-        canvas_img = None
-        canvas_is_blank = True
+        # best-effort — if bbox measurement fails, skip
+        pass
+    return m
+
+def _image_rect(layer):
+    x, y = layer.get("x") or 0, layer.get("y") or 0
+    return (x, y, x + (layer.get("width") or 0), y + (layer.get("height") or 0))
+
+def _images_overlap_too_much(a, b):
+    if not (min(a[2], b[2]) > max(a[0], b[0]) and min(a[3], b[3]) > max(a[1], b[1])):
+        return False
+    overlap = (min(a[2], b[2]) - max(a[0], b[0])) * (min(a[3], b[3]) - max(a[1], b[1]))
+    smaller = min((a[2]-a[0]) * (a[3]-a[1]), (b[2]-b[0]) * (b[3]-b[1]))
+    return overlap / smaller > 0.4  # >40% overlap of smaller image
+
+# Measurements are kept per project. On the next check only what an edit can
+# have changed is re-measured: edited text layers, text layers whose
+# background pixels changed (their box meets an edited layer's old or new
+# bounds) and overlaps of edited images. A full measurement is the same code
+# with every layer treated as edited, so both paths give identical results.
+COMPLIANCE_STATE_PROJECTS = int(os.getenv("COMPLIANCE_STATE_PROJECTS", "64"))
+compliance_states = LRUCache(COMPLIANCE_STATE_PROJECTS)
+
+def measure_compliance(project_id, proj, incremental=False):
+    """Rule-independent measurements of a project, for apply_compliance_rules.
+
+    With incremental=True, reuse what is still valid from the previous
+    measurement of this project.
+    """
+    layers = proj.get("layers") or []
+    ids = [l.get("layer_id") for l in layers]
+    # key layers by id when ids are usable, by position otherwise
+    keyed = all(ids) and len(set(ids)) == len(ids)
+    keys = ids if keyed else list(range(len(layers)))
+    context = (proj["width"], proj["height"], proj.get("background_color"))
+    incremental = incremental and keyed
+
+    by_id = dict(zip(keys, layers))
+    previous = compliance_states.get(str(project_id)) if incremental else None
+    # a re-ordered stack changes what sits under every text layer: start over
+    if (previous is None or previous["context"] != context
+            or [k for k in previous["order"] if k in by_id] != [k for k in keys if k in previous["layers"]]):
+        previous = {"layers": {}, "text": {}, "overlaps": set()}
+    changed = {k for k in keys if previous["layers"].get(k) != by_id[k]}
+    removed = set(previous["layers"]) - set(keys)
+
+    # pixels can only have changed inside the old/new bounds of edited layers
+    dirty = []
+    for k in changed | removed:
+        for layer in (previous["layers"].get(k), by_id.get(k)):
+            bbox = layer_bbox(layer) if layer else None
+            if bbox:
+                pad = DIRTY_RECT_PADDING
+                dirty.append((bbox[0] - pad, bbox[1] - pad, bbox[2] + pad, bbox[3] + pad))
+
+    text = {}
+    remeasure = []
+    for k, layer in by_id.items():
+        if layer.get("type") != "text":
+            continue
+        cached = previous["text"].get(k)
+        if k in changed or cached is None or cached["box"] is None or any(_rects_intersect(cached["window"], d) for d in dirty):
+            remeasure.append(k)
+        else:
+            text[k] = cached
+
+    if remeasure:
+        try:
+            canvas_img = render_project_image(project_id, proj)
+            if len(remeasure) == len([l for l in layers if l.get("type") == "text"]):
+                full_sampler = RegionSampler(canvas_img)
+                get_sampler = lambda bbox: full_sampler
+            else:
+                get_sampler = lambda bbox: RegionSampler.for_box(canvas_img, bbox)
+        except Exception:
+            get_sampler = lambda bbox: None
+        for k in remeasure:
+            text[k] = _measure_text_layer(by_id[k], proj, get_sampler)
+
+    # image overlaps: keep pairs between untouched images, re-test edited ones
+    img_keys = [k for k in keys if by_id[k].get("type") == "image"]
+    rects = {k: _image_rect(by_id[k]) for k in img_keys}
+    edited_imgs = [k for k in img_keys if k in changed]
+    if len(edited_imgs) == len(img_keys):
+        overlaps = {frozenset((img_keys[i], img_keys[j])) for i, j in overlapping_pairs([rects[k] for k in img_keys])
+                    if _images_overlap_too_much(rects[img_keys[i]], rects[img_keys[j]])}
+    else:
+        overlaps = {p for p in previous["overlaps"] if not (p & (changed | removed))}
+        for k in edited_imgs:
+            overlaps.update(frozenset((k, other)) for other in img_keys
+                            if other != k and _images_overlap_too_much(rects[k], rects[other]))
+
+    state = {"context": context, "order": keys, "layers": by_id, "text": text, "overlaps": overlaps}
+    if incremental:
+        compliance_states.put(str(project_id), state)
+
+    # union area, so overlapping text is only counted once
+    boxes = [text[k]["box"] for k in keys if k in text and text[k]["box"]]
+    position = {k: i for i, k in enumerate(img_keys)}
+    return {
+        "layers": layers,
+        "text": [(by_id[k], text[k]) for k in keys if k in text],
+        "text_coverage": union_area(boxes) / (proj["width"] * proj["height"]),
+        "overlaps": [(by_id[img_keys[i]], by_id[img_keys[j]])
+                     for i, j in sorted(tuple(sorted(position[k] for k in pair)) for pair in overlaps)],
+    }
 
-    violations = []
+# --- Compliance rules ----------------------------------------------------------
+COMPLIANCE_RULE_CODES = [
+    "RESOLUTION_LOW", "FONT_TOO_SMALL", "LOW_CONTRAST", "BUSY_BACKGROUND",
+    "TEXT_TOO_MUCH", "LOGO_MARGIN_VIOLATION", "IMAGE_OVERLAP",
+]
 
+def _compliance_findings(proj, measured, rules):
+    """Yield (layer, violation) pairs; layer is None for canvas-wide findings."""
     # 1) resolution check
-    min_w, min_h = rules.get("required_file_resolution", [0, 0])
+    min_w, min_h = rules.required_file_resolution
     if proj["width"] < min_w or proj["height"] < min_h:
-        violations.append({
+        yield None, {
             "code": "RESOLUTION_LOW",
             "severity": "high",
             "message": f"Canvas resolution {proj['width']}x{proj['height']} is below required {min_w}x{min_h}"
-        })
+        }
 
     # 2) text size + contrast + text coverage
-    total_text_pixels = 0
-    for layer in proj.get("layers", []):
-        if layer.get("type") == "text":
-            font_size = int(layer.get("font_size", 16))
-            if font_size < rules.get("min_font_size", 12):
-                violations.append({
-                    "code": "FONT_TOO_SMALL",
-                    "severity": "medium",
-                    "layer_id": layer.get("layer_id"),
-                    "message": f"Text layer font size {font_size}px is smaller than required {rules.get('min_font_size')}px"
-                })
-
-            # approximate text bounding box by rendering text to temp image
-            try:
-                tmp = Image.new("RGB", (proj["width"], proj["height"]), (255,255,255))
-                draw = ImageDraw.Draw(tmp)
-                try:
-                    font = ImageFont.truetype("arial.ttf", font_size)
-                except Exception:
-                    font = ImageFont.load_default()
-                bbox = draw.textbbox((layer.get("x",0), layer.get("y",0)), layer.get("text",""), font=font)
-                x0,y0,x1,y1 = bbox
-                w = x1 - x0; h = y1 - y0
-                total_text_pixels += w*h
-
-                # sample background color under text region
-                sampled = sample_canvas_region(canvas_img, (x0,y0,w,h))
-                text_rgb = hex_to_rgb(layer.get("color","#000000"))
-                cr = contrast_ratio(text_rgb, sampled)
-                if cr < rules.get("min_contrast_ratio", 4.5):
-                    violations.append({
-                        "code": "LOW_CONTRAST",
-                        "severity": "high" if cr < 3 else "medium",
-                        "layer_id": layer.get("layer_id"),
-                        "message": f"Text contrast ratio {cr:.2f} is below required {rules.get('min_contrast_ratio')}"
-                    })
-            except Exception:
-                # best-effort — if bbox measurement fails, skip
-                pass
+    for layer, m in measured["text"]:
+        if m["font_size"] < rules.min_font_size:
+            yield layer, {
+                "code": "FONT_TOO_SMALL",
+                "severity": "medium",
+                "layer_id": layer.get("layer_id"),
+                "message": f"Text layer font size {m['font_size']}px is smaller than required {rules.min_font_size}px"
+            }
+        cr = m["contrast"]
+        if cr is not None and cr < rules.min_contrast_ratio:
+            yield layer, {
+                "code": "LOW_CONTRAST",
+                "severity": "high" if cr < 3 else "medium",
+                "layer_id": layer.get("layer_id"),
+                "message": f"Text contrast ratio {cr:.2f} is below required {rules.min_contrast_ratio}"
+            }
+        # optional rule: background under text must not be too busy
+        max_std = rules.max_background_std
+        if max_std is not None and m["spread"] is not None and m["spread"] > max_std:
+            yield layer, {
+                "code": "BUSY_BACKGROUND",
+                "severity": "low",
+                "layer_id": layer.get("layer_id"),
+                "message": f"Background behind text varies too much (luminance spread {m['spread']:.0f} > {max_std})"
+            }
 
-    text_coverage = total_text_pixels / (proj["width"] * proj["height"])
-    if text_coverage > rules.get("max_text_coverage_pct", 0.3):
-        violations.append({
+    text_coverage = measured["text_coverage"]
+    if text_coverage > rules.max_text_coverage_pct:
+        yield None, {
             "code": "TEXT_TOO_MUCH",
             "severity": "medium",
-            "message": f"Text covers {text_coverage*100:.1f}% of canvas which exceeds allowed {rules.get('max_text_coverage_pct')*100:.0f}%"
-        })
+            "message": f"Text covers {text_coverage*100:.1f}% of canvas which exceeds allowed {rules.max_text_coverage_pct*100:.0f}%"
+        }
 
     # 3) logo placement / safe margins
-    # find layers of type image named 'logo' by convention (you may add layer.meta)
     short_side = min(proj["width"], proj["height"])
-    min_logo_margin = int(short_side * rules.get("logo_safe_margin_pct", 0.05))
-
-    for layer in proj.get("layers", []):
-        if layer.get("type") == "image" and layer.get("meta", {}).get("role") == "logo":
-            lx, ly, lw, lh = int(layer.get("x",0)), int(layer.get("y",0)), int(layer.get("width",0)), int(layer.get("height",0))
-            # if logo too close to edges
-            if lx < min_logo_margin or ly < min_logo_margin or (proj["width"] - (lx+lw)) < min_logo_margin or (proj["height"] - (ly+lh)) < min_logo_margin:
-                violations.append({
-                    "code": "LOGO_MARGIN_VIOLATION",
-                    "severity": "low",
-                    "layer_id": layer.get("layer_id"),
-                    "message": f"Logo is closer than {min_logo_margin}px to canvas edge; move inward to meet safe margin"
-                })
-
-    # 4) overlapping important elements - naive check: image-image overlap > threshold
-    img_layers = [l for l in proj.get("layers", []) if l.get("type")=="image"]
-    for i in range(len(img_layers)):
-        for j in range(i+1, len(img_layers)):
-            a = img_layers[i]; b = img_layers[j]
-            ax,ay,aw,ah = a.get("x",0), a.get("y",0), a.get("width",0), a.get("height",0)
-            bx,by,bw,bh = b.get("x",0), b.get("y",0), b.get("width",0), b.get("height",0)
-            # compute overlap area
-            ix = max(ax, bx)
-            iy = max(ay, by)
-            ix2 = min(ax+aw, bx+bw)
-            iy2 = min(ay+ah, by+bh)
-            if ix2 > ix and iy2 > iy:
-                overlap = (ix2-ix)*(iy2-iy)
-                smaller = min(aw*ah, bw*bh)
-                if overlap / smaller > 0.4:  # >40% overlap of smaller image
-                    violations.append({
-                        "code": "IMAGE_OVERLAP",
-                        "severity": "medium",
-                        "message": f"Images {a.get('layer_id')} and {b.get('layer_id')} overlap significantly"
-                    })
-
-    return {"status": "success", "violations": violations}
-
-# --- Auto-fix suggestion / apply fixes ------------------------------------
-@app.post("/compliance/autofix/{project_id}")
-def compliance_autofix(project_id: str, retailer: str = "RetailerA", apply_changes: bool = True):
-    guideline = db.retailer_guidelines.find_one({"retailer": retailer})
-    if not guideline:
-        raise HTTPException(status_code=404, detail="Retailer guideline not found")
-    rules = guideline["rules"]
+    min_logo_margin = int(short_side * rules.logo_safe_margin_pct)
+    # find layers of type image named 'logo' by convention (you may add layer.meta)
+    for layer in measured["layers"]:
+        if not (layer.get("type") == "image" and layer.get("meta", {}).get("role") == "logo"):
+            continue
+        lx, ly, lw, lh = int(layer.get("x",0)), int(layer.get("y",0)), int(layer.get("width",0)), int(layer.get("height",0))
+        # if logo too close to edges
+        if lx < min_logo_margin or ly < min_logo_margin or (proj["width"] - (lx+lw)) < min_logo_margin or (proj["height"] - (ly+lh)) < min_logo_margin:
+            yield layer, {
+                "code": "LOGO_MARGIN_VIOLATION",
+                "severity": "low",
+                "layer_id": layer.get("layer_id"),
+                "message": f"Logo is closer than {min_logo_margin}px to canvas edge; move inward to meet safe margin"
+            }
 
-    proj = db.editor_projects.find_one({"_id": ObjectId(project_id)})
+    # 4) overlapping important elements: image-image overlap > threshold
+    for a, b in measured["overlaps"]:
+        yield None, {
+            "code": "IMAGE_OVERLAP",
+            "severity": "medium",
+            "message": f"Images {a.get('layer_id')} and {b.get('layer_id')} overlap significantly"
+        }
+
+def apply_compliance_rules(proj, measured, rules):
+    """Judge measure_compliance output against one retailer's GuidelineRules."""
+    return {"status": "success", "violations": [v for _, v in _compliance_findings(proj, measured, rules)]}
+
+def evaluate_compliance(project_id, proj, rules, incremental=False):
+    # Guard: empty project
+    if not proj.get("layers"):
+        return {"status": "success", "violations": [], "info": "No layers to check"}
+    return apply_compliance_rules(proj, measure_compliance(project_id, proj, incremental), rules)
+
+def check_retailers(project_id, proj, guidelines, incremental=False):
+    """{retailer: result} for several CompiledGuidelines from one measurement."""
+    if not proj.get("layers"):
+        return {g.retailer: {"status": "success", "violations": [], "info": "No layers to check"} for g in guidelines}
+    measured = measure_compliance(project_id, proj, incremental)
+    return {g.retailer: apply_compliance_rules(proj, measured, g.rules) for g in guidelines}
+
+# --- Multi-retailer compliance matrix -----------------------------------------
+@app.get("/compliance/matrix/{project_id}")
+def compliance_matrix(
+    project_id: str,
+    response: Response,
+    retailers: Optional[str] = None,
+    if_none_match: Optional[str] = Header(None)
+):
+    """Check one project against several retailers from a single render.
+
+    `retailers` is a comma-separated list (default: every loaded guideline).
+    The matrix holds, per retailer, the number of violations of each rule.
+    """
+    names = list(dict.fromkeys(r.strip() for r in retailers.split(",") if r.strip())) if retailers else sorted(guideline_registry.compiled)
+    if not names:
+        raise HTTPException(status_code=400, detail="No retailers to check")
+    guidelines = [guideline_registry.get(name) for name in names]
+    try:
+        pid = ObjectId(project_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid project ID format")
+    proj = db.editor_projects.find_one({"_id": pid})
     if not proj:
         raise HTTPException(status_code=404, detail="Project not found")
 
-    changes = []
-    updated = False
+    etag = compliance_etag((project_content_hash(proj), "matrix", [(g.retailer, g.version) for g in guidelines]))
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
 
-    # load image of canvas for sampling
-    canvas_img = render_project_image(project_id)
+    results = check_retailers(project_id, proj, guidelines, incremental=True)
+    return {
+        "status": "success",
+        "rules": COMPLIANCE_RULE_CODES,
+        "matrix": {
+            name: {code: sum(1 for v in result["violations"] if v["code"] == code) for code in COMPLIANCE_RULE_CODES}
+            for name, result in results.items()
+        },
+        "compliant": {name: not result["violations"] for name, result in results.items()},
+        "violations": {name: result["violations"] for name, result in results.items()},
+    }
 
-    short_side = min(proj["width"], proj["height"])
-    min_logo_margin = int(short_side * rules.get("logo_safe_margin_pct", 0.05))
+# --- Auto-fix solver ------------------------------------------------------
+# Fixes are applied to an in-memory copy of the layers, then the copy is
+# re-measured (incrementally: only what the fixes touched is re-sampled) and
+# fixed again until no rule yields a new fix or the iteration/time budget runs
+# out. A font increase therefore gets its contrast checked in the new box, and
+# a moved logo is checked for overlaps. The final fields are written in one
+# undoable edit.
+AUTOFIX_MAX_ITERATIONS = int(os.getenv("AUTOFIX_MAX_ITERATIONS", "6"))
+AUTOFIX_TIME_BUDGET = float(os.getenv("AUTOFIX_TIME_BUDGET", "2.0"))  # seconds
+
+def _is_logo(layer):
+    return layer.get("type") == "image" and layer.get("meta", {}).get("role") == "logo"
+
+def _logo_positions(layer, proj, margin):
+    """Positions inside the safe margin: the nearest one first, then the corners by distance."""
+    max_x = max(margin, proj["width"] - int(layer.get("width", 0)) - margin)
+    max_y = max(margin, proj["height"] - int(layer.get("height", 0)) - margin)
+    nearest = (min(max(int(layer.get("x", 0)), margin), max_x), min(max(int(layer.get("y", 0)), margin), max_y))
+    corners = [(margin, margin), (max_x, margin), (margin, max_y), (max_x, max_y)]
+    corners.sort(key=lambda c: abs(c[0] - nearest[0]) + abs(c[1] - nearest[1]))
+    return [nearest] + [c for c in corners if c != nearest]
+
+def _autofix_step(proj, layers, measured, findings, rules, tried, contrasts):
+    """Return a fixed copy of `layers`, or None when no rule yields a new fix.
+
+    Layers are keyed by their position in the stack, so layers without a
+    usable layer_id are fixed independently. `tried` records every
+    (position, field, value) already applied so fixes that undo each other
+    cannot loop. `contrasts` maps (position, box, color) to the contrast
+    measured for it: the sample includes the glyphs themselves, so black/white
+    is chosen by measurement, not by estimate.
+    """
+    # measurements hold the very layer dicts of `layers`
+    position = {id(layer): i for i, layer in enumerate(layers)}
+    flagged = defaultdict(set)
+    for layer, v in findings:
+        if layer is not None:
+            flagged[position[id(layer)]].add(v["code"])
+    for a, b in measured["overlaps"]:
+        for layer in (a, b):
+            if _is_logo(layer):
+                flagged[position[id(layer)]].add("IMAGE_OVERLAP")
+
+    updates = defaultdict(dict)
+    def propose(i, field, value):
+        layer = layers[i]
+        current = (layer.get("x"), layer.get("y")) if field == "position" else layer.get(field)
+        if value != current and (field == "color" or (i, field, value) not in tried):
+            tried.add((i, field, value))
+            updates[i][field] = value
+
+    for layer, m in measured["text"]:
+        i = position[id(layer)]
+        if "FONT_TOO_SMALL" in flagged[i]:
+            propose(i, "font_size", rules.min_font_size)
+        elif "LOW_CONTRAST" in flagged[i] and m["background"] is not None:
+            # switch text color to black/white: try the one the sampled bg favours,
+            # then keep whichever measured best in this box
+            current = layer.get("color", "#000000").upper()
+            contrasts[(i, m["box"], current)] = m["contrast"]
+            black_cr = contrast_ratio((0,0,0), m["background"])
+            white_cr = contrast_ratio((255,255,255), m["background"])
+            untested = [c for c in (("#000000", "#FFFFFF") if black_cr >= white_cr else ("#FFFFFF", "#000000"))
+                        if (i, m["box"], c) not in contrasts]
+            if untested:
+                propose(i, "color", untested[0])
+            else:
+                measured_colors = {c: cr for (k, box, c), cr in contrasts.items() if k == i and box == m["box"]}
+                propose(i, "color", max(measured_colors, key=measured_colors.get))
+
+    # move logos inside the safe margin, to a spot that doesn't cover other images
+    min_logo_margin = int(min(proj["width"], proj["height"]) * rules.logo_safe_margin_pct)
+    images = [i for i, l in enumerate(layers) if l.get("type") == "image"]
+    for i in images:
+        layer = layers[i]
+        if not (_is_logo(layer) and flagged[i] & {"LOGO_MARGIN_VIOLATION", "IMAGE_OVERLAP"}):
+            continue
+        others = [_image_rect(layers[o]) for o in images if o != i]
+        for x, y in _logo_positions(layer, proj, min_logo_margin):
+            rect = _image_rect({**layer, "x": x, "y": y})
+            if (i, "position", (x, y)) not in tried and not any(_images_overlap_too_much(rect, o) for o in others):
+                propose(i, "position", (x, y))
+                break
+
+    if not updates:
+        return None
+    fixed = []
+    for i, layer in enumerate(layers):
+        fields = dict(updates.get(i, {}))
+        if "position" in fields:
+            fields["x"], fields["y"] = fields.pop("position")
+        # copies: the measurement state still holds the previous layer dicts
+        fixed.append({**layer, **fields} if fields else layer)
+    return fixed
+
+def solve_autofix(project_id, proj, rules, max_iterations=AUTOFIX_MAX_ITERATIONS, time_budget=AUTOFIX_TIME_BUDGET):
+    """Iterate fixes on an in-memory copy of the project to a fixed point or budget.
+
+    The copy is measured and rendered under a scratch key, so the project's
+    own compliance state and canvas never see the simulated layers. Returns
+    the changed fields keyed by layer position.
+    """
+    deadline = time.perf_counter() + time_budget
+    sim = {**proj, "layers": list(proj.get("layers") or [])}
+    scratch = f"autofix:{ObjectId()}"
+    # start from the project's measurements: they match the unfixed layers
+    state = compliance_states.get(str(project_id))
+    if state is not None:
+        compliance_states.put(scratch, state)
+    tried = set()
+    contrasts = {}
+    iterations = 0
+    converged = False
+    try:
+        while True:
+            measured = measure_compliance(scratch, sim, incremental=True) if sim["layers"] else None
+            findings = list(_compliance_findings(sim, measured, rules)) if measured else []
+            if iterations >= max_iterations or time.perf_counter() > deadline:
+                break
+            fixed = _autofix_step(sim, sim["layers"], measured, findings, rules, tried, contrasts) if measured else None
+            if fixed is None:
+                converged = True
+                break
+            sim["layers"] = fixed
+            iterations += 1
+    finally:
+        compliance_states.discard(scratch)
+        project_compositor.discard(scratch)
+
+    # final diff against the stored layers
+    fixes = {"font_size": "increase_font", "color": "color_contrast"}
+    changes, fields = [], {}
+    for i, (before, layer) in enumerate(zip(proj.get("layers") or [], sim["layers"])):
+        lid = layer.get("layer_id")
+        changed = {k: layer.get(k) for k in ("font_size", "color", "x", "y") if layer.get(k) != before.get(k)}
+        if not changed:
+            continue
+        fields[i] = changed
+        for key, fix in fixes.items():
+            if key in changed:
+                changes.append({"layer_id": lid, "fix": fix, "from": before.get(key, "#000000" if key == "color" else 16), "to": changed[key]})
+        if "x" in changed or "y" in changed:
+            changes.append({"layer_id": lid, "fix": "move_logo_inside_margin",
+                            "from": (before.get("x", 0), before.get("y", 0)), "to": (layer.get("x"), layer.get("y"))})
+    return {
+        "changes": changes,
+        "fields": fields,
+        "iterations": iterations,
+        "converged": converged,
+        "remaining_violations": [v for _, v in findings],
+    }
 
-    new_layers = proj.get("layers", [])
+@app.post("/compliance/autofix/{project_id}")
+def compliance_autofix(project_id: str, retailer: str = "RetailerA", apply_changes: bool = True, max_iterations: int = AUTOFIX_MAX_ITERATIONS):
+    rules = guideline_registry.get(retailer).rules
+    try:
+        pid = ObjectId(project_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid project ID format")
+    proj = db.editor_projects.find_one({"_id": pid})
+    if not proj:
+        raise HTTPException(status_code=404, detail="Project not found")
 
-    for idx, layer in enumerate(new_layers):
-        if layer.get("type") == "text":
-            font_size = int(layer.get("font_size", 16))
-            if font_size < rules.get("min_font_size", 16):
-                changes.append({"layer_id": layer.get("layer_id"), "fix": "increase_font", "from": font_size, "to": rules.get("min_font_size")})
-                layer["font_size"] = rules.get("min_font_size")
-                updated = True
+    solved = solve_autofix(project_id, proj, rules, max(0, min(max_iterations, 20)))
+    updated = bool(solved["changes"])
 
-            # fix contrast by switching text color to black/white based on sampled bg
-            try:
-                tmp = Image.new("RGB", (proj["width"], proj["height"]), (255,255,255))
-                draw = ImageDraw.Draw(tmp)
+    # apply to DB if requested; merge fields so edits made meanwhile are kept
+    if updated and apply_changes:
+        stored = proj.get("layers") or []
+        if _layers_by_id(stored) is not None:
+            fields = {stored[i]["layer_id"]: f for i, f in solved["fields"].items()}
+            edit_layers(project_id, lambda layers: [{**l, **fields.get(l.get("layer_id"), {})} for l in layers])
+        else:
+            # without usable ids, positions only hold while the stack is unchanged
+            def merge(layers):
+                if [l.get("layer_id") for l in layers] != [l.get("layer_id") for l in stored]:
+                    raise HTTPException(status_code=409, detail="Layers changed during auto-fix; run it again")
+                return [{**l, **solved["fields"].get(i, {})} for i, l in enumerate(layers)]
+            edit_layers(project_id, merge)
+    return {
+        "status": "success",
+        "applied": updated,
+        "changes": solved["changes"],
+        "iterations": solved["iterations"],
+        "converged": solved["converged"],
+        "remaining_violations": solved["remaining_violations"],
+    }
+
+# --- Bulk compliance scans -----------------------------------------------------
+# A scan checks every project against a set of retailers in a bounded pool of
+# worker processes and writes one compliance_reports document per project.
+# Projects are streamed in _id order and the job records the last _id whose
+# report is written, so an interrupted scan resumes from there. Each run of a
+# scan holds a lease under its own token (owner) and renews heartbeat_at as
+# it records results and while it waits on a slow project; a watchdog in each
+# API process takes over scans whose lease has expired, except those still
+# running in its own process.
+COMPLIANCE_SCAN_WORKERS = int(os.getenv("COMPLIANCE_SCAN_WORKERS", "2"))
+COMPLIANCE_SCAN_LEASE_SECONDS = 120
+SCAN_PROJECT_FIELDS = {"name": 1, "width": 1, "height": 1, "background_color": 1, "layers": 1}
+
+def _init_scan_worker():
+    # each project is rendered once per scan: keeping canvases only costs memory
+    project_compositor.max_projects = 0
+
+def scan_project(proj, guidelines):
+    """Worker-process entry point: check one project against every guideline."""
+    return check_retailers(proj["_id"], proj, guidelines)
+
+def _renew_scan_lease(job_id, owner):
+    """Move heartbeat_at forward; False once another run has taken the scan over."""
+    return db.compliance_scan_jobs.update_one(
+        {"_id": job_id, "owner": owner}, {"$set": {"heartbeat_at": datetime.utcnow()}}
+    ).matched_count == 1
+
+def _record_scan_result(job_id, owner, proj, guidelines, results, error):
+    now = datetime.utcnow()
+    report = {
+        "job_id": job_id,
+        "project_id": proj["_id"],
+        "project_name": proj.get("name"),
+        "checked_at": now,
+        "guideline_versions": {g.retailer: g.version for g in guidelines},
+        "error": error,
+    }
+    inc = {"failed": 1} if error else {"scanned": 1}
+    if results is not None:
+        report["violations"] = {r: res["violations"] for r, res in results.items()}
+        report["non_compliant"] = [r for r, res in results.items() if res["violations"]]
+        # the summary is a list in guideline order: retailer names may hold
+        # '.' or '$' and can't be used in update paths
+        for i, g in enumerate(guidelines):
+            violations = results[g.retailer]["violations"]
+            inc[f"summary.{i}.non_compliant"] = 1 if violations else 0
+            inc[f"summary.{i}.violations"] = len(violations)
+    db.compliance_reports.replace_one({"job_id": job_id, "project_id": proj["_id"]}, report, upsert=True)
+
+    # only the lease holder may move the checkpoint
+    return db.compliance_scan_jobs.update_one(
+        {"_id": job_id, "owner": owner},
+        {"$set": {"last_project_id": proj["_id"], "heartbeat_at": now}, "$inc": inc},
+    ).matched_count == 1
+
+def run_compliance_scan(job_id, owner):
+    owned = {"_id": job_id, "owner": owner}
+    cursor = None
+    try:
+        job = db.compliance_scan_jobs.find_one(owned)
+        if not job:
+            return
+        guidelines = [guideline_registry.get(r) for r in job["retailers"]]
+        query = {"_id": {"$gt": job["last_project_id"]}} if job.get("last_project_id") else {}
+        spawn = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(COMPLIANCE_SCAN_WORKERS, mp_context=spawn, initializer=_init_scan_worker) as pool:
+            cursor = db.editor_projects.find(query, SCAN_PROJECT_FIELDS, no_cursor_timeout=True).sort("_id", 1).batch_size(50)
+            inflight = deque()
+
+            def finish_oldest():
+                proj, future = inflight.popleft()
+                # a project can take longer than the lease: keep it alive meanwhile
+                while not wait([future], timeout=COMPLIANCE_SCAN_LEASE_SECONDS / 3).done:
+                    if not _renew_scan_lease(job_id, owner):
+                        return False
                 try:
-                    font = ImageFont.truetype("arial.ttf", layer.get("font_size",16))
-                except Exception:
-                    font = ImageFont.load_default()
-                bbox = draw.textbbox((layer.get("x",0), layer.get("y",0)), layer.get("text",""), font=font)
-                x0,y0,x1,y1 = bbox
-                sampled = sample_canvas_region(canvas_img, (x0,y0,x1-x0,y1-y0))
-                black_cr = contrast_ratio((0,0,0), sampled)
-                white_cr = contrast_ratio((255,255,255), sampled)
-                preferred = "#000000" if black_cr >= white_cr else "#FFFFFF"
-                current = layer.get("color", "#000000")
-                if contrast_ratio(hex_to_rgb(current), sampled) < rules.get("min_contrast_ratio", 4.5):
-                    changes.append({"layer_id": layer.get("layer_id"), "fix": "color_contrast", "from": current, "to": preferred})
-                    layer["color"] = preferred
-                    updated = True
-            except Exception:
-                pass
+                    results, error = future.result(), None
+                except Exception as e:
+                    results, error = None, str(e)
+                return _record_scan_result(job_id, owner, proj, guidelines, results, error)
+
+            # results are recorded in _id order so the checkpoint never skips a project
+            for proj in cursor:
+                inflight.append((proj, pool.submit(scan_project, proj, guidelines)))
+                if len(inflight) >= COMPLIANCE_SCAN_WORKERS * 2 and not finish_oldest():
+                    return  # lease lost to another process
+            while inflight:
+                if not finish_oldest():
+                    return
+        db.compliance_scan_jobs.update_one(owned, {"$set": {"status": "completed", "finished_at": datetime.utcnow()}})
+    except Exception as e:
+        detail = e.detail if isinstance(e, HTTPException) else str(e)
+        print(f"[Compliance scan] {job_id} failed: {detail}")
+        db.compliance_scan_jobs.update_one(owned, {"$set": {"status": "failed", "error": detail, "finished_at": datetime.utcnow()}})
+    finally:
+        if cursor is not None:
+            cursor.close()
+
+_scan_threads = {}  # job _id -> thread running it in this process
+_scan_threads_lock = threading.Lock()
+
+def _start_scan(job_id, owner):
+    thread = threading.Thread(target=run_compliance_scan, args=(job_id, owner), name=f"compliance-scan-{job_id}", daemon=True)
+    with _scan_threads_lock:
+        _scan_threads[job_id] = thread
+    thread.start()
+
+def _local_scans():
+    """_ids of the scans still running in this process."""
+    with _scan_threads_lock:
+        for job_id in [j for j, t in _scan_threads.items() if not t.is_alive()]:
+            del _scan_threads[job_id]
+        return list(_scan_threads)
+
+def _claim_stale_scan(job_id=None, statuses=("running",)):
+    """Take over a scan whose lease has expired; returns it with its new owner token, or None."""
+    now = datetime.utcnow()
+    query = {"status": {"$in": list(statuses)}, "heartbeat_at": {"$lt": now - timedelta(seconds=COMPLIANCE_SCAN_LEASE_SECONDS)}}
+    local = _local_scans()
+    if job_id is not None:
+        if job_id in local:
+            return None
+        query["_id"] = job_id
+    else:
+        query["_id"] = {"$nin": local}
+    return db.compliance_scan_jobs.find_one_and_update(
+        query,
+        {"$set": {"status": "running", "owner": str(ObjectId()), "heartbeat_at": now, "error": None, "finished_at": None}},
+        return_document=ReturnDocument.AFTER,
+    )
 
-        if layer.get("type") == "image" and layer.get("meta", {}).get("role") == "logo":
-            lx, ly, lw, lh = int(layer.get("x",0)), int(layer.get("y",0)), int(layer.get("width",0)), int(layer.get("height",0))
-            # move logo inside safe margin if too close
-            move_x = max(min_logo_margin, lx)
-            move_y = max(min_logo_margin, ly)
-            if lx < min_logo_margin or ly < min_logo_margin or (proj["width"] - (lx+lw)) < min_logo_margin or (proj["height"] - (ly+lh)) < min_logo_margin:
-                changes.append({"layer_id": layer.get("layer_id"), "fix": "move_logo_inside_margin", "from": (lx,ly), "to": (move_x, move_y)})
-                layer["x"] = move_x
-                layer["y"] = move_y
-                updated = True
-
-    # apply to DB if requested
-    if updated and apply_changes:
-        db.editor_projects.update_one({"_id": ObjectId(project_id)}, {"$set": {"layers": new_layers}})
-    return {"status": "success", "applied": updated, "changes": changes}
+def _watch_compliance_scans():
+    while True:
+        try:
+            job = _claim_stale_scan()
+            while job is not None:
+                print(f"[Compliance scan] resuming {job['_id']} after {job.get('last_project_id')}")
+                _start_scan(job["_id"], job["owner"])
+                job = _claim_stale_scan()
+        except Exception as e:
+            print(f"[Compliance scan] watchdog error: {e}")
+        time.sleep(COMPLIANCE_SCAN_LEASE_SECONDS / 2)
+
+@app.on_event("startup")
+def start_compliance_scan_watchdog():
+    db.compliance_reports.create_index([("job_id", 1), ("project_id", 1)], unique=True)
+    db.compliance_scan_jobs.create_index([("status", 1), ("heartbeat_at", 1)])
+    threading.Thread(target=_watch_compliance_scans, name="compliance-scan-watchdog", daemon=True).start()
+
+def _scan_job_status(job):
+    done = job.get("scanned", 0) + job.get("failed", 0)
+    return {
+        "job_id": str(job["_id"]),
+        "status": job["status"],
+        "retailers": job["retailers"],
+        "total": job.get("total", 0),
+        "scanned": job.get("scanned", 0),
+        "failed": job.get("failed", 0),
+        "progress": round(done / job["total"], 4) if job.get("total") else 1.0,
+        "summary": {s["retailer"]: {"non_compliant": s["non_compliant"], "violations": s["violations"]}
+                    for s in job.get("summary", [])},
+        "last_project_id": str(job["last_project_id"]) if job.get("last_project_id") else None,
+        "created_at": job["created_at"].isoformat(),
+        "heartbeat_at": job["heartbeat_at"].isoformat() if job.get("heartbeat_at") else None,
+        "finished_at": job["finished_at"].isoformat() if job.get("finished_at") else None,
+        "error": job.get("error"),
+    }
+
+def _find_scan_job(job_id):
+    try:
+        job = db.compliance_scan_jobs.find_one({"_id": ObjectId(job_id)})
+    except InvalidId:
+        raise HTTPException(status_code=400, detail="Invalid job ID format")
+    if not job:
+        raise HTTPException(status_code=404, detail="Scan job not found")
+    return job
+
+@app.post("/compliance/scans")
+def start_compliance_scan(retailers: Optional[str] = None):
+    """Start a background scan of every project (comma-separated `retailers`, default all)."""
+    names = list(dict.fromkeys(r.strip() for r in retailers.split(",") if r.strip())) if retailers else sorted(guideline_registry.compiled)
+    if not names:
+        raise HTTPException(status_code=400, detail="No retailers to check")
+    for name in names:
+        guideline_registry.get(name)  # 404 early on unknown retailers
+
+    fresh = datetime.utcnow() - timedelta(seconds=COMPLIANCE_SCAN_LEASE_SECONDS)
+    if db.compliance_scan_jobs.find_one({"status": "running", "heartbeat_at": {"$gte": fresh}}):
+        raise HTTPException(status_code=409, detail="A compliance scan is already running")
+
+    now = datetime.utcnow()
+    job = {
+        "status": "running",
+        "retailers": names,
+        "total": db.editor_projects.estimated_document_count(),
+        "scanned": 0,
+        "failed": 0,
+        "summary": [{"retailer": r, "non_compliant": 0, "violations": 0} for r in names],
+        "last_project_id": None,
+        "owner": str(ObjectId()),  # token of this run of the scan
+        "created_at": now,
+        "heartbeat_at": now,
+        "finished_at": None,
+        "error": None,
+    }
+    job["_id"] = db.compliance_scan_jobs.insert_one(job).inserted_id
+    _start_scan(job["_id"], job["owner"])
+    return {"status": "success", "job": _scan_job_status(job)}
+
+@app.get("/compliance/scans/{job_id}")
+def get_compliance_scan(job_id: str):
+    return {"status": "success", "job": _scan_job_status(_find_scan_job(job_id))}
+
+@app.get("/compliance/scans/{job_id}/reports")
+def list_compliance_scan_reports(job_id: str, non_compliant_only: bool = False, skip: int = 0, limit: int = 50):
+    """Reports written so far, in project order; available while the scan runs."""
+    job = _find_scan_job(job_id)
+    query = {"job_id": job["_id"]}
+    if non_compliant_only:
+        query["non_compliant.0"] = {"$exists": True}
+    cursor = db.compliance_reports.find(query).sort("project_id", 1).skip(max(0, skip)).limit(max(1, min(limit, 500)))
+    reports = []
+    for r in cursor:
+        reports.append({
+            "project_id": str(r["project_id"]),
+            "project_name": r.get("project_name"),
+            "checked_at": r["checked_at"].isoformat(),
+            "non_compliant": r.get("non_compliant", []),
+            "violations": r.get("violations", {}),
+            "guideline_versions": r["guideline_versions"],
+            "error": r.get("error"),
+        })
+    return {"status": "success", "job": _scan_job_status(job), "reports": reports}
+
+@app.post("/compliance/scans/{job_id}/resume")
+def resume_compliance_scan(job_id: str):
+    """Continue a failed scan, or one whose process stopped renewing its lease."""
+    job = _find_scan_job(job_id)
+    if job["status"] == "completed":
+        raise HTTPException(status_code=400, detail="Scan already completed")
+    if job["status"] == "failed":
+        # failed scans have no live owner: let the lease check pass immediately
+        db.compliance_scan_jobs.update_one({"_id": job["_id"], "status": "failed"}, {"$set": {"heartbeat_at": datetime.min}})
+    claimed = _claim_stale_scan(job["_id"], statuses=("running", "failed"))
+    if not claimed:
+        raise HTTPException(status_code=409, detail="Scan is still running")
+    _start_scan(claimed["_id"], claimed["owner"])
+    return {"status": "success", "job": _scan_job_status(_find_scan_job(job_id))}
 
 #SMART IMAGE ENHANCEMENT v2 (Advanced AI)
 def pil_to_cv(img: Image.Image):
-    return cv2.cvtColor(np.array(img), cv2.COLOR_RGBA2BGRA if img.mode == "RGBA" else cv2.COLOR_RGB2BGR)
+    arr = np.array(img)
+    return cv2.cvtColor(arr, cv2.COLOR_RGBA2BGRA if img.mode == "RGBA" else cv2.COLOR_RGB2BGR, dst=arr)
 
 def cv_to_pil(img_cv):
-    img_rgb = cv2.cvtColor(img_cv, cv2.COLOR_BGR2RGB)
-    return Image.fromarray(img_rgb)
+    """RGB PIL image of a BGR array; converts in place, so `img_cv` is consumed."""
+    return Image.fromarray(cv2.cvtColor(img_cv, cv2.COLOR_BGR2RGB, dst=img_cv))
 
-def auto_white_balance(img):
-    """ Gray-world AWB """
+LUT_RAMP = np.repeat(np.arange(256, dtype=np.uint8)[:, None, None], 3, axis=2)  # (256, 1, 3): every value, per channel
+
+def auto_white_balance(img, means=None):
+    """ Gray-world AWB (`means`: the frame's channel means, when `img` is a tile of it) """
     result = img.copy().astype(np.float32)
-    avg_b, avg_g, avg_r = np.mean(result[:,:,0]), np.mean(result[:,:,1]), np.mean(result[:,:,2])
+    avg_b, avg_g, avg_r = (np.float32(m) for m in (means or cv2.mean(img)[:3]))
     avg_gray = (avg_b + avg_g + avg_r) / 3
 
     result[:,:,0] = np.clip(result[:,:,0] * (avg_gray / avg_b), 0, 255)
@@ -1181,21 +2965,37 @@ def enhance_shadows_highlights(img):
     blended = cv2.addWeighted(shadows, 0.6, highlights, 0.4, 0)
     return (blended * 255).astype(np.uint8)
 
-def auto_contrast(img):
-    """ Contrast stretching (Histogram Stretch) """
-    ycrcb = cv2.cvtColor(img, cv2.COLOR_BGR2YCrCb)
-    y = ycrcb[:, :, 0]
-    y = cv2.equalizeHist(y)
-    ycrcb[:, :, 0] = y
-    return cv2.cvtColor(ycrcb, cv2.COLOR_YCrCb2BGR)
+def auto_contrast(img, lut=None, dst=None):
+    """ Contrast stretching (Histogram Stretch); `lut` from equalize_lut() for a tile, `dst` may be `img` """
+    ycrcb = cv2.cvtColor(img, cv2.COLOR_BGR2YCrCb, dst=dst)
+    if lut is None:
+        lut = equalize_lut(np.bincount(ycrcb[:, :, 0].ravel(), minlength=256))
+    table = LUT_RAMP.copy()
+    table[:, 0, 0] = lut  # luma only
+    cv2.LUT(ycrcb, table, dst=ycrcb)
+    return cv2.cvtColor(ycrcb, cv2.COLOR_YCrCb2BGR, dst=ycrcb)
+
+def equalize_lut(hist):
+    """ The lookup table cv2.equalizeHist builds from a 256-bin luma histogram """
+    hist = np.asarray(hist, dtype=np.int64).ravel()
+    lut = np.zeros(256, np.uint8)
+    first = int(np.flatnonzero(hist)[0])
+    if hist[first] == hist.sum():
+        lut[:] = first  # flat image
+        return lut
+    scale = np.float32(255.0 / (hist.sum() - hist[first]))
+    lut[first + 1:] = np.clip(np.rint(np.cumsum(hist[first + 1:]).astype(np.float32) * scale), 0, 255)
+    return lut
 
 def blur_level(img):
     """ Returns blur level using Laplacian variance """
     gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-    return cv2.Laplacian(gray, cv2.CV_64F).var()
+    _, std = cv2.meanStdDev(cv2.Laplacian(gray, cv2.CV_16S))  # int16 holds any 8-bit Laplacian
+    return float(std[0, 0]) ** 2
 
-def smart_sharpen(img):
-    b = blur_level(img)
+def smart_sharpen(img, b=None):
+    if b is None:
+        b = blur_level(img)
     if b < 20:
         amount = 1.8
     elif b < 50:
@@ -1204,9 +3004,9 @@ def smart_sharpen(img):
         amount = 1.1
     return cv2.addWeighted(img, 1 + amount, img, -amount, 0)
 
-def noise_reduction(img):
+def noise_reduction(img, dst=None):
     """ Bilateral filter preserving edges """
-    return cv2.bilateralFilter(img, d=7, sigmaColor=40, sigmaSpace=40)
+    return cv2.bilateralFilter(img, d=7, sigmaColor=40, sigmaSpace=40, dst=dst)
 
 def upscale_hd(img):
     """ 2x upscale (safe SR) """
@@ -1255,34 +3055,182 @@ def _amazon_crop(img: Image.Image):
 
     return canvas
 
-@app.get("/smart-enhance/{file_id}")
-def smart_enhance(file_id: str, upscale: bool = False):
-    try:
-        file_obj = fs.get(ObjectId(file_id))
-        pil_img = Image.open(io.BytesIO(file_obj.read())).convert("RGB")
-
-        img = pil_to_cv(pil_img)
-
+# --- Enhancement graph ---------------------------------------------------------
+# Run one after another, the helpers above allocate several full-size arrays
+# per step (float32 copies, two cv2.pow images and a blend), which is most of
+# the chain's time and memory on large photos. smart_enhance_graph() lists
+# them as EnhanceNodes and run_enhance_graph() runs the list over one working
+# buffer and one spare:
+#   - per-pixel nodes give a 256-entry table per channel, made by running the
+#     helper itself on a 0..255 ramp. Consecutive ones are fused into a single
+#     in-place cv2.LUT pass; identity tables are skipped. A node that measures
+#     its input first (white-balance means, blur level) starts a new run.
+#   - other nodes write in place or into the spare, and the buffers swap.
+
+class EnhanceNode:
+    def __init__(self, name, table=None, measure=None, apply=None):
+        self.name = name
+        self.table = table      # stat -> (256, 1, 3) uint8 table, for per-pixel nodes
+        self.measure = measure  # img -> the stat `table` needs, read from the node's input
+        self.apply = apply      # (img, spare) -> result, for whole-frame nodes
+
+def fused_lut(nodes, img):
+    """One table for a run of per-pixel nodes; only the first may measure, and it measures `img`."""
+    lut = None
+    for node in nodes:
+        step = node.table(node.measure(img) if node.measure else None)
+        lut = step if lut is None else np.take_along_axis(step, lut.astype(np.intp), axis=0)
+    return lut
+
+def run_enhance_graph(img, nodes):
+    """Run `nodes` over BGR image `img`, which is overwritten; returns the result."""
+    spare = None
+    i = 0
+    while i < len(nodes):
+        node = nodes[i]
+        if node.table is None:
+            if spare is None or spare.shape != img.shape:
+                spare = np.empty_like(img)
+            out = node.apply(img, spare)
+            if out is spare:
+                img, spare = spare, img
+            elif out is not img:
+                img, spare = out, None  # new size (upscale)
+            i += 1
+            continue
+        end = i + 1
+        while end < len(nodes) and nodes[end].table is not None and nodes[end].measure is None:
+            end += 1
+        lut = fused_lut(nodes[i:end], img)
+        if not np.array_equal(lut, LUT_RAMP):
+            cv2.LUT(img, lut, dst=img)
+        i = end
+    return img
+
+def smart_enhance_graph(upscale=False):
+    nodes = [
         # ----- Step 1: White Balance -----
-        img = auto_white_balance(img)
-
-        # ----- Step 2: Shadow/Highlight Recovery -----
-        img = enhance_shadows_highlights(img)
-
+        EnhanceNode("white_balance", measure=lambda img: cv2.mean(img)[:3],
+                    table=lambda means: auto_white_balance(LUT_RAMP, means)),
+        # ----- Step 2: Shadow/Highlight Recovery (fused with step 1) -----
+        EnhanceNode("shadows_highlights", table=lambda _: enhance_shadows_highlights(LUT_RAMP)),
         # ----- Step 3: Smart Contrast -----
-        img = auto_contrast(img)
-
+        EnhanceNode("contrast", apply=lambda img, spare: auto_contrast(img, dst=img)),
         # ----- Step 4: Noise Reduction -----
-        img = noise_reduction(img)
+        EnhanceNode("noise_reduction", apply=lambda img, spare: noise_reduction(img, dst=spare)),
+        # ----- Step 5: Smart Sharpen (img*(1+a) - img*a: an identity table on 8-bit input) -----
+        EnhanceNode("sharpen", measure=blur_level, table=lambda b: smart_sharpen(LUT_RAMP, b)),
+    ]
+    if upscale:
+        # ----- Step 6: Optional HD Upscale -----
+        nodes.append(EnhanceNode("upscale", apply=lambda img, spare: upscale_hd(img)))
+    return nodes
+
+# --- Tiled smart-enhance -------------------------------------------------------
+# On 24 MP photos the smart-enhance chain is slow and its float32 temporaries
+# run to gigabytes. The tiled mode runs the same helpers on overlapping tiles
+# in a thread pool (OpenCV and most numpy kernels release the GIL). The steps
+# that need whole-frame statistics - white-balance means, the luma histogram
+# for auto_contrast, the blur level for smart_sharpen - get them from a
+# cheap pass over the frame first, so the output matches the untiled chain
+# up to rounding: OpenCV's vectorised filters may round a pixel at a tile
+# edge one level differently. Images of ENHANCE_TILED_MIN_PIXELS and up use
+# it by default.
+ENHANCE_TILE_SIZE = int(os.getenv("ENHANCE_TILE_SIZE", "1024"))
+ENHANCE_WORKERS = int(os.getenv("ENHANCE_WORKERS", "0")) or (os.cpu_count() or 1)
+ENHANCE_TILED_MIN_PIXELS = int(os.getenv("ENHANCE_TILED_MIN_PIXELS", "4000000"))
+ENHANCE_TILE_OVERLAP = 4   # px: bilateral filter radius (3) + Laplacian (1)
+
+def use_tiled_enhance(size, tiled=None):
+    """`tiled` as requested, or by pixel count when None."""
+    return size[0] * size[1] >= ENHANCE_TILED_MIN_PIXELS if tiled is None else tiled
+
+def _enhance_tiles(h, w, tile):
+    return [(y, x, min(h, y + tile), min(w, x + tile)) for y in range(0, h, tile) for x in range(0, w, tile)]
+
+def smart_enhance_tiled(img, upscale=False, tile=None, workers=None):
+    """The smart-enhance chain on a BGR image, tile by tile on `workers` threads."""
+    tile = tile or ENHANCE_TILE_SIZE
+    h, w = img.shape[:2]
+    tiles = _enhance_tiles(h, w, tile)
+    pad = ENHANCE_TILE_OVERLAP
+
+    def padded(y0, x0, y1, x1, margin):
+        return max(0, y0 - margin), max(0, x0 - margin), min(h, y1 + margin), min(w, x1 + margin)
+
+    tone_lut = fused_lut(smart_enhance_graph()[:2], img)  # steps 1-2
+    toned = np.empty_like(img)
+    denoised = np.empty_like(img)
+
+    def tone(box):
+        # Steps 1-2 are per pixel; returns the tile's luma histogram for step 3
+        y0, x0, y1, x1 = box
+        out = cv2.LUT(img[y0:y1, x0:x1], tone_lut, dst=toned[y0:y1, x0:x1])
+        return np.bincount(cv2.cvtColor(out, cv2.COLOR_BGR2YCrCb)[:, :, 0].ravel(), minlength=256)
+
+    def contrast_and_denoise(box):
+        # Steps 3-4; returns Laplacian sum, sum of squares and count for step 5
+        y0, x0, y1, x1 = box
+        py0, px0, py1, px1 = padded(y0, x0, y1, x1, pad)
+        out = noise_reduction(auto_contrast(toned[py0:py1, px0:px1], lut))
+        inner = out[y0 - py0:y1 - py0, x0 - px0:x1 - px0]
+        denoised[y0:y1, x0:x1] = inner
+        lap = cv2.Laplacian(cv2.cvtColor(out, cv2.COLOR_BGR2GRAY), cv2.CV_64F)[y0 - py0:y1 - py0, x0 - px0:x1 - px0]
+        return lap.sum(), np.square(lap).sum(), lap.size
+
+    with ThreadPoolExecutor(max_workers=workers or ENHANCE_WORKERS) as pool:
+        lut = equalize_lut(sum(pool.map(tone, tiles)))
+        sums = list(pool.map(contrast_and_denoise, tiles))
+        n = sum(c for _, _, c in sums)
+        mean = sum(s for s, _, _ in sums) / n
+        blur = sum(q for _, q, _ in sums) / n - mean * mean
+
+        # Step 5 is per pixel, step 6 (2x cubic) reads 2 px around each source pixel
+        if not upscale:
+            def sharpen(box):
+                y0, x0, y1, x1 = box
+                denoised[y0:y1, x0:x1] = smart_sharpen(denoised[y0:y1, x0:x1], blur)
+            list(pool.map(sharpen, tiles))
+            return denoised
+
+        result = np.empty((h * 2, w * 2) + img.shape[2:], img.dtype)
+        def sharpen_and_upscale(box):
+            y0, x0, y1, x1 = box
+            py0, px0, py1, px1 = padded(y0, x0, y1, x1, 2)
+            out = upscale_hd(smart_sharpen(denoised[py0:py1, px0:px1], blur))
+            result[2 * y0:2 * y1, 2 * x0:2 * x1] = out[2 * (y0 - py0):2 * (y1 - py0), 2 * (x0 - px0):2 * (x1 - px0)]
+        list(pool.map(sharpen_and_upscale, tiles))
+        return result
+
+def render_smart_enhance(pil_img: Image.Image, upscale: bool = False, tiled: bool = None) -> Image.Image:   # tiled: None = by image size
+    pil_img = pil_img.convert("RGB")
+
+    img = pil_to_cv(pil_img)
+    if use_tiled_enhance(pil_img.size, tiled):
+        # ----- Steps 1-6 on overlapping tiles -----
+        img = smart_enhance_tiled(img, upscale)
+    else:
+        # ----- Steps 1-6 as one fused graph -----
+        img = run_enhance_graph(img, smart_enhance_graph(upscale))
 
-        # ----- Step 5: Smart Sharpen -----
-        img = smart_sharpen(img)
+    return cv_to_pil(img)
 
-        # ----- Step 6: Optional HD Upscale -----
-        if upscale:
-            img = upscale_hd(img)
+@app.get("/smart-enhance/{file_id}")
+def smart_enhance(file_id: str, upscale: bool = False, tiled: bool = None, preview: bool = False, force: bool = False):   # tiled: None = by image size
+    try:
+        data = fs.get(ObjectId(file_id)).read()
+        if not preview:
+            # tiled output is only near-identical (rounding at tile edges), so it is keyed apart
+            tiled = use_tiled_enhance(Image.open(io.BytesIO(data)).size, tiled)
+            memo = derivation_key(data, "smart-enhance", {"upscale": upscale, "tiled": tiled})
+            cached = None if force else find_derivation(memo)
+            if cached:
+                return cached
+        pil_img, scale = open_source_image(data, preview)
+        out_pil = render_smart_enhance(pil_img, upscale, tiled)
+        if preview:
+            return preview_response("smart-enhance", file_id, {"upscale": upscale, "tiled": tiled}, out_pil, scale)
 
-        out_pil = cv_to_pil(img)
         buffer = pil_to_bytes(out_pil)
 
         new_file_id = fs.put(buffer.getvalue(), filename=f"{file_id}_smart_v2.png", content_type="image/png")
@@ -1290,75 +3238,394 @@ def smart_enhance(file_id: str, upscale: bool = False):
         processed_path = f"processed/{new_file_id}.png"
         out_pil.save(processed_path)
 
-        return {
+        return record_derivation(memo, {
             "status": "success",
             "operation": "smart_enhancement_v2",
             "new_file_id": str(new_file_id)
-        }
+        }, [str(new_file_id)])
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Smart Enhancement V2 failed: {str(e)}")
 
+# --- Proxy segmentation -------------------------------------------------------
+# rembg segments at 320 px and GrabCut's cost grows with the pixel count, so
+# feeding them a 6000x4000 supplier photo mostly buys resize and graph-cut
+# time. Both segment a proxy reduced to SEGMENT_PROXY_SIZE (the quality knob;
+# 0 = full resolution) instead. The mask is upsampled and only its uncertain
+# edge band is re-fitted to the full-resolution pixels with a guided filter,
+# tile by tile.
+SEGMENT_PROXY_SIZE = int(os.getenv("SEGMENT_PROXY_SIZE", "1024"))
+SEGMENT_REFINE_TILE = 512      # px, full-resolution tiles the edge band is refined in
+SEGMENT_REFINE_EPS = 1e-4      # guided filter regularisation: lower follows image edges more tightly
+
+def segmentation_proxy(image: Image.Image):
+    """(`image` reduced for segmentation, reduction factor); factor 1 means unchanged."""
+    factor = segmentation_factor(image.size)
+    if factor <= 1:
+        return image, 1
+    return image.reduce(factor), factor
+
+def segmentation_factor(size) -> int:
+    return math.ceil(max(size) / SEGMENT_PROXY_SIZE) if SEGMENT_PROXY_SIZE else 1
+
+def _guided_filter(guide, src, radius, eps):
+    """He et al.'s guided filter: `src` smoothed along the edges of `guide` (float32, 0..1)."""
+    k = (2 * radius + 1, 2 * radius + 1)
+    mean_i, mean_p = cv2.blur(guide, k), cv2.blur(src, k)
+    cov = cv2.blur(guide * src, k) - mean_i * mean_p
+    var = cv2.blur(guide * guide, k) - mean_i * mean_i
+    a = cov / (var + eps)
+    b = mean_p - a * mean_i
+    return cv2.blur(a, k) * guide + cv2.blur(b, k)
+
+def refine_mask_edges(image: Image.Image, coarse: Image.Image) -> Image.Image:
+    """`coarse` (a proxy-sized "L" mask) at `image`'s size, its edge band refined at full resolution."""
+    w, h = image.size
+    small = np.asarray(coarse)
+    factor = w / coarse.width
+    out = cv2.resize(small, (w, h), interpolation=cv2.INTER_LINEAR)
+
+    # edge band, found on the proxy: soft alpha plus a couple of proxy pixels around the 50% line
+    hard = (small >= 128).astype(np.uint8)
+    ring = np.ones((5, 5), np.uint8)
+    band = ((small > 8) & (small < 247)) | (cv2.dilate(hard, ring) != cv2.erode(hard, ring))
+    if not band.any():
+        return Image.fromarray(out)
+
+    # window ~2x the blur of a 320 px model mask at this size
+    radius = max(4, round(max(w, h) / 160))
+    pad = 2 * radius
+    gray = np.asarray(image.convert("L"))
+    tile = SEGMENT_REFINE_TILE
+    for y in range(0, h, tile):
+        for x in range(0, w, tile):
+            x1, y1 = min(w, x + tile), min(h, y + tile)
+            tile_band = band[int(y / factor):math.ceil(y1 / factor), int(x / factor):math.ceil(x1 / factor)]
+            if not tile_band.any():
+                continue
+            px0, py0, px1, py1 = max(0, x - pad), max(0, y - pad), min(w, x1 + pad), min(h, y1 + pad)
+            refined = _guided_filter(gray[py0:py1, px0:px1].astype(np.float32) / 255,
+                                     out[py0:py1, px0:px1].astype(np.float32) / 255,
+                                     radius, SEGMENT_REFINE_EPS)
+            refined = np.clip(refined * 255 + 0.5, 0, 255).astype(np.uint8)[y - py0:y1 - py0, x - px0:x1 - px0]
+            keep = cv2.resize(tile_band.astype(np.uint8), (x1 - x, y1 - y), interpolation=cv2.INTER_NEAREST) > 0
+            out[y:y1, x:x1][keep] = refined[keep]
+    return Image.fromarray(out)
+
+def grabcut_mask(image: Image.Image) -> Image.Image:
+    """Subject mask from OpenCV GrabCut (centre-rect init), segmented on the proxy."""
+    upright = ImageOps.exif_transpose(image)
+    proxy, factor = segmentation_proxy(upright)
+    img_cv = cv2.cvtColor(np.array(proxy.convert("RGB")), cv2.COLOR_RGB2BGR)
+    mask = np.zeros(img_cv.shape[:2], np.uint8)
+    bgd_model = np.zeros((1, 65), np.float64)
+    fgd_model = np.zeros((1, 65), np.float64)
+    h, w = img_cv.shape[:2]
+    rect = (int(w*0.05), int(h*0.05), int(w*0.9), int(h*0.9))
+    cv2.grabCut(img_cv, mask, rect, bgd_model, fgd_model, 5, cv2.GC_INIT_WITH_RECT)
+    mask = Image.fromarray(np.where((mask == 2) | (mask == 0), 0, 255).astype('uint8'))
+    return refine_mask_edges(upright, mask) if factor > 1 else mask
+
+# --- Subject masks ------------------------------------------------------------
+# Segmentation is the expensive step shared by remove-bg and smart-crop. The
+# alpha mask of a source image is stored once per (sha256 of the file bytes,
+# model, proxy size): as a PNG in GridFS indexed by the subject_masks
+# collection, with a small in-process LRU in front. Later operations on the
+# same image - another crop mode, remove-bg after smart-crop - reuse it
+# instead of re-running the model.
+SUBJECT_MASK_CACHE_SIZE = int(os.getenv("SUBJECT_MASK_CACHE_SIZE", "32"))
+subject_mask_cache = LRUCache(SUBJECT_MASK_CACHE_SIZE)
+subject_mask_counts = {"memory": 0, "stored": 0, "computed": 0}
+
+@app.on_event("startup")
+def ensure_subject_mask_indexes():
+    if "content_hash_1_model_1" in db.subject_masks.index_information():
+        db.subject_masks.drop_index("content_hash_1_model_1")  # key from before proxy_size
+    db.subject_masks.create_index([("content_hash", 1), ("model", 1), ("proxy_size", 1)], unique=True)
+
+def subject_cutout(image: Image.Image, mask: Image.Image) -> Image.Image:
+    """The cutout rembg.remove() returns, rebuilt from its mask."""
+    image = ImageOps.exif_transpose(image)  # rembg segments the upright image
+    return Image.composite(image, Image.new("RGBA", image.size, 0), mask)
+
+def _known_subject_mask(key, size):
+    """The mask for `key` from memory or the mask store, or None if there's no usable one."""
+    mask = subject_mask_cache.get(key)
+    if mask is not None and mask.size == size:
+        subject_mask_counts["memory"] += 1
+        return mask
+
+    content_hash, model, proxy_size = key
+    stored = db.subject_masks.find_one({"content_hash": content_hash, "model": model, "proxy_size": proxy_size})
+    if stored:
+        try:
+            mask = Image.open(io.BytesIO(fs.get(stored["mask_file_id"]).read())).convert("L")
+        except Exception:
+            mask = None
+        if mask is not None and mask.size == size:
+            subject_mask_counts["stored"] += 1
+            subject_mask_cache.put(key, mask)
+            return mask
+        # unreadable or stale entry: drop it and segment again
+        db.subject_masks.delete_one({"_id": stored["_id"]})
+    return None
+
+def subject_mask(image: Image.Image, source_bytes: bytes = None, model: str = REMBG_MODEL) -> Image.Image:
+    """Mode "L" subject mask for `image`, from the mask store when possible.
+
+    `source_bytes` (the stored file) is hashed for the key; without it the
+    decoded pixels are hashed instead.
+    """
+    if source_bytes is None:
+        source_bytes = image.mode.encode() + str(image.size).encode() + image.tobytes()
+    content_hash = hashlib.sha256(source_bytes).hexdigest()
+    upright = ImageOps.exif_transpose(image)
+    size = upright.size
+    proxy, factor = segmentation_proxy(upright)
+    proxy_size = SEGMENT_PROXY_SIZE if factor > 1 else 0
+    key = (content_hash, model, proxy_size)
+
+    mask = _known_subject_mask(key, size)
+    if mask is not None:
+        return mask
+
+    mask = rembg_pool(model).remove(proxy, only_mask=True).convert("L")
+    if factor > 1:
+        mask = refine_mask_edges(upright, mask)
+    subject_mask_counts["computed"] += 1
+    subject_mask_cache.put(key, mask)
+
+    buf = io.BytesIO()
+    mask.save(buf, format="PNG")
+    mask_file_id = fs.put(buf.getvalue(), filename=f"mask_{content_hash[:16]}_{model}.png", content_type="image/png")
+    try:
+        db.subject_masks.insert_one({
+            "content_hash": content_hash,
+            "model": model,
+            "proxy_size": proxy_size,
+            "mask_file_id": mask_file_id,
+            "width": mask.width,
+            "height": mask.height,
+            "created_at": datetime.utcnow(),
+        })
+    except DuplicateKeyError:
+        fs.delete(mask_file_id)  # a concurrent request stored the same mask first
+    return mask
+
+def preview_subject_mask(image: Image.Image, source_bytes: bytes, model: str = REMBG_MODEL) -> Image.Image:
+    """subject_mask for `image`, a preview proxy of the stored file `source_bytes`; stores nothing.
+
+    The stored file's full-size mask is reduced to the proxy when one is
+    known. Otherwise the proxy itself is segmented and kept in memory only.
+    """
+    upright = ImageOps.exif_transpose(image)
+    full = Image.open(io.BytesIO(source_bytes))  # header only, no decode
+    full_size = full.size[::-1] if full.getexif().get(0x0112) in (5, 6, 7, 8) else full.size  # rotated by EXIF
+    content_hash = hashlib.sha256(source_bytes).hexdigest()
+    proxy_size = SEGMENT_PROXY_SIZE if segmentation_factor(full_size) > 1 else 0
+
+    mask = _known_subject_mask((content_hash, model, proxy_size), full_size)
+    if mask is not None:
+        return mask.resize(upright.size, Image.BILINEAR)
+    key = ("preview", content_hash, model, upright.size)
+    mask = subject_mask_cache.get(key)
+    if mask is None:
+        mask = rembg_pool(model).remove(upright, only_mask=True).convert("L")
+        subject_mask_cache.put(key, mask)
+    return mask
+
+def subject_mask_stats():
+    return {**subject_mask_counts, "cache": subject_mask_cache.stats()}
+
+# --- Fast subject detection --------------------------------------------------
+# Studio packshots on plain backgrounds don't need a neural network to find
+# the product. smart-crop's `detector` can pick a cheap detector that runs on
+# a small proxy of the image and reports a confidence; below
+# SMART_CROP_MIN_CONFIDENCE the crop falls back to rembg.
+# (Spectral-residual saliency was tried too: its boxes were much looser and
+# its confidence didn't predict that, so it is not offered.)
+SMART_CROP_MIN_CONFIDENCE = float(os.getenv("SMART_CROP_MIN_CONFIDENCE", "0.85"))
+DETECTOR_PROXY_SIZE = 512      # px, fast detectors see the image reduced to about this
+BACKGROUND_TOLERANCE = 24      # max channel difference still counted as background
+
+def _border_pixels(a, ring):
+    """Pixels of the outer `ring` px of an (h, w, c) array, as (n, c)."""
+    c = a.shape[2]
+    return np.concatenate([a[:ring].reshape(-1, c), a[-ring:].reshape(-1, c),
+                           a[ring:-ring, :ring].reshape(-1, c), a[ring:-ring, -ring:].reshape(-1, c)])
+
+def _detect_by_background(rgba):
+    """Pixels that differ from the (uniform) border colour; confidence = border uniformity.
+
+    Soft shadows - the background darkened evenly across channels - don't count.
+    """
+    ring = max(2, min(rgba.shape[:2]) // 25)
+    border_alpha = _border_pixels(rgba[..., 3:], ring)[:, 0]
+    if (border_alpha < 255).mean() > 0.5:
+        # already a cut-out: the alpha channel is the mask
+        return rgba[..., 3] > 0, float((border_alpha == 0).mean())
+    rgb = rgba[..., :3].astype(np.int16)
+    border = _border_pixels(rgb, ring)
+    bg = np.median(border, axis=0).astype(np.int16)
+    border_dist = np.abs(border - bg).max(axis=1)
+    tolerance = max(BACKGROUND_TOLERANCE, float(np.percentile(border_dist, 99)) + 8)
+    # per-channel maxima via np.maximum - reducing over a 3-wide last axis is slow
+    diff = np.abs(rgb - bg)
+    mask = np.maximum(np.maximum(diff[..., 0], diff[..., 1]), diff[..., 2]) > tolerance
+    r, g, b = np.moveaxis(rgba[..., :3] / np.maximum(bg, 1).astype(np.float32), 2, 0)
+    hi, lo = np.maximum(np.maximum(r, g), b), np.minimum(np.minimum(r, g), b)
+    shadow = (hi - lo < 0.06) & (r + g + b > 1.65) & (hi < 1)
+    mask = cv2.morphologyEx((mask & ~shadow).astype(np.uint8), cv2.MORPH_OPEN, np.ones((3, 3), np.uint8))
+    return mask > 0, float((border_dist <= BACKGROUND_TOLERANCE).mean())
+
+def _detect_by_edges(rgba):
+    """Region spanned by strong edges; confidence drops as edges reach the border."""
+    gray = cv2.GaussianBlur(cv2.cvtColor(rgba[..., :3], cv2.COLOR_RGB2GRAY), (3, 3), 0)
+    edges = cv2.Canny(gray, 50, 150)
+    mask = cv2.morphologyEx(edges, cv2.MORPH_CLOSE, np.ones((7, 7), np.uint8))
+    ring = max(2, min(rgba.shape[:2]) // 25)
+    border_density = float((_border_pixels(edges[..., None], ring) > 0).mean())
+    return mask > 0, max(0.0, 1.0 - border_density / 0.02)
+
+FAST_SUBJECT_DETECTORS = {
+    "background": _detect_by_background,
+    "edges": _detect_by_edges,
+}
+
+def _mask_bbox(mask, scale, size):
+    """Full-resolution bbox of a proxy mask (specks dropped) and the share of the frame the box covers."""
+    n, _, stats, _ = cv2.connectedComponentsWithStats(mask.astype(np.uint8), connectivity=8)
+    keep = [i for i in range(1, n) if stats[i, cv2.CC_STAT_AREA] >= mask.size * 0.001]
+    if not keep:
+        return None, 0.0
+    x0 = min(stats[i, cv2.CC_STAT_LEFT] for i in keep)
+    y0 = min(stats[i, cv2.CC_STAT_TOP] for i in keep)
+    x1 = max(stats[i, cv2.CC_STAT_LEFT] + stats[i, cv2.CC_STAT_WIDTH] for i in keep)
+    y1 = max(stats[i, cv2.CC_STAT_TOP] + stats[i, cv2.CC_STAT_HEIGHT] for i in keep)
+    coverage = (x1 - x0) * (y1 - y0) / mask.size  # box, not pixels: the edge mask is only outlines
+    return (max(0, int(x0 / scale)), max(0, int(y0 / scale)),
+            min(size[0], math.ceil(x1 / scale)), min(size[1], math.ceil(y1 / scale))), coverage
+
+def detect_subject_bbox(image: Image.Image, source_bytes: bytes = None, detector: str = "rembg", model: str = REMBG_MODEL,
+                        preview: bool = False):
+    """(bbox, detector used, fast-detector confidence or None) for the subject in `image`.
+
+    With preview=True, `image` is a preview proxy of `source_bytes` and no mask is stored.
+    """
+    confidence = None
+    if detector != "rembg":
+        upright = ImageOps.exif_transpose(image)  # same frame as rembg's mask
+        factor = max(1, max(upright.size) // DETECTOR_PROXY_SIZE)
+        proxy = upright.reduce(factor) if factor > 1 else upright  # box filter, much cheaper than resize
+        scale = 1 / factor
+        mask, confidence = FAST_SUBJECT_DETECTORS[detector](np.asarray(proxy.convert("RGBA")))
+        bbox, coverage = _mask_bbox(mask, scale, upright.size)
+        if bbox is None or not 0.005 <= coverage <= 0.95:
+            confidence = 0.0  # nothing found, or "everything": not a packshot
+        confidence = round(confidence, 3)
+        if confidence >= SMART_CROP_MIN_CONFIDENCE:
+            return bbox, detector, confidence
+    mask = preview_subject_mask(image, source_bytes, model) if preview else subject_mask(image, source_bytes, model)
+    alpha = subject_cutout(image, mask).getchannel("A")
+    return alpha.getbbox(), "rembg", confidence
+
+def render_smart_crop(
+    image: Image.Image,
+    mode: str = "tight",
+    width: int = None,
+    height: int = None,
+    detector: str = "rembg",
+    model: str = None,
+    source_bytes: bytes = None,
+    scale: float = 1.0,       # custom width/height are given for the stored file; previews render smaller
+    preview: bool = False     # `image` is a preview proxy of `source_bytes`: store no mask
+):
+    """(cropped image, bbox, detector used, fast-detector confidence) for /smart-crop's parameters."""
+    if detector != "rembg" and detector not in FAST_SUBJECT_DETECTORS:
+        raise HTTPException(status_code=400, detail="Invalid detector")
+    model = resolve_rembg_model(model)
+    image = image.convert("RGBA")
+
+    # Step 1: Subject detection (rembg mask shared with remove-bg, or a fast detector)
+    bbox, detector_used, confidence = detect_subject_bbox(image, source_bytes, detector, model, preview)
+    if not bbox:
+        raise HTTPException(status_code=400, detail="Subject not found")
+
+    # Tight crop
+    cropped = image.crop(bbox)
+
+    # MODE HANDLING
+    # 1. TIGHT (default)
+    if mode == "tight":
+        final_img = cropped
+
+    # 2. SQUARE
+    elif mode == "square":
+        max_dim = max(cropped.size)
+        final_img = Image.new("RGBA", (max_dim, max_dim), (255, 255, 255, 0))
+        final_img.paste(
+            cropped,
+            ((max_dim - cropped.width) // 2,
+             (max_dim - cropped.height) // 2)
+        )
+
+    # 3. PORTRAIT (4:5)
+    elif mode == "portrait":
+        target_ratio = 4 / 5
+        final_img = _resize_with_aspect_and_pad(cropped, target_ratio)
+
+    # 4. LANDSCAPE (16:9)
+    elif mode == "landscape":
+        target_ratio = 16 / 9
+        final_img = _resize_with_aspect_and_pad(cropped, target_ratio)
+
+    # 5. AMAZON MODE
+    elif mode == "amazon":
+        # Amazon Standard: White BG, 85% product coverage centered
+        final_img = _amazon_crop(cropped)
+
+    # 6. CUSTOM SIZE
+    elif mode == "custom":
+        if not width or not height:
+            raise HTTPException(status_code=400, detail="Width & height required")
+        final_img = cropped.resize((max(1, round(width * scale)), max(1, round(height * scale))))
+
+    else:
+        raise HTTPException(status_code=400, detail="Invalid crop mode")
+
+    return final_img, bbox, detector_used, confidence
+
 @app.get("/smart-crop/{file_id}")
 def smart_crop(
     file_id: str,
     mode: str = "tight",   # tight, square, portrait, landscape, amazon, custom
     width: int = None,
-    height: int = None
+    height: int = None,
+    detector: str = "rembg",  # rembg, background, edges (fast ones fall back to rembg)
+    model: str = None,        # rembg model: REMBG_MODEL or one of REMBG_MODEL_OPTIONS
+    preview: bool = False,
+    force: bool = False       # recompute even if this exact result is stored
 ):
     try:
         # Fetch original
-        file_obj = fs.get(ObjectId(file_id))
-        image = Image.open(io.BytesIO(file_obj.read())).convert("RGBA")
-
-        # Step 1: Subject detection using rembg
-        removed = remove(image)
-        alpha = removed.getchannel("A")
-        bbox = alpha.getbbox()
-        if not bbox:
-            raise HTTPException(status_code=400, detail="Subject not found")
-
-        # Tight crop
-        cropped = image.crop(bbox)
-
-        # MODE HANDLING
-        # 1. TIGHT (default)
-        if mode == "tight":
-            final_img = cropped
-
-        # 2. SQUARE
-        elif mode == "square":
-            max_dim = max(cropped.size)
-            final_img = Image.new("RGBA", (max_dim, max_dim), (255, 255, 255, 0))
-            final_img.paste(
-                cropped,
-                ((max_dim - cropped.width) // 2,
-                 (max_dim - cropped.height) // 2)
-            )
-
-        # 3. PORTRAIT (4:5)
-        elif mode == "portrait":
-            target_ratio = 4 / 5
-            final_img = _resize_with_aspect_and_pad(cropped, target_ratio)
-
-        # 4. LANDSCAPE (16:9)
-        elif mode == "landscape":
-            target_ratio = 16 / 9
-            final_img = _resize_with_aspect_and_pad(cropped, target_ratio)
-
-        # 5. AMAZON MODE
-        elif mode == "amazon":
-            # Amazon Standard: White BG, 85% product coverage centered
-            final_img = _amazon_crop(cropped)
-
-        # 6. CUSTOM SIZE
-        elif mode == "custom":
-            if not width or not height:
-                raise HTTPException(status_code=400, detail="Width & height required")
-            final_img = cropped.resize((width, height))
+        data = fs.get(ObjectId(file_id)).read()
+        if not preview:
+            params = {"mode": mode, "width": width, "height": height, "detector": detector, "model": resolve_rembg_model(model)}
+            memo = derivation_key(data, "smart-crop", params)
+            cached = None if force else find_derivation(memo)
+            if cached:
+                return cached
+        image, scale = open_source_image(data, preview)
+        final_img, bbox, detector_used, confidence = render_smart_crop(
+            image, mode, width, height, detector, model, data, scale, preview
+        )
 
-        else:
-            raise HTTPException(status_code=400, detail="Invalid crop mode")
+        if preview:
+            params = {"mode": mode, "width": width, "height": height, "detector": detector, "model": model}
+            return preview_response("smart-crop", file_id, params, final_img, scale, {
+                "X-Bbox": ",".join(str(round(v / scale)) for v in bbox),  # in the stored file's pixels
+                "X-Detector": detector_used,
+            })
 
         # Save to GridFS
         buffer = pil_to_bytes(final_img)
@@ -1371,61 +3638,80 @@ def smart_crop(
         # Save locally
         final_img.save(f"processed/{new_file_id}.png")
 
-        return {
+        return record_derivation(memo, {
             "status": "success",
             "operation": "smart_crop",
             "mode": mode,
             "new_file_id": str(new_file_id),
-            "bbox_used": bbox
-        }
+            "bbox_used": bbox,
+            "detector": detector_used,
+            "detector_confidence": confidence
+        }, [str(new_file_id)])
 
+    except HTTPException as he:
+        raise he
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Smart crop failed: {str(e)}")
 
 # Multi Channel Auto Resize
+# Resize presets
+AUTO_RESIZE_PRESETS = {
+    "instagram_square": (1080, 1080),
+    "instagram_portrait": (1080, 1350),
+    "amazon": (2000, 2000),
+    "thumbnail": (300, 300),
+    "website_banner": (1920, 1080),
+    "flipkart": (1600, 2000)
+}
+
+def render_auto_resize(image: Image.Image, include_custom: bool = False, custom_width: int = None, custom_height: int = None):
+    """Yield (channel, (width, height), image) per preset, one image alive at a time."""
+    image = image.convert("RGBA")
+    presets = dict(AUTO_RESIZE_PRESETS)
+
+    # Add custom if requested
+    if include_custom and custom_width and custom_height:
+        presets["custom"] = (custom_width, custom_height)
+
+    # Process all preset sizes
+    for name, (w, h) in presets.items():
+
+        # For Amazon — white background
+        if name == "amazon":
+            bg = Image.new("RGB", (w, h), (255, 255, 255))
+            resized = image.resize((int(w*0.85), int(h*0.85)))
+            bg.paste(
+                resized.convert("RGB"),
+                ((w - resized.width) // 2, (h - resized.height) // 2)
+            )
+            final_img = bg
+        else:
+            # Normal aspect fill resize
+            final_img = image.resize((w, h))
+
+        yield name, (w, h), final_img
+
 @app.get("/auto-resize/{file_id}")
 def auto_resize(
     file_id: str,
     include_custom: bool = False,
     custom_width: int = None,
-    custom_height: int = None
+    custom_height: int = None,
+    force: bool = False        # recompute even if this exact result is stored
 ):
     try:
         # Load original from GridFS
-        file_obj = fs.get(ObjectId(file_id))
-        image = Image.open(io.BytesIO(file_obj.read())).convert("RGBA")
-
-        # Resize presets
-        presets = {
-            "instagram_square": (1080, 1080),
-            "instagram_portrait": (1080, 1350),
-            "amazon": (2000, 2000),
-            "thumbnail": (300, 300),
-            "website_banner": (1920, 1080),
-            "flipkart": (1600, 2000)
-        }
-
-        # Add custom if requested
-        if include_custom and custom_width and custom_height:
-            presets["custom"] = (custom_width, custom_height)
+        data = fs.get(ObjectId(file_id)).read()
+        custom = (custom_width, custom_height) if include_custom and custom_width and custom_height else None
+        memo = derivation_key(data, "auto-resize", {"custom": custom})
+        cached = None if force else find_derivation(memo)
+        if cached:
+            return cached
+        image = Image.open(io.BytesIO(data))
 
         response_list = []
 
-        # Process all preset sizes
-        for name, (w, h) in presets.items():
-
-            # For Amazon — white background
-            if name == "amazon":
-                bg = Image.new("RGB", (w, h), (255, 255, 255))
-                resized = image.resize((int(w*0.85), int(h*0.85)))
-                bg.paste(
-                    resized.convert("RGB"),
-                    ((w - resized.width) // 2, (h - resized.height) // 2)
-                )
-                final_img = bg
-            else:
-                # Normal aspect fill resize
-                final_img = image.resize((w, h))
+        for name, (w, h), final_img in render_auto_resize(image, include_custom, custom_width, custom_height):
 
             # Save each output
             buffer = pil_to_bytes(final_img)
@@ -1444,12 +3730,12 @@ def auto_resize(
                 "file_id": str(new_file_id)
             })
 
-        return {
+        return record_derivation(memo, {
             "status": "success",
             "operation": "auto_resize",
             "total_generated": len(response_list),
             "files": response_list
-        }
+        }, [f["file_id"] for f in response_list])
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Auto resize failed: {str(e)}")
@@ -1561,6 +3847,178 @@ async def batch_export(req: BatchExportRequest):
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Batch export failed: {str(e)}")
+
+# --- Pipeline -------------------------------------------------------------------
+# The usual asset flow (remove-bg -> smart-crop -> smart-enhance -> auto-resize)
+# is one request per hop, and every hop decodes the previous hop's PNG from
+# GridFS, then encodes its own and writes it to GridFS and processed/. POST
+# /pipeline decodes the source once and hands the image from stage to stage in
+# memory; only the stages marked `save` (the last one when none are) are
+# encoded and stored, as PNG or /batch-export's JPEG/WebP. Each stage takes
+# its endpoint's query parameters and gives the same pixels as chaining the
+# endpoints. auto-resize fans out into one image per channel, so it must be
+# the last stage.
+class PipelineStep(BaseModel):
+    op: str                    # remove-bg, smart-crop, crop, enhance, smart-enhance, auto-resize
+    params: Dict = {}          # the endpoint's query parameters
+    save: bool = False         # store this stage's output
+
+class PipelineRequest(BaseModel):
+    file_id: str
+    steps: List[PipelineStep]
+    format: str = "png"        # png / jpeg / webp for stored outputs
+    quality: int = 85          # for jpeg/webp
+
+# Each op's parameters, checked and converted before any stage runs: query
+# strings arrive as JSON strings ("1.5", "false"), and values the endpoints
+# reject (modes, detectors, models) are rejected here too. Outputs are only
+# stored once every stage has run, so a failure leaves nothing behind.
+class _StageParams(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+
+def _check_rembg_model(model):
+    try:
+        resolve_rembg_model(model)
+    except HTTPException as he:
+        raise ValueError(he.detail)
+    return model
+
+class RemoveBgParams(_StageParams):
+    model: Optional[str] = None
+
+    check_model = field_validator("model")(_check_rembg_model)
+
+class SmartCropParams(_StageParams):
+    mode: Literal["tight", "square", "portrait", "landscape", "amazon", "custom"] = "tight"
+    width: Optional[int] = None
+    height: Optional[int] = None
+    detector: str = "rembg"
+    model: Optional[str] = None
+
+    check_model = field_validator("model")(_check_rembg_model)
+
+    @field_validator("detector")
+    @classmethod
+    def check_detector(cls, detector):
+        if detector != "rembg" and detector not in FAST_SUBJECT_DETECTORS:
+            raise ValueError(f"Unknown detector '{detector}'")
+        return detector
+
+    @model_validator(mode="after")
+    def check_custom_size(self):
+        if self.mode == "custom" and not (self.width and self.height):
+            raise ValueError("mode 'custom' needs width and height")
+        return self
+
+class CropParams(_StageParams):
+    mode: str = "square"
+
+class EnhanceParams(_StageParams):
+    sharpness: float = 1.2
+    contrast: float = 1.15
+    brightness: float = 1.1
+
+class SmartEnhanceParams(_StageParams):
+    upscale: bool = False
+    tiled: Optional[bool] = None
+
+class AutoResizeParams(_StageParams):
+    include_custom: bool = False
+    custom_width: Optional[int] = None
+    custom_height: Optional[int] = None
+
+def _stage_remove_bg(image, source_bytes, p: RemoveBgParams):
+    return smart_remove_background(image.convert("RGBA"), source_bytes, resolve_rembg_model(p.model))[0]
+
+def _stage_smart_crop(image, source_bytes, p: SmartCropParams):
+    return render_smart_crop(image, p.mode, p.width, p.height, p.detector, p.model, source_bytes)[0]
+
+# op -> (params model, stage(image, source bytes or None once the image has changed, params))
+PIPELINE_STAGES = {
+    "remove-bg": (RemoveBgParams, _stage_remove_bg),
+    "smart-crop": (SmartCropParams, _stage_smart_crop),
+    "crop": (CropParams, lambda image, source_bytes, p: render_crop(image, p.mode)),
+    "enhance": (EnhanceParams, lambda image, source_bytes, p:
+        render_enhance(image, p.sharpness, p.contrast, p.brightness)),
+    "smart-enhance": (SmartEnhanceParams, lambda image, source_bytes, p: render_smart_enhance(image, p.upscale, p.tiled)),
+    "auto-resize": (AutoResizeParams, lambda image, source_bytes, p:
+        render_auto_resize(image, p.include_custom, p.custom_width, p.custom_height)),
+}
+
+def encode_output(img: Image.Image, format: str, quality: int) -> bytes:
+    buffer = io.BytesIO()
+    if format == "jpeg":
+        img.convert("RGB").save(buffer, format="JPEG", quality=quality, optimize=True)
+    elif format == "webp":
+        img.save(buffer, format="WEBP", quality=quality, method=6)
+    else:
+        img.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+@app.post("/pipeline")
+def run_pipeline(req: PipelineRequest):
+    if req.format not in ("png", "jpeg", "webp"):
+        raise HTTPException(status_code=400, detail="Invalid format. Use ['png', 'jpeg', 'webp']")
+    if not req.steps:
+        raise HTTPException(status_code=400, detail="No steps given")
+    stage_params = []
+    for i, step in enumerate(req.steps):
+        if step.op not in PIPELINE_STAGES:
+            raise HTTPException(status_code=400, detail=f"Step {i}: unknown op '{step.op}'")
+        if step.op == "auto-resize" and i != len(req.steps) - 1:
+            raise HTTPException(status_code=400, detail="auto-resize must be the last step")
+        try:
+            stage_params.append(PIPELINE_STAGES[step.op][0](**step.params))
+        except ValidationError as e:
+            errors = "; ".join(f"{'.'.join(map(str, err['loc']))}: {err['msg']}" if err["loc"] else err["msg"]
+                               for err in e.errors())
+            raise HTTPException(status_code=400, detail=f"Step {i} ({step.op}): {errors}")
+    if not any(step.save for step in req.steps):
+        req.steps[-1].save = True
+
+    try:
+        data = fs.get(ObjectId(req.file_id)).read()
+    except Exception:
+        raise HTTPException(status_code=404, detail="File not found")
+
+    def store(img, i, op, channel=None):
+        name = f"{req.file_id}_pipeline_{i}_{channel or op}.{req.format}"
+        content = encode_output(img, req.format, req.quality)
+        new_file_id = fs.put(content, filename=name, content_type=f"image/{req.format}")
+        with open(f"processed/{new_file_id}.{req.format}", "wb") as f:
+            f.write(content)
+        output = {"step": i, "op": op, "file_id": str(new_file_id), "width": img.width, "height": img.height}
+        return {**output, "channel": channel} if channel else output
+
+    try:
+        image = Image.open(io.BytesIO(data))
+        source_bytes = data
+        kept = []
+        for i, step in enumerate(req.steps):
+            image = PIPELINE_STAGES[step.op][1](image, source_bytes, stage_params[i])
+            source_bytes = None
+            if step.save and step.op != "auto-resize":
+                kept.append((image, i, step.op))
+
+        # every stage has run: store the kept outputs, then auto-resize's
+        # channels as they are made (it is lazy and always last)
+        outputs = [store(img, i, op) for img, i, op in kept]
+        last = req.steps[-1]
+        if last.save and last.op == "auto-resize":
+            outputs.extend(store(resized, len(req.steps) - 1, last.op, name) for name, _, resized in image)
+
+        return {
+            "status": "success",
+            "operation": "pipeline",
+            "steps": [step.op for step in req.steps],
+            "total_saved": len(outputs),
+            "files": outputs
+        }
+
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Pipeline failed: {str(e)}")
     
 #collaboration And Review
 class Annotation(BaseModel):